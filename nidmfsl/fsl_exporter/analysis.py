@@ -0,0 +1,566 @@
+"""
+Extraction of the information shared by all the contrasts of an FSL analysis
+directory. Extraction only deals with plain values and files so that
+analysis directories can be processed in separate processes.
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+from nidmfsl.fsl_exporter.clusters import relabel_clusters, cluster_lut, \
+    connectivity_structure, slab_thickness, SlabLabels
+from nidmfsl.fsl_exporter.images import read_geometry, image_file, \
+    load_data, save_image, save_slabs
+from nidmfsl.fsl_exporter.profile import Profiler, phase
+from nidmfsl.fsl_exporter.smoothness import smoothest_inputs, \
+    estimate_smoothness_from_command
+from nidmfsl.fsl_exporter.tables import read_table
+
+import re
+import os
+import glob
+import json
+import collections
+import logging
+import warnings
+import subprocess
+import numpy as np
+import numpy.linalg as npla
+import nibabel as nib
+import scipy.ndimage
+from nibabel.affines import apply_affine
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+# An excursion set of the analysis, the numbering used for its exported files
+# and the path of its cluster labels map
+ExcursionSetFile = collections.namedtuple(
+    'ExcursionSetFile', ['filename', 'stat_num', 'stat_type', 'stat_num_idx',
+                         'cluster_labels_map'])
+
+
+def get_num_peaks(feat_post_log):
+    if feat_post_log is not None:
+        num_peak_search = re.compile(r'.* --num=(?P<numpeak>\d+)+ .*')
+        num_peak_found = num_peak_search.search(feat_post_log)
+        if num_peak_found:
+            num_peak = int(num_peak_found.group('numpeak'))
+        else:
+            num_peak_search = re.compile(r'.* -n=(?P<numpeak>\d+)+ .*')
+            num_peak_found = num_peak_search.search(feat_post_log)
+            if num_peak_found:
+                num_peak = int(num_peak_found.group('numpeak'))
+            else:
+                # If not specified, default value is inf?
+                # (cf. http://fsl.fmrib.ox.ac.uk/fsl/fslwiki/Cluster)
+                # Is it ok to say no limit with -1 (as for Inf
+                # we would need float...)
+                # FIXME: for now omitted if not explicitely defined
+                num_peak = None
+    else:
+        num_peak = None
+    return num_peak
+
+
+def get_peak_dist(feat_post_log):
+    if feat_post_log is not None:
+        peak_dist_search = re.compile(
+            r'.* --peakdist=(?P<peakdist>\d+)+ .*')
+        peak_dist_found = peak_dist_search.search(feat_post_log)
+        if peak_dist_found:
+            peak_dist = float(peak_dist_found.group('peakdist'))
+        else:
+            # If not specified, default value is zero (cf.
+            # http://fsl.fmrib.ox.ac.uk/fsl/fslwiki/Cluster)
+            peak_dist = 0.0
+    else:
+        peak_dist = 0.0
+
+    return peak_dist
+
+
+def get_connectivity(feat_post_log):
+    """
+    Parse FSL result directory to retreive peak connectivity within a
+    cluster.
+    """
+    # Default connectivity in FSL (26)
+    connectivity = 26
+
+    if feat_post_log is not None:
+        conn_re = r'cluster.* --connectivity=(?P<connectivity>\d+)+ .*'
+        connectivity_search = re.compile(conn_re)
+        conn_in_log = connectivity_search.search(feat_post_log)
+        if conn_in_log is not None:
+            connectivity = int(conn_in_log.group('connectivity'))
+
+    return connectivity
+
+
+def estimate_search_space(analysis_dir, first_level, feat_dir, fsl_path,
+                          native_smoothness=False, scratch_dir=None):
+    """
+    Parse FSL result directory to retreive the search space estimates
+    (volume, resels, noise FWHM and roughness). Return a dictionary of
+    keyword arguments for SearchSpace.
+
+    If the noise FWHM was not stored by FEAT, it is estimated by running
+    FSL's smoothest (whose output is written in 'scratch_dir' or in the
+    stats directory) or, if FSL is not available or 'native_smoothness' is
+    True, with estimate_smoothness (which then also gives the roughness and
+    resels). If the inputs of smoothest are missing, the noise FWHM is not
+    reported.
+    """
+    # FIXME this needs to be estimated
+    search_space_file = image_file(os.path.join(analysis_dir, 'mask'))
+
+    smoothness_file = os.path.join(analysis_dir, 'stats', 'smoothness')
+
+    # Load DLH, VOLUME, RESELS and noise FWHM
+    with open(smoothness_file, "r") as fp:
+        smoothness_txt = fp.read()
+
+    sm_reg = \
+        r"FWHMx = (?P<FWHMx_vx>\d+\.?\d*) voxels, " + \
+        r"FWHMy = (?P<FWHMy_vx>\d+\.?\d*) voxels, " + \
+        r"FWHMz = (?P<FWHMz_vx>\d+\.?\d*) voxels\n" + \
+        r"FWHMx = (?P<FWHMx_mm>\d+\.?\d*) mm, " + \
+        r"FWHMy = (?P<FWHMy_mm>\d+\.?\d*) mm, " + \
+        r"FWHMz = (?P<FWHMz_mm>\d+\.?\d*) mm\n" + \
+        r"DLH (?P<DLH>\d+\.?\d*) voxels\^\-3\n" + \
+        r"VOLUME (?P<volume>\d+) voxels\n" + \
+        r"RESELS (?P<vox_per_resels>\d+\.?\d*) voxels per resel"
+
+    sm_match = re.search(sm_reg, smoothness_txt, re.DOTALL)
+
+    if sm_match:
+        d = sm_match.groupdict()
+    else:
+        # smoothness was estimated without the "-V" option, recompute
+        if first_level:
+            log_file = os.path.join(analysis_dir, 'logs', 'feat3_stats')
+
+            if not os.path.isfile(log_file):
+                log_file = os.path.join(
+                    feat_dir, 'logs', 'feat3_film')
+        else:
+            log_file = os.path.join(analysis_dir, 'logs', 'feat3c_flame')
+
+        if not os.path.isfile(log_file):
+            warnings.warn(
+                "Log file feat3_stats/feat3_film not found, " +
+                "noise FWHM will not be reported")
+            noise_fwhm_in_voxels = None
+            noise_fwhm_in_units = None
+
+            # Load DLH, VOLUME and RESELS
+            d = dict()
+            d['DLH'], d['volume'], d['vox_per_resels'] = \
+                np.loadtxt(smoothness_file, usecols=[1])
+        else:
+            with open(log_file, "r") as fp:
+                log_txt = fp.read()
+
+            cmd_match = re.search(r"(?P<cmd>smoothest.*)\n", log_txt)
+
+            native = cmd_match is not None and (
+                native_smoothness or fsl_path is None)
+            if native:
+                inputs = smoothest_inputs(cmd_match.group("cmd"),
+                                          analysis_dir)
+
+            if native and inputs is not None:
+                # Estimate the noise FWHM, DLH and RESELS (consistent with
+                # each other, see estimate_smoothness) and compare the
+                # resel size with FSL's estimate
+                d = estimate_smoothness_from_command(
+                    cmd_match.group("cmd"), analysis_dir)
+                fsl_vox_per_resels = np.loadtxt(
+                    smoothness_file, usecols=[1])[2]
+
+                if abs(d['vox_per_resels'] /
+                       float(fsl_vox_per_resels) - 1) > 0.1:
+                    warnings.warn(
+                        "Noise FWHM estimated in " + analysis_dir +
+                        " (" + str(d['vox_per_resels']) +
+                        " voxels per resel) differs from FSL's estimate (" +
+                        str(fsl_vox_per_resels) + " voxels per resel)")
+            elif cmd_match and not native:
+                if scratch_dir is None:
+                    smoothness_v_file = smoothness_file + "_v"
+                else:
+                    smoothness_v_file = os.path.join(
+                        scratch_dir, 'smoothness_v')
+
+                cmd = cmd_match.group("cmd")
+                cmd = cmd.replace("stats/smoothness", smoothness_v_file)
+                cmd = cmd.replace(
+                    "smoothest",
+                    os.path.join(fsl_path,
+                                 "bin", "smoothest") + " -V")
+
+                # Discard stdout
+                FNULL = open(os.devnull, 'w')
+                subprocess.check_call(
+                    "cd "+analysis_dir+";"+cmd, shell=True,
+                    stdout=FNULL, stderr=subprocess.STDOUT)
+                with open(smoothness_v_file, "r") as fp:
+                    smoothness_txt = fp.read()
+
+                sm_match = re.search(sm_reg, smoothness_txt, re.DOTALL)
+                d = sm_match.groupdict()
+            else:
+                if cmd_match:
+                    warnings.warn(
+                        "Inputs of the 'smoothest' command not found or " +
+                        "not supported, noise FWHM will not be reported")
+                else:
+                    warnings.warn(
+                        "'smoothest' command not found in log, " +
+                        "noise FWHM will not be reported")
+                noise_fwhm_in_voxels = None
+                noise_fwhm_in_units = None
+
+                # Load DLH, VOLUME and RESELS
+                d = dict()
+                d['DLH'], d['volume'], d['vox_per_resels'] = \
+                    np.loadtxt(smoothness_file, usecols=[1])
+
+    vol_in_resels = float(d['volume'])/float(d['vox_per_resels'])
+
+    if 'FWHMx_vx' in d:
+        noise_fwhm_in_voxels = json.dumps(
+            [float(d['FWHMx_vx']), float(d['FWHMy_vx']),
+             float(d['FWHMz_vx'])])
+        noise_fwhm_in_units = json.dumps(
+            [float(d['FWHMx_mm']), float(d['FWHMy_mm']),
+             float(d['FWHMz_mm'])])
+
+    search_space = dict(
+        search_space_file=search_space_file,
+        vol_in_voxels=int(d['volume']),
+        vol_in_resels=vol_in_resels,
+        resel_size_in_voxels=float(d['vox_per_resels']),
+        noise_fwhm_in_voxels=noise_fwhm_in_voxels,
+        noise_fwhm_in_units=noise_fwhm_in_units,
+        noise_roughness=float(d['DLH']))
+
+    return search_space
+
+
+def compute_cluster_labels_map(excursion_set, analysis_dir, connectivity,
+                               tables=None, label_memory=None,
+                               compresslevel=None):
+    """
+    Compute the cluster labels map of 'excursion_set' (an ExcursionSetFile),
+    numbering clusters as in FSL's cluster table, and save it (gzipped at
+    'compresslevel'). 'tables' is an optional cache of the tables read (see
+    read_table). If labeling the whole volume would use more than
+    'label_memory' bytes, the excursion set is labeled slab by slab (see
+    SlabLabels).
+    """
+    filename = excursion_set.filename
+    stat_num = excursion_set.stat_num
+    stat_type = excursion_set.stat_type
+
+    # Update labels to match FSL's table
+    # If clusters are available in voxel space
+    if stat_type == 'T':
+        cluster_vox_file = glob.glob(
+            os.path.join(analysis_dir,
+                         'cluster_zstat' + str(stat_num) + '.txt'))
+    else:
+        cluster_vox_file = glob.glob(
+            os.path.join(
+                analysis_dir, 'cluster_zfstat' + str(stat_num) +
+                '.txt'))
+
+    if not cluster_vox_file:
+        cluster_vox_tab = None
+    elif len(cluster_vox_file) > 1:
+        print(cluster_vox_file)
+        warnings.warn("Found more than 1 cluster vox file")
+    else:
+        cluster_vox_table = read_table(cluster_vox_file[0], tables)
+        cluster_vox_tab = cluster_vox_table.data
+
+    # If cluster vox table was not found look for coordinates in
+    # world space and convert to voxel space
+    if cluster_vox_tab is None:
+        cluster_file = glob.glob(
+            os.path.join(analysis_dir,
+                         'cluster*' + str(stat_num) + '*_std.txt'))
+        if not cluster_file:
+            cluster_mm_tab = None
+        elif len(cluster_file) > 1:
+            print(cluster_file)
+            warnings.warn("Found more than 1 cluster file")
+        else:
+            cluster_mm_table = read_table(cluster_file[0], tables)
+            cluster_mm_tab = cluster_mm_table.data
+
+        if cluster_mm_tab is not None:
+
+            # Work out which are z-max xyz columns.
+            xcol = cluster_mm_table.indices('Z-MAX X')[0]
+
+            # Transform cluster positions in mm into voxels
+            # Read in coordinates of clusters in mm space
+            cluster_mm = cluster_mm_tab[:, xcol:(xcol+3)]
+
+            # Read in excursion set image header to obtain
+            # world to voxel mapping
+            worldToVox = npla.inv(read_geometry(filename).affine)
+
+            # Transform cluster coordinates to voxel space
+            cluster_vox = apply_affine(worldToVox, cluster_mm)
+
+            # Record coordinates
+            cluster_vox_tab = cluster_mm_tab.copy()
+            cluster_vox_tab[:, xcol:(xcol+3)] = cluster_vox
+
+    voxels = cluster_ids = None
+    if cluster_vox_tab is not None:
+
+        # If we have a voxel table it was either derived from the
+        # mm table and must have the same column layout...
+        if not cluster_vox_file:
+
+            # Work out which are z-max xyz columns and cluster
+            # labels id.
+            xcol = cluster_mm_table.indices('Z-MAX X')[0]
+            clidcol = cluster_mm_table.indices('Cluster Index')[0]
+
+        # Or we had a cluster_vox_file already!
+        else:
+
+            # Work out which are z-max xyz columns and cluster
+            # labels id.
+            xcol = cluster_vox_table.indices('Z-MAX X')[0]
+            clidcol = cluster_vox_table.indices('Cluster Index')[0]
+
+        voxels = cluster_vox_tab[:, xcol:(xcol+3)]
+        cluster_ids = cluster_vox_tab[:, clidcol]
+
+    structure = connectivity_structure(connectivity)
+    affine = read_geometry(filename).affine
+
+    excset_img = nib.load(filename, mmap='r', keep_file_open=True)
+    thickness = excset_img.shape[2]
+    if label_memory is not None:
+        thickness = slab_thickness(
+            excset_img.shape, excset_img.get_data_dtype().itemsize,
+            label_memory)
+
+    if thickness < excset_img.shape[2]:
+        # Label connected clusters slab by slab and replace their labels by
+        # FSL labels (labels that are not in FSL's table are numbered after
+        # FSL labels to avoid conflicts) while the map is written
+        slab_labels = SlabLabels(excset_img.dataobj, structure, thickness,
+                                 voxels)
+        lut = cluster_lut(slab_labels.num_labels, slab_labels.components,
+                          cluster_ids)
+        logger.debug(
+            "Cluster labels map" + excursion_set.stat_num_idx +
+            " computed in " + str(len(slab_labels.bounds)) + " slabs of " +
+            str(thickness) + " planes")
+        save_slabs(excursion_set.cluster_labels_map,
+                   slab_labels.slabs(lut), excset_img.shape[:3], lut.dtype,
+                   affine, compresslevel)
+        return
+
+    # Compute connected clusters from excursion set
+    labels, num_labels = scipy.ndimage.label(
+        np.asanyarray(excset_img.dataobj), structure)
+
+    # Replace existing labels by FSL labels (labels that are not in FSL's
+    # table are numbered after FSL labels to avoid conflicts)
+    clust_labels = relabel_clusters(labels, num_labels, voxels, cluster_ids)
+
+    logger.debug(
+        "Cluster labels map" + excursion_set.stat_num_idx + " stored as " +
+        str(clust_labels.dtype) + ": " +
+        str(labels.nbytes - clust_labels.nbytes) +
+        " bytes saved")
+
+    clusterlabels_img = nib.Nifti1Image(clust_labels, affine)
+    save_image(clusterlabels_img, excursion_set.cluster_labels_map,
+               compresslevel)
+
+
+def masked_median(grand_mean_file, mask_file):
+    """
+    Return the median of the grand mean map within the analysis mask.
+    """
+    # Uncompressed images are not read in memory beyond the mask
+    grand_mean_data = load_data(grand_mean_file)
+    mask_data = load_data(mask_file)
+
+    grand_mean_data_in_mask = grand_mean_data[mask_data > 0]
+    return np.median(np.array(grand_mean_data_in_mask, dtype=float))
+
+
+def compute_group_residuals(stat_dir, residuals_file=None,
+                            compresslevel=None):
+    """
+    Compute the residual mean squares map of a group analysis (sum of the
+    random effects variance and of the lower-level variance) and save it as
+    'residuals_file' (by default in 'stat_dir'), gzipped at 'compresslevel'.
+    Return the path of the map.
+    """
+    sigma2_group_file = image_file(
+        os.path.join(stat_dir, 'mean_random_effects_var1'))
+    sigma2_sub_file = image_file(os.path.join(stat_dir, 'varcope1'))
+
+    sigma2_group = load_data(sigma2_group_file)
+    sigma2_sub = load_data(sigma2_sub_file)
+
+    if residuals_file is None:
+        residuals_file = os.path.join(stat_dir,
+                                      'calculated_sigmasquareds.nii.gz')
+    residuals_img = nib.Nifti1Image(
+        sigma2_group + sigma2_sub, read_geometry(sigma2_sub_file).qform)
+    save_image(residuals_img, residuals_file, compresslevel)
+
+    return residuals_file
+
+
+def extract_analysis(task):
+    """
+    Extract the AnalysisContext of an analysis directory: read its logs,
+    design matrix and smoothness estimates and write the derived maps:
+    cluster labels maps (at the paths given by the excursion sets) and, for
+    group analyses, residual mean squares map (as 'residuals_file'), gzipped at
+    'compresslevel'. Other outputs (of FSL's smoothest) are written in
+    'scratch_dir' or, if None, next to FSL's outputs.
+
+    'task' is a tuple (analysis_dir, excursion_sets, fsf, first_level,
+    feat_dir, fsl_path, num_threads, profile, native_smoothness,
+    label_memory, scratch_dir, residuals_file, compresslevel) so that this
+    function can be used with multiprocessing.Pool.map. Up to 'num_threads'
+    excursion sets are processed concurrently (loading, labelling and saving
+    images mostly happens outside of the GIL). If 'profile' is True, the
+    phases of the extraction are profiled in the 'profile' attribute of the
+    context.
+    """
+    analysis_dir, excursion_sets, fsf, first_level, feat_dir, fsl_path, \
+        num_threads, profile, native_smoothness, label_memory, \
+        scratch_dir, residuals_file, compresslevel = task
+    profiler = Profiler() if profile else None
+
+    # There is not table display listing peaks and clusters for voxelwise
+    # correction
+    feat_post_log_file = os.path.join(analysis_dir, 'logs', 'feat4_post')
+    if os.path.isfile(feat_post_log_file):
+        with open(feat_post_log_file, 'r') as log:
+            feat_post_log = log.read()
+    else:
+        warnings.warn(
+            "Log file feat4_post not found, " +
+            "connectivity information will not be reported")
+        feat_post_log = None
+
+    connectivity = get_connectivity(feat_post_log)
+
+    # Tables read, returned to the exporter so that they are not read again
+    tables = dict()
+
+    def cluster_labels_map(excursion_set):
+        compute_cluster_labels_map(excursion_set, analysis_dir, connectivity,
+                                   tables, label_memory, compresslevel)
+
+    num_threads = min(num_threads, len(excursion_sets))
+    with phase(profiler, 'cluster_labels_maps'):
+        if num_threads > 1:
+            pool = ThreadPool(num_threads)
+            try:
+                pool.map(cluster_labels_map, excursion_sets, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for excursion_set in excursion_sets:
+                cluster_labels_map(excursion_set)
+
+    stat_dir = os.path.join(analysis_dir, 'stats')
+    if first_level:
+        residuals_file = image_file(os.path.join(stat_dir, 'sigmasquareds'))
+    else:
+        with phase(profiler, 'group_residuals'):
+            residuals_file = compute_group_residuals(
+                stat_dir, residuals_file, compresslevel)
+
+    grand_mean_file = image_file(os.path.join(analysis_dir, 'mean_func'))
+    if os.path.isfile(grand_mean_file):
+        with phase(profiler, 'grand_mean_median'):
+            grand_mean_median = masked_median(
+                grand_mean_file,
+                image_file(os.path.join(analysis_dir, 'mask')))
+    else:
+        grand_mean_median = None
+
+    with phase(profiler, 'search_space'):
+        search_space = estimate_search_space(
+            analysis_dir, first_level, feat_dir, fsl_path,
+            native_smoothness, scratch_dir)
+
+    with open(os.path.join(analysis_dir, 'design.mat'), 'r') as fid:
+        design_matrix = np.loadtxt(fid, skiprows=5, ndmin=2)
+
+    return AnalysisContext(
+        analysis_dir, excursion_sets, design_matrix,
+        connectivity=connectivity,
+        peak_dist=get_peak_dist(feat_post_log),
+        num_peaks=get_num_peaks(feat_post_log),
+        prob_thresh=float(fsf.get('fmri(prob_thresh)')),
+        z_thresh=float(fsf.get('fmri(z_thresh)')),
+        thresh_type=int(fsf.get('fmri(thresh)')),
+        search_space=search_space,
+        residuals_file=residuals_file,
+        grand_mean_median=grand_mean_median,
+        tables=tables,
+        profile=profiler.phases if profiler else None)
+
+
+class AnalysisContext(object):
+    """
+    Per-analysis facts (for a .feat directory or for one cope*.feat
+    directory of a .gfeat) that are computed once and shared by all the
+    excursion sets of the analysis: clustering parameters read from
+    logs/feat4_post, height threshold settings, search space estimates and
+    derived maps. Only plain values are stored so that a context can be
+    pickled.
+    """
+
+    def __init__(self, analysis_dir, excursion_sets, design_matrix,
+                 connectivity, peak_dist, num_peaks, prob_thresh, z_thresh,
+                 thresh_type, search_space, residuals_file, grand_mean_median,
+                 tables=None, profile=None):
+        self.analysis_dir = analysis_dir
+        # List of ExcursionSetFile (with cluster labels maps computed)
+        self.excursion_sets = excursion_sets
+        # Values of the design matrix (from design.mat)
+        self.design_matrix = design_matrix
+        # Clustering (from logs/feat4_post)
+        self.connectivity = connectivity
+        self.peak_dist = peak_dist
+        self.num_peaks = num_peaks
+        # Height threshold
+        self.prob_thresh = prob_thresh
+        self.z_thresh = z_thresh
+        self.thresh_type = thresh_type
+        # Keyword arguments of SearchSpace that do not depend on the
+        # coordinate space (from stats/smoothness)
+        self.search_space = search_space
+        # Residual mean squares map
+        self.residuals_file = residuals_file
+        # Median of the grand mean map within the mask (None if missing)
+        self.grand_mean_median = grand_mean_median
+        # FSLTable of the cluster tables read, by path
+        self.tables = tables or dict()
+        # Profiled phases of the extraction (None if not profiled)
+        self.profile = profile
+
+    def __repr__(self):
+        return 'AnalysisContext(' + repr(self.analysis_dir) + ')'
@@ -0,0 +1,264 @@
+"""
+Export of several FSL result directories in a single interpreter.
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+from nidmfsl.fsl_exporter.fsl_exporter import FSLtoNIDMExporter
+from nidmfsl.fsl_exporter.fsf import FSFDesign
+
+import os
+import glob
+import time
+import shlex
+import collections
+import multiprocessing
+import traceback
+
+# A FEAT directory to export and its groups (list of (group name, number of
+# subjects), None for first-level analyses)
+BatchItem = collections.namedtuple('BatchItem', ['feat_dir', 'groups'])
+
+
+def read_batch_file(batch_file):
+    """
+    Read a list of FEAT directories: one directory per line optionally
+    followed by pairs of group name and number of subjects, e.g.:
+        /data/sub01.feat
+        "/data/group analysis.gfeat" control 12 patient 10
+    Empty lines and lines starting with '#' are ignored.
+    """
+    items = list()
+    with open(batch_file, 'r') as fid:
+        for line_num, line in enumerate(fid, 1):
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+
+            feat_dir = fields[0]
+            group_fields = fields[1:]
+            if len(group_fields) % 2:
+                raise Exception(
+                    batch_file + ", line " + str(line_num) + ": groups must "
+                    "be given as pairs of group name and number of subjects")
+
+            groups = [list(group_fields[i:i + 2])
+                      for i in range(0, len(group_fields), 2)]
+            items.append(BatchItem(feat_dir, groups or None))
+
+    return items
+
+
+def _list_dir(path):
+    """
+    Return the (name, path, is_dir) entries of directory 'path', symbolic
+    links to directories are not reported as directories.
+    """
+    if hasattr(os, 'scandir'):
+        return [(entry.name, entry.path, entry.is_dir(follow_symlinks=False))
+                for entry in os.scandir(path)]
+    else:
+        # Python 2
+        entries = list()
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            entries.append((name, entry_path, os.path.isdir(entry_path) and
+                            not os.path.islink(entry_path)))
+        return entries
+
+
+def is_feat_dir(path):
+    """
+    Return True if 'path' is a completed FEAT directory: it has a design.fsf
+    and a stats directory (in the directory itself or, for group analyses,
+    in its cope*.feat directories).
+    """
+    if not os.path.isfile(os.path.join(path, 'design.fsf')):
+        return False
+    return os.path.isdir(os.path.join(path, 'stats')) or \
+        bool(glob.glob(os.path.join(path, 'cope*.feat', 'stats')))
+
+
+def discover_feat_dirs(root, groups=None):
+    """
+    Return a BatchItem for each completed .feat or .gfeat directory found
+    under 'root' (sorted by path). FEAT directories are not searched for
+    nested analyses. 'groups' is used for higher-level analyses.
+    """
+    items = list()
+    to_visit = [os.path.abspath(root)]
+    while to_visit:
+        path = to_visit.pop()
+        name = os.path.basename(path)
+        if name.endswith('.feat') or name.endswith('.gfeat'):
+            if is_feat_dir(path):
+                design = FSFDesign.from_file(os.path.join(path, 'design.fsf'))
+                if int(design.get('fmri(level)', 1)) > 1:
+                    items.append(BatchItem(path, groups))
+                else:
+                    items.append(BatchItem(path, None))
+            continue
+
+        for entry_name, entry_path, is_dir in _list_dir(path):
+            if is_dir:
+                to_visit.append(entry_path)
+
+    return sorted(items, key=lambda item: item.feat_dir)
+
+
+def estimate_cost(feat_dir):
+    """
+    Estimate the cost of exporting 'feat_dir' as the number of bytes of
+    images to be read: the NIfTI images of each analysis directory (and of
+    its stats directory) plus one more read of each excursion set, i.e. of
+    each contrast, for cluster labelling.
+    """
+    analysis_dirs = glob.glob(os.path.join(feat_dir, 'cope*.feat'))
+    if not analysis_dirs:
+        analysis_dirs = [feat_dir]
+
+    cost = 0
+    for analysis_dir in analysis_dirs:
+        for directory in (analysis_dir, os.path.join(analysis_dir, 'stats')):
+            if not os.path.isdir(directory):
+                continue
+            for name, path, is_dir in _list_dir(directory):
+                if not is_dir and name.endswith(('.nii.gz', '.nii')):
+                    size = os.path.getsize(path)
+                    cost += size
+                    if name.startswith('thresh_z'):
+                        cost += size
+    return cost
+
+
+def get_output_path(feat_dir, zipped=True):
+    """
+    Return the path of the NIDM-Results pack created for 'feat_dir' (as
+    named by FSLtoNIDMExporter).
+    """
+    feat_dir = os.path.abspath(feat_dir)
+    if not os.path.isdir(feat_dir) and os.path.isdir(feat_dir + ".feat"):
+        feat_dir = feat_dir + ".feat"
+    feat_dir = feat_dir.rstrip("/")
+
+    out_dir = os.path.join(feat_dir, os.path.basename(feat_dir))
+    if zipped:
+        return out_dir + ".nidm.zip"
+    else:
+        return out_dir + ".nidm"
+
+
+def get_output_paths(feat_dir, zipped=True, version="1.3.0"):
+    """
+    Return the list of paths of the NIDM-Results packs created for
+    'feat_dir' in 'version' (a version or a list of versions, as named by
+    FSLtoNIDMExporter).
+    """
+    output = get_output_path(feat_dir, zipped)
+    if not isinstance(version, (list, tuple)) or len(version) == 1:
+        return [output]
+
+    ext = ".nidm.zip" if zipped else ".nidm"
+    out_dir = output[:-len(ext)]
+    return [out_dir + "_" + v.split("-")[0].replace(".", "") + ext
+            for v in version]
+
+
+def export_item(task):
+    """
+    Export one FEAT directory and return a summary dictionary (feat_dir,
+    status, duration in seconds, output path, error message and traceback).
+    Failures are reported in the summary rather than raised.
+
+    The status is "success", "failure" or, in incremental mode, "skipped"
+    when the previous export is up to date.
+
+    'task' is a tuple (item, options), 'options' being the keyword arguments
+    of FSLtoNIDMExporter (e.g. version, zipped, overwrite or incremental),
+    so that this function can be used with multiprocessing.Pool.
+    """
+    item, options = task
+
+    summary = collections.OrderedDict()
+    summary['feat_dir'] = item.feat_dir
+    summary['status'] = 'failure'
+    summary['duration'] = 0.0
+    summary['output'] = None
+    summary['error'] = None
+    summary['traceback'] = None
+
+    start = time.time()
+    cwd = os.getcwd()
+    try:
+        if not (options.get('incremental') or options.get('overwrite')):
+            for output in get_output_paths(item.feat_dir,
+                                           options.get('zipped', True),
+                                           options['version']):
+                if os.path.exists(output):
+                    # The exporter would otherwise prompt before overwriting
+                    raise Exception(output + " already exists")
+
+        # The previous output is replaced once the new one is complete
+        exporter = FSLtoNIDMExporter(
+            feat_dir=item.feat_dir, groups=item.groups, **options)
+        exporter.parse()
+        summary['output'] = exporter.export()
+        if exporter.up_to_date:
+            summary['status'] = 'skipped'
+        else:
+            summary['status'] = 'success'
+    except Exception as e:
+        summary['error'] = str(e) or e.__class__.__name__
+        summary['traceback'] = traceback.format_exc()
+    finally:
+        # The export changes the working directory when zipping
+        os.chdir(cwd)
+        summary['duration'] = time.time() - start
+
+    return summary
+
+
+def run_batch(items, jobs=1, **options):
+    """
+    Export each BatchItem of 'items', running up to 'jobs' exports in
+    parallel (in separate processes). Exports are started by decreasing
+    estimated cost so that the largest ones do not end up running last.
+    'options' are the keyword arguments of FSLtoNIDMExporter used for each
+    export (e.g. version, "1.3.0" by default, zipped, overwrite, incremental
+    or scratch_dir), as for a single export.
+    Return the list of summaries of export_item in the order of 'items'.
+    """
+    options.setdefault('version', "1.3.0")
+
+    # Paths are resolved now as exports change the working directory
+    items = [BatchItem(os.path.abspath(item.feat_dir), item.groups)
+             for item in items]
+    tasks = [(item, options) for item in items]
+
+    num_jobs = min(jobs, len(tasks))
+    if num_jobs > 1:
+        costs = list()
+        for item in items:
+            try:
+                costs.append(estimate_cost(item.feat_dir))
+            except OSError:
+                costs.append(0)
+        order = sorted(range(len(tasks)), key=lambda i: -costs[i])
+
+        pool = multiprocessing.Pool(num_jobs)
+        try:
+            # Tasks are handed out one at a time, in the order submitted
+            ordered_summaries = pool.map(
+                export_item, [tasks[i] for i in order], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        summaries = [None] * len(tasks)
+        for i, summary in zip(order, ordered_summaries):
+            summaries[i] = summary
+    else:
+        summaries = [export_item(task) for task in tasks]
+
+    return summaries
@@ -0,0 +1,217 @@
+"""
+Cache of the analyses extracted from FEAT directories (see extract_analysis)
+so that a FEAT directory exported again (e.g. in another NIDM-Results
+version or output format) is not extracted again.
+
+Each entry is a directory named after the fingerprint of the inputs of the
+extraction. It holds the plain values of the AnalysisContexts (JSON), their
+arrays (design matrices and tables, in a NumPy .npz file) and the derived
+maps (gzipped NIfTI files, as exported). Entries are evicted in least
+recently used order when the cache grows over its maximum size.
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from nidmfsl.fsl_exporter.analysis import AnalysisContext, ExcursionSetFile
+from nidmfsl.fsl_exporter.tables import FSLTable
+from nidmfsl.fsl_exporter.staging import link_file
+
+# Version of the format of the entries (to be increased whenever the
+# AnalysisContext or the way it is stored changes)
+CACHE_FORMAT = 1
+
+# Files of an entry (in addition to the derived maps)
+CONTEXTS_FILE = 'analyses.json'
+ARRAYS_FILE = 'arrays.npz'
+
+
+def fingerprint(manifest, options):
+    """
+    Return the key of the entry of the analyses extracted from the inputs
+    described by 'manifest' (see build_manifest) with the extraction
+    'options' (a dictionary of JSON values).
+    """
+    text = json.dumps({'format': CACHE_FORMAT, 'files': manifest['files'],
+                       'options': options}, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _json_value(value):
+    # NumPy scalars (e.g. the median of the grand mean map)
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(repr(value) + " is not JSON serializable")
+
+
+def _encode(context, derived_dir, entry_dir, arrays):
+    """
+    Return the JSON description of the AnalysisContext 'context', adding
+    its arrays to 'arrays' and its derived maps (found in 'derived_dir') to
+    'entry_dir'.
+    """
+    def encode_path(path):
+        if path is not None and os.path.dirname(path) == derived_dir:
+            name = os.path.basename(path)
+            link_file(path, os.path.join(entry_dir, name), symlink=False)
+            return {'derived': name}
+        return path
+
+    def encode_array(array):
+        name = 'array' + str(len(arrays))
+        arrays[name] = array
+        return name
+
+    return {
+        'analysis_dir': context.analysis_dir,
+        'excursion_sets': [
+            [excursion_set.filename, excursion_set.stat_num,
+             excursion_set.stat_type, excursion_set.stat_num_idx,
+             encode_path(excursion_set.cluster_labels_map)]
+            for excursion_set in context.excursion_sets],
+        'design_matrix': encode_array(context.design_matrix),
+        'connectivity': context.connectivity,
+        'peak_dist': context.peak_dist,
+        'num_peaks': context.num_peaks,
+        'prob_thresh': context.prob_thresh,
+        'z_thresh': context.z_thresh,
+        'thresh_type': context.thresh_type,
+        'search_space': context.search_space,
+        'residuals_file': encode_path(context.residuals_file),
+        'grand_mean_median': context.grand_mean_median,
+        'tables': [[path, table.header, encode_array(table.data)]
+                   for path, table in sorted(context.tables.items())]}
+
+
+def _decode(analysis, entry_dir, derived_dir, arrays, derived_files):
+    """
+    Return the AnalysisContext described by 'analysis' (see _encode),
+    linking its derived maps from 'entry_dir' to 'derived_dir' (and
+    appending their paths to 'derived_files').
+    """
+    def decode_path(path):
+        if isinstance(path, dict):
+            derived_file = os.path.join(derived_dir, path['derived'])
+            link_file(os.path.join(entry_dir, path['derived']),
+                      derived_file, symlink=False)
+            derived_files.append(derived_file)
+            return derived_file
+        return path
+
+    return AnalysisContext(
+        analysis['analysis_dir'],
+        [ExcursionSetFile(filename, stat_num, stat_type, stat_num_idx,
+                          decode_path(cluster_labels_map))
+         for filename, stat_num, stat_type, stat_num_idx,
+         cluster_labels_map in analysis['excursion_sets']],
+        arrays[analysis['design_matrix']],
+        connectivity=analysis['connectivity'],
+        peak_dist=analysis['peak_dist'],
+        num_peaks=analysis['num_peaks'],
+        prob_thresh=analysis['prob_thresh'],
+        z_thresh=analysis['z_thresh'],
+        thresh_type=analysis['thresh_type'],
+        search_space=analysis['search_space'],
+        residuals_file=decode_path(analysis['residuals_file']),
+        grand_mean_median=analysis['grand_mean_median'],
+        tables=dict((path, FSLTable(header, arrays[name]))
+                    for path, header, name in analysis['tables']))
+
+
+def store_analyses(cache_dir, key, contexts, derived_dir, max_size=None):
+    """
+    Store the AnalysisContexts 'contexts' (whose derived maps are in
+    'derived_dir') as the entry 'key' of 'cache_dir' and then evict the
+    least recently used entries if the cache is larger than 'max_size'
+    bytes.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry_dir):
+        # The entry is written under a temporary name so that it is never
+        # read partially written
+        tmp_dir = tempfile.mkdtemp(prefix='.' + key + '.', dir=cache_dir)
+        try:
+            arrays = dict()
+            analyses = [_encode(context, derived_dir, tmp_dir, arrays)
+                        for context in contexts]
+            np.savez_compressed(os.path.join(tmp_dir, ARRAYS_FILE), **arrays)
+            with open(os.path.join(tmp_dir, CONTEXTS_FILE), 'w') as fid:
+                json.dump({'format': CACHE_FORMAT, 'analyses': analyses},
+                          fid, default=_json_value)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # Entry stored by a concurrent export
+                if not os.path.isdir(entry_dir):
+                    raise
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+    if max_size is not None:
+        evict(cache_dir, max_size)
+
+
+def load_analyses(cache_dir, key, derived_dir):
+    """
+    Return the AnalysisContexts stored as the entry 'key' of 'cache_dir',
+    with their derived maps linked (or copied) to 'derived_dir', or None if
+    there is no such (complete) entry.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    derived_files = list()
+    try:
+        with open(os.path.join(entry_dir, CONTEXTS_FILE), 'r') as fid:
+            entry = json.load(fid)
+        if entry.get('format') != CACHE_FORMAT:
+            return None
+        with np.load(os.path.join(entry_dir, ARRAYS_FILE)) as npz:
+            arrays = dict(npz.items())
+        contexts = [
+            _decode(analysis, entry_dir, derived_dir, arrays, derived_files)
+            for analysis in entry['analyses']]
+        # Most recently used entry
+        os.utime(entry_dir, None)
+    except (IOError, OSError, ValueError, KeyError):
+        # Missing entry, entry evicted while being read or read-only cache
+        # (derived maps already linked are removed as they share their
+        # content with the entry)
+        for derived_file in derived_files:
+            os.remove(derived_file)
+        return None
+
+    return contexts
+
+
+def evict(cache_dir, max_size):
+    """
+    Remove the least recently used entries of 'cache_dir' until its size is
+    at most 'max_size' bytes.
+    """
+    entries = list()
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        # Entries being written are not evicted
+        if name.startswith('.') or not os.path.isdir(entry_dir):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(entry_dir, f))
+                       for f in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+        except OSError:
+            # Entry evicted by a concurrent export
+            continue
+
+    total = sum(size for last_used, size, entry_dir in entries)
+    for last_used, size, entry_dir in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
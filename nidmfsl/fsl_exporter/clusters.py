@@ -0,0 +1,419 @@
+"""
+Helpers to build cluster labels maps from FSL excursion sets (in memory or
+slab by slab for very large volumes) and compact storage of the clusters
+and peaks reported by FSL.
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+import numpy as np
+import scipy.ndimage
+from nidmresults.objects.inference import Cluster, Peak
+
+# Integer types that can be used to store a cluster labels map (NIfTI
+# compatible), from the most to the least compact
+LABEL_DTYPES = (np.uint8, np.uint16, np.int32)
+
+# Rank of the structuring element (as in
+# scipy.ndimage.generate_binary_structure) for each connectivity used by FSL
+CONNECTIVITY_RANKS = {6: 1, 18: 2, 26: 3}
+
+# Approximate number of bytes used per voxel of a slab, on top of the image
+# data, to label it: labels (int32), relabeled slab and positions of the
+# first voxel of each component
+SLAB_BYTES_PER_VOXEL = 16
+
+
+def label_dtype(max_label):
+    """
+    Return the smallest integer type that can store labels up to
+    'max_label'.
+    """
+    for dtype in LABEL_DTYPES:
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise Exception("Too many clusters to be stored in a cluster labels "
+                    "map: " + str(max_label))
+
+
+def connectivity_structure(connectivity):
+    """
+    Return the structuring element of 'connectivity' (6, 18 or 26
+    neighbours) to be used with scipy.ndimage.label.
+    """
+    if connectivity not in CONNECTIVITY_RANKS:
+        raise Exception('Unknown connectivity: ' +
+                        str(connectivity))
+    return scipy.ndimage.generate_binary_structure(
+        3, CONNECTIVITY_RANKS[connectivity]).astype('uint8')
+
+
+def cluster_lut(num_labels, components=None, cluster_ids=None):
+    """
+    Return the lookup table replacing the labels of a connected components
+    map by FSL cluster indices.
+
+    'components' is the component found at each row of the FSL cluster
+    table (e.g. at the Z-MAX position, 0 if outside of the excursion set)
+    and 'cluster_ids' the FSL cluster index of each row. Components that
+    are not referenced in the table are numbered after the last FSL index so
+    that labels never collide. The table is returned in the smallest
+    integer type that fits.
+    """
+    # Lookup table: connected component label -> output label
+    lut = np.zeros(num_labels + 1, dtype=np.int64)
+    referenced = np.zeros(num_labels + 1, dtype=bool)
+    # Background is never relabeled
+    referenced[0] = True
+
+    if components is not None:
+        components = np.asarray(components, dtype=np.int64)
+        cluster_ids = np.asarray(cluster_ids).astype(np.int64)
+
+        # Ignore positions that fall outside of the excursion set
+        inside = components > 0
+        lut[components[inside]] = cluster_ids[inside]
+        referenced[components[inside]] = True
+
+    missing = np.flatnonzero(~referenced)
+    first_free = lut.max() + 1
+    lut[missing] = np.arange(first_free, first_free + missing.size)
+
+    return lut.astype(label_dtype(lut.max()))
+
+
+def relabel_clusters(labels, num_labels, voxels=None, cluster_ids=None):
+    """
+    Replace the labels of a connected components map by FSL cluster indices
+    in a single pass over the volume.
+
+    'voxels' is an (N, 3) array of voxel coordinates (one per row of the FSL
+    cluster table, e.g. the Z-MAX position) and 'cluster_ids' the FSL
+    cluster index of each row (see cluster_lut). The map is returned in the
+    smallest integer type that fits.
+    """
+    components = None
+    if voxels is not None:
+        voxels = np.asarray(voxels).reshape(-1, 3).astype(int)
+        components = labels[voxels[:, 0], voxels[:, 1], voxels[:, 2]]
+
+    return cluster_lut(num_labels, components, cluster_ids)[labels]
+
+
+def slab_thickness(shape, itemsize, max_bytes):
+    """
+    Return the number of planes (along the last axis) of the slabs of an
+    image of shape 'shape' and 'itemsize' bytes per voxel so that labeling
+    a slab uses about 'max_bytes' (at least one plane).
+    """
+    plane_bytes = shape[0] * shape[1] * (itemsize + SLAB_BYTES_PER_VOXEL)
+    return max(1, int(max_bytes // plane_bytes))
+
+
+def _boundary_pairs(previous, current, structure):
+    """
+    Return the unique pairs of labels of neighbouring voxels (according to
+    'structure') of two consecutive planes: 'previous' at z and 'current'
+    at z + 1.
+    """
+    nx, ny = previous.shape
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    for dx, dy in zip(*np.nonzero(structure[:, :, 2])):
+        dx, dy = dx - 1, dy - 1
+        prev = previous[max(0, -dx):nx - max(0, dx),
+                        max(0, -dy):ny - max(0, dy)]
+        curr = current[max(0, dx):nx - max(0, -dx),
+                       max(0, dy):ny - max(0, -dy)]
+        touching = (prev > 0) & (curr > 0)
+        pairs.append(np.stack([prev[touching], curr[touching]], axis=1))
+    return np.unique(np.concatenate(pairs).astype(np.int64), axis=0)
+
+
+def _offset(labels, offset):
+    """
+    Return 'labels' with 'offset' added to the labels of the foreground.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    return np.where(labels > 0, labels + offset, 0)
+
+
+def _union_find(num_labels, pairs):
+    """
+    Return the root (smallest label) of the set of each label (0 to
+    'num_labels') once the labels of each pair are merged.
+    """
+    parent = np.arange(num_labels + 1)
+
+    def find(label):
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    for a, b in pairs.tolist():
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    # Point each label to its root (parents are always smaller labels)
+    while True:
+        roots = parent[parent]
+        if np.array_equal(roots, parent):
+            return roots
+        parent = roots
+
+
+class SlabLabels(object):
+
+    """
+    Connected components of a 3D image labeled slab by slab (along the last
+    axis) so that a single slab of the image and of its labels is in memory
+    at once. Components of consecutive slabs that touch are merged
+    (union-find) and components are numbered as by scipy.ndimage.label on
+    the whole volume (in the C order of their first voxel).
+
+    The image is read twice: once to find the components (and the component
+    at each of 'voxels') and once more, in 'slabs', to produce the labels.
+    """
+
+    def __init__(self, dataobj, structure, thickness, voxels=None):
+        # Image data (e.g. a nibabel array proxy) read one slab at a time
+        self.dataobj = dataobj
+        self.structure = structure
+        self.shape = tuple(dataobj.shape[:3])
+        self.bounds = [(z, min(z + thickness, self.shape[2]))
+                       for z in range(0, self.shape[2], thickness)]
+
+        if voxels is not None:
+            voxels = np.asarray(voxels).reshape(-1, 3).astype(int)
+            components = np.zeros(voxels.shape[0], dtype=np.int64)
+
+        # Label of the first component of each slab (minus one)
+        self.offsets = list()
+        # Position of the first voxel of each component (in the whole volume)
+        first_voxels = list()
+        pairs = list()
+        num_labels = 0
+        previous = None
+        for z_start, z_stop in self.bounds:
+            labels, num_slab = self._label(z_start, z_stop)
+            self.offsets.append(num_labels)
+
+            # First voxel of each component, in C order
+            flat = labels.ravel()
+            foreground = np.flatnonzero(flat)
+            values, first = np.unique(flat[foreground], return_index=True)
+            x, y, z = np.unravel_index(foreground[first], labels.shape)
+            first_voxels.append(
+                np.ravel_multi_index((x, y, z + z_start), self.shape))
+
+            # Components touching the previous slab (labels are offset to
+            # be unique across slabs)
+            if previous is not None:
+                pairs.append(_boundary_pairs(
+                    previous, _offset(labels[:, :, 0], num_labels),
+                    structure))
+            previous = _offset(labels[:, :, -1], num_labels)
+
+            if voxels is not None:
+                inside = (voxels[:, 2] >= z_start) & (voxels[:, 2] < z_stop)
+                found = labels[voxels[inside, 0], voxels[inside, 1],
+                               voxels[inside, 2] - z_start]
+                components[inside] = _offset(found, num_labels)
+
+            num_labels += num_slab
+
+        roots = _union_find(num_labels, np.concatenate(
+            pairs) if pairs else np.zeros((0, 2), dtype=np.int64))
+
+        # Number merged components in the order of their first voxel
+        first_voxels = np.concatenate(first_voxels)
+        root_first = np.full(num_labels + 1, np.iinfo(np.int64).max)
+        np.minimum.at(root_first, roots[1:], first_voxels)
+        root_labels = np.flatnonzero(roots == np.arange(num_labels + 1))[1:]
+        order = np.argsort(root_first[root_labels], kind='mergesort')
+        numbering = np.zeros(num_labels + 1, dtype=np.int64)
+        numbering[root_labels[order]] = np.arange(1, root_labels.size + 1)
+
+        # Lookup table: label within the slabs -> label in the whole volume
+        self.lut = numbering[roots]
+        self.num_labels = root_labels.size
+        # Component at each of 'voxels' (0 if outside of the excursion set)
+        self.components = None
+        if voxels is not None:
+            self.components = self.lut[components]
+
+    def _label(self, z_start, z_stop):
+        """
+        Return the connected components (and their number) of the slab of
+        the image between planes 'z_start' and 'z_stop'.
+        """
+        data = np.asarray(self.dataobj[:, :, z_start:z_stop])
+        return scipy.ndimage.label(data, self.structure)
+
+    def slabs(self, lut=None):
+        """
+        Yield the labels of each slab (in the order of the last axis), as
+        numbered in the whole volume or replaced by 'lut' (a lookup table
+        such as returned by cluster_lut).
+        """
+        if lut is None:
+            lut = np.arange(self.num_labels + 1)
+        for (z_start, z_stop), offset in zip(self.bounds, self.offsets):
+            labels, num_slab = self._label(z_start, z_stop)
+            slab_lut = np.zeros(num_slab + 1, dtype=np.int64)
+            slab_lut[1:] = self.lut[offset + 1:offset + num_slab + 1]
+            yield lut[slab_lut][labels]
+
+
+class PeakList(object):
+
+    """
+    Peaks of an excursion set stored as arrays (one row per peak). The Peak
+    objects are only created when the peaks are accessed (e.g. when the
+    document is serialized) and the same object is returned for a row until
+    release() is called.
+    """
+
+    def __init__(self, cluster_ids, suffixes, equiv_z, coords=None,
+                 coords_std=None):
+        # FSL cluster index of each peak
+        self.cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        self.suffixes = np.asarray(suffixes)
+        self.equiv_z = np.asarray(equiv_z, dtype=float)
+        # (N, 3) arrays of positions in voxels and in mm (or None)
+        if coords is not None:
+            coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        self.coords = coords
+        if coords_std is not None:
+            coords_std = np.asarray(coords_std, dtype=float).reshape(-1, 3)
+        self.coords_std = coords_std
+
+        # Rows of the peaks of each cluster (in the order of the table)
+        self._order = np.argsort(self.cluster_ids, kind='mergesort')
+        self._sorted_ids = self.cluster_ids[self._order]
+        # Peak objects created, by row
+        self._peaks = dict()
+
+    def __len__(self):
+        return self.cluster_ids.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.peak(i)
+
+    def peak(self, i):
+        """
+        Return the Peak object of row 'i'.
+        """
+        i = int(i)
+        if i not in self._peaks:
+            self._peaks[i] = self._make_peak(i)
+        return self._peaks[i]
+
+    def release(self):
+        """
+        Forget the Peak objects created (new objects, with new identifiers,
+        are created on the next access).
+        """
+        self._peaks = dict()
+
+    def _make_peak(self, i):
+        coords = dict()
+        if self.coords is not None:
+            coords['x'], coords['y'], coords['z'] = \
+                [int(v) for v in self.coords[i]]
+        if self.coords_std is not None:
+            coords['x_std'], coords['y_std'], coords['z_std'] = \
+                [float(v) for v in self.coords_std[i]]
+        return Peak(equiv_z=float(self.equiv_z[i]),
+                    suffix=str(self.suffixes[i]), **coords)
+
+    def cluster_peaks(self, cluster_id):
+        """
+        Return the list of Peak objects of cluster 'cluster_id'.
+        """
+        start = np.searchsorted(self._sorted_ids, cluster_id, side='left')
+        stop = np.searchsorted(self._sorted_ids, cluster_id, side='right')
+        return [self.peak(i) for i in self._order[start:stop]]
+
+
+class ClusterList(object):
+
+    """
+    Clusters of an excursion set stored as arrays (one row per cluster),
+    along with their peaks (a PeakList). The Cluster and Peak objects are
+    only created when a cluster is accessed, so that the memory used
+    between the parsing and the serialization scales with the size of the
+    tables. The same objects (and so the same identifiers in the document)
+    are returned on each access until release() is called, e.g. once the
+    document is serialized.
+    """
+
+    def __init__(self, cluster_ids, sizes, peaks=None, p_fwers=None,
+                 cogs=None, cogs_std=None):
+        self.cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.peaks = peaks
+        # Corrected p-value of each cluster (or None if not reported)
+        if p_fwers is not None:
+            p_fwers = np.asarray(p_fwers, dtype=float)
+        self.p_fwers = p_fwers
+        # (N, 3) arrays of centres of gravity in voxels and in mm (or None)
+        if cogs is not None:
+            cogs = np.asarray(cogs, dtype=float).reshape(-1, 3)
+        self.cogs = cogs
+        if cogs_std is not None:
+            cogs_std = np.asarray(cogs_std, dtype=float).reshape(-1, 3)
+        self.cogs_std = cogs_std
+        # Cluster objects created, by row
+        self._clusters = dict()
+
+    def __len__(self):
+        return self.cluster_ids.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        """
+        Return the Cluster object of row 'i' (with its peaks).
+        """
+        i = range(len(self))[i]
+        if i not in self._clusters:
+            self._clusters[i] = self._make_cluster(i)
+        return self._clusters[i]
+
+    def release(self):
+        """
+        Forget the Cluster and Peak objects created (new objects, with new
+        identifiers, are created on the next access).
+        """
+        self._clusters = dict()
+        if self.peaks is not None:
+            self.peaks.release()
+
+    def _make_cluster(self, i):
+        cluster_id = int(self.cluster_ids[i])
+
+        if self.peaks is not None:
+            peaks = self.peaks.cluster_peaks(cluster_id)
+        else:
+            peaks = list()
+
+        pFWER = None
+        if self.p_fwers is not None:
+            pFWER = float(self.p_fwers[i])
+
+        coords = dict()
+        if self.cogs is not None:
+            coords['x'], coords['y'], coords['z'] = \
+                [float(v) for v in self.cogs[i]]
+        if self.cogs_std is not None:
+            coords['x_std'], coords['y_std'], coords['z_std'] = \
+                [float(v) for v in self.cogs_std[i]]
+
+        return Cluster(cluster_num=cluster_id, size=int(self.sizes[i]),
+                       pFWER=pFWER, peaks=peaks, **coords)
@@ -0,0 +1,94 @@
+"""
+Parser for FSL design files (design.fsf).
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+import re
+
+# "set <variable> <value>" statements of a design file
+SET_RE = re.compile(r'^\s*set\s+(?P<key>\S+)\s+(?P<value>.*?)\s*$')
+# Array elements whose index ends the variable name, e.g. fmri(con_real3.12)
+# (family "fmri(con_real3.*)", index 12)
+FAMILY_RE = re.compile(r'^(?P<prefix>.*?)(?P<index>\d+)\)$')
+
+
+def _typed(value):
+    """
+    Convert a raw design file value into an int, a float or a string.
+    """
+    if len(value) > 1 and value.startswith('"') and value.endswith('"'):
+        return value[1:-1]
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+class FSFDesign(object):
+    """
+    Index of the variables set in an FSL design file, built in a single pass
+    over the file.
+    """
+
+    def __init__(self, design_txt):
+        self.raw_values = dict()
+        self.values = dict()
+        self.families = dict()
+
+        for line in design_txt.splitlines():
+            if line.lstrip().startswith('#'):
+                continue
+            m = SET_RE.match(line)
+            if m is None:
+                continue
+
+            key = m.group('key')
+            raw = m.group('value')
+            self.raw_values[key] = raw
+            self.values[key] = _typed(raw)
+
+            m = FAMILY_RE.match(key)
+            if m is not None:
+                family = m.group('prefix') + '*)'
+                self.families.setdefault(family, dict())[
+                    int(m.group('index'))] = key
+
+    @classmethod
+    def from_file(klass, design_file):
+        with open(design_file, 'r') as fid:
+            return klass(fid.read())
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key, default=None):
+        """
+        Return the value of variable 'key' (e.g. "fmri(level)") as an int, a
+        float or a string (quotes removed).
+        """
+        return self.values.get(key, default)
+
+    def raw(self, key, default=None):
+        """
+        Return the value of variable 'key' as written in the design file.
+        """
+        return self.raw_values.get(key, default)
+
+    def items(self, family, raw=False):
+        """
+        Return the (index, value) pairs of all the elements of 'family' (e.g.
+        "fmri(con_real3.*)" or "fmri(evtitle*)") sorted by index.
+        """
+        values = self.raw_values if raw else self.values
+        keys = self.families.get(family, dict())
+        return [(index, values[keys[index]]) for index in sorted(keys)]
+
+    def vector(self, family, raw=False):
+        """
+        Return the values of all the elements of 'family' sorted by index.
+        """
+        return [value for index, value in self.items(family, raw)]
@@ -7,24 +7,46 @@ specification.
 """
 
 from nidmresults.exporter import NIDMExporter
+from prov.model import ProvDocument
+from nidmresults.objects.generic import NIDMFile
 from nidmresults.objects.constants import *
 from nidmresults.objects.modelfitting import *
 from nidmresults.objects.contrast import *
 from nidmresults.objects.inference import *
 from nidmfsl.fsl_exporter.objects.fsl_objects import *
+from nidmfsl.fsl_exporter.images import read_geometry, image_file, \
+    image_files, split_image_ext, compress_image
+from nidmfsl.fsl_exporter.fsf import FSFDesign
+from nidmfsl.fsl_exporter.analysis import extract_analysis, \
+    ExcursionSetFile
+from nidmfsl.fsl_exporter.tables import FSLTable, read_table
+from nidmfsl.fsl_exporter.clusters import ClusterList, PeakList
+from nidmfsl.fsl_exporter.manifest import MANIFEST_SUFFIX, input_files, \
+    build_manifest, read_manifest, write_manifest, manifest_matches
+from nidmfsl.fsl_exporter.profile import Profiler, phase
+from nidmfsl.fsl_exporter.staging import move_atomic, link_file
+from nidmfsl.fsl_exporter.cache import fingerprint, load_analyses, \
+    store_analyses
+from nidmfsl import __version__
 
 import re
 import os
 import sys
 import glob
-import json
-import scipy.ndimage
+import shutil
+import tempfile
 import numpy as np
-import subprocess
 import warnings
-import numpy.linalg as npla
+import collections
+import multiprocessing
 from nibabel.affines import apply_affine
 
+# Python 2 compatibility
+try:
+    input = raw_input
+except NameError:
+    pass
+
 # If "nidmresults" code is available locally work on the source code (used
 # only for development)
 FSL_EXPORTER_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -44,7 +66,12 @@ class FSLtoNIDMExporter(NIDMExporter, object):
     """
 
     def __init__(self, feat_dir, version="1.3.0-rc2", out_dirname=None,
-                 zipped=True, groups=None):
+                 zipped=True, groups=None, jobs=1, incremental=False,
+                 manifest_hashes=False, profile=False,
+                 write_sub_tables=False, native_smoothness=False,
+                 label_memory=None, scratch_dir=None, compresslevel=None,
+                 link_files=False, cache_dir=None, cache_size=None,
+                 overwrite=False):
         # Absolute path to feat directory
         feat_dir = os.path.abspath(feat_dir)
 
@@ -63,11 +90,103 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                 out_dirname = os.path.basename(feat_dir)
         out_dir = os.path.join(feat_dir, out_dirname)
 
-        # Ignore rc* in version number
-        version = version.split("-")[0]
-
+        # Ignore rc* in version number. A list of versions can be given to
+        # write one pack per version from a single parse.
+        if isinstance(version, (list, tuple)):
+            versions = [v.split("-")[0] for v in version]
+        else:
+            versions = [version.split("-")[0]]
+        if not versions:
+            raise Exception("No NIDM-Results version to export.")
+
+        # With several versions, the version is appended to the name of each
+        # pack (e.g. "_130" for 1.3.0)
+        if len(versions) > 1:
+            out_dirs = [out_dir + "_" + v.replace(".", "") for v in versions]
+        else:
+            out_dirs = [out_dir]
+        packs = [d + (".nidm.zip" if zipped else ".nidm") for d in out_dirs]
+        # Paths returned by export()
+        self.outputs = packs[0] if len(packs) == 1 else packs
+
+        # Profile of the phases of the export (None if not profiled)
+        self.profile = Profiler() if profile else None
+        # Temporary directory where the files written by the export are
+        # staged (None until the export is initialised)
+        self.staging_dir = None
+
+        # Design of the analysis (None if there is no design.fsf file, which
+        # is reported by parse())
+        design_file = os.path.join(feat_dir, 'design.fsf')
+        if os.path.isfile(design_file):
+            self.fsf = FSFDesign.from_file(design_file)
+            onset_files = [f for f in self.fsf.vector('fmri(custom*)')
+                           if isinstance(f, str)]
+        else:
+            self.fsf = None
+            onset_files = list()
+
+        # Manifest of the inputs (built before the export writes files next
+        # to them)
+        with phase(self.profile, 'manifest'):
+            manifest = build_manifest(
+                feat_dir, input_files(feat_dir, onset_files),
+                {'nidmfsl': __version__, 'nidm_version': versions[0],
+                 'zipped': zipped, 'groups': groups,
+                 'native_smoothness': native_smoothness},
+                hashes=manifest_hashes)
+
+        # Version, output name, pack and manifest of each pack to export. In
+        # incremental mode, packs whose inputs did not change since their
+        # previous export are skipped.
+        self.exports = list()
+        for version, out_dir, pack in zip(versions, out_dirs, packs):
+            pack_manifest = dict(manifest, options=dict(
+                manifest['options'], nidm_version=version))
+            if incremental and os.path.exists(pack) and manifest_matches(
+                    read_manifest(pack + MANIFEST_SUFFIX), pack_manifest):
+                print("NIDM export up to date: " + pack)
+                continue
+            self.exports.append((version, out_dir, pack, pack_manifest))
+
+        self.up_to_date = not self.exports
+        if self.up_to_date:
+            self.feat_dir = feat_dir
+            self.out_dir = packs[0]
+            return
+
+        # Existing packs are only replaced once the new ones are complete:
+        # without confirmation in incremental mode (out of date packs) or
+        # with 'overwrite'
+        for export in self.exports:
+            if os.path.exists(export[2]) and not (overwrite or incremental):
+                msg = export[2] + " already exists, overwrite?"
+                if not input("%s (y/N) " % msg).lower() == 'y':
+                    quit("Bye.")
+
+        version, out_dir = self.exports[0][:2]
         try:
-            super(FSLtoNIDMExporter, self).__init__(version, out_dir, zipped)
+            # The packs are built in a staging directory (in 'scratch_dir'
+            # or next to the packs) and then moved in place atomically. With
+            # a scratch directory, the derived maps are also written there
+            # rather than in the FEAT directory.
+            self.scratch_dir = scratch_dir
+            self.staging_dir = tempfile.mkdtemp(
+                prefix='nidmfsl-',
+                dir=scratch_dir or os.path.dirname(packs[0]))
+            # The parent exporter is initialised in the staging directory so
+            # that it does not remove the existing pack
+            super(FSLtoNIDMExporter, self).__init__(
+                version, os.path.join(self.staging_dir,
+                                      os.path.basename(out_dir)), zipped)
+            os.rmdir(self.export_dir)
+            # Derived maps (computed once for all versions) are written in
+            # 'derived_dir', which is also the export directory of a single
+            # pack
+            self.derived_dir = os.path.join(self.staging_dir, 'export')
+            os.mkdir(self.derived_dir)
+            self._set_export(*self.exports[0])
+
             # Check if feat_dir exists
             print("Exporting NIDM results from "+feat_dir)
             if not os.path.isdir(feat_dir):
@@ -81,6 +200,42 @@ class FSLtoNIDMExporter(NIDMExporter, object):
             self.f_contrast_names_by_num = dict()
 
             self.groups = groups
+            # Number of analysis directories processed in parallel
+            self.jobs = jobs
+            # Write the tables of clusters and peaks in subject-space mm
+            # (*_sub.txt) computed for first-level analyses in the feat
+            # directory
+            self.write_sub_tables = write_sub_tables
+            # FSLTable of each table file read, by path
+            self._tables = dict()
+            # Estimate the noise FWHM (if not stored by FEAT) without
+            # running FSL's smoothest
+            self.native_smoothness = native_smoothness
+            # Memory (in bytes) above which the excursion sets are labeled
+            # slab by slab (None to always label whole volumes)
+            self.label_memory = label_memory
+            # Gzip compression level of the images written by the export
+            # (None for nibabel's default)
+            self.compresslevel = compresslevel
+            # Link the unchanged FSL outputs into the pack (hard link,
+            # reflink or symbolic link) rather than copying them
+            self.link_files = link_files
+            # SHA512 of the images already exported, by path (reused by the
+            # packs of the next versions)
+            self._shas = dict()
+            # Cache of the extracted analyses (None if not used), keyed by a
+            # fingerprint of the inputs and of the options of the
+            # extraction, and its maximum size in bytes (None for no limit)
+            self.cache_dir = cache_dir
+            self.cache_size = cache_size
+            if cache_dir is not None:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                self.cache_key = fingerprint(manifest, {
+                    'feat_dir': feat_dir, 'nidmfsl': __version__,
+                    'native_smoothness': native_smoothness,
+                    'compresslevel': compresslevel,
+                    'fsl_path': os.getenv('FSLDIR')})
 
             self.without_group_versions = ["0.1.0", "0.2.0", "1.0.0", "1.1.0",
                                            "1.2.0"]
@@ -91,18 +246,39 @@ class FSLtoNIDMExporter(NIDMExporter, object):
             self.cleanup()
             raise
 
+        if self.profile is not None:
+            self._instrument()
+
+    def _instrument(self):
+        """
+        Profile the parsing and export steps: parse, export, the extraction
+        of the analysis directories, the _find_* and _get_* methods, image
+        copies (add_object) and serialization. Methods are only wrapped when
+        profiling so that there is no overhead otherwise.
+        """
+        names = ['parse', 'export', '_extract_analyses', 'add_object',
+                 'save_prov_to_files'] + [
+            name for name in dir(self)
+            if name.startswith('_find_') or name.startswith('_get_')]
+        for name in names:
+            method = getattr(self, name)
+            if callable(method):
+                setattr(self, name, self.profile.wrap(name, method))
+
     def parse(self):
         """
         Parse an FSL result directory to extract the pieces information to be
         stored in NIDM-Results.
         """
+        if self.up_to_date:
+            return
+
         try:
-            # Load design.fsf file
-            design_file_open = open(self.design_file, 'r')
-            self.design_txt = design_file_open.read()
+            # Load design.fsf file (unless already loaded with the manifest)
+            if self.fsf is None:
+                self.fsf = FSFDesign.from_file(self.design_file)
 
-            fmri_level_re = r'.*set fmri\(level\) (?P<info>\d+).*'
-            fmri_level = int(self._search_in_fsf(fmri_level_re))
+            fmri_level = int(self.fsf.get('fmri(level)'))
             self.first_level = (fmri_level == 1)
 
             self.analyses_num = dict()
@@ -119,7 +295,8 @@ class FSLtoNIDMExporter(NIDMExporter, object):
             else:
                 if not self.groups:
                     # Number of subject per groups was introduced in 1.3.0
-                    if self.version['num'] not in self.without_group_versions:
+                    if any(export[0] not in self.without_group_versions
+                           for export in self.exports):
                         raise Exception("Group analysis with unspecified"
                                         "groups.")
                 # If feat was called with the GUI then the analysis directory
@@ -147,11 +324,148 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                         # There is a single analysis, no need to add a prefix
                         self.analyses_num[self.analysis_dirs[0]] = ""
 
+            self._extract_analyses()
+
             super(FSLtoNIDMExporter, self).parse()
         except Exception:
             self.cleanup()
             raise
 
+    def _set_export(self, version, out_dir, pack, manifest):
+        """
+        Set the NIDM-Results version, export directory and pack of the next
+        export (one per version).
+        """
+        if version == "dev":
+            self.version = {'major': 10000, 'minor': 0, 'revision': 0,
+                            'num': version}
+        else:
+            major, minor, revision = version.split(".")
+            self.version = {'major': int(major), 'minor': int(minor),
+                            'revision': int(revision), 'rc': -1,
+                            'num': version}
+
+        if len(self.exports) == 1:
+            self.export_dir = self.derived_dir
+        else:
+            self.export_dir = os.path.join(self.staging_dir,
+                                           'export_' + version)
+            os.mkdir(self.export_dir)
+        self.pack = pack
+        self.out_dir = os.path.join(self.staging_dir, os.path.basename(pack))
+        self.manifest = manifest
+        self.manifest_file = pack + MANIFEST_SUFFIX
+
+    def _parse_version(self):
+        """
+        Build the NIDM objects of the current version in a new document from
+        the analyses already extracted (used for all versions but the first
+        one).
+        """
+        self.doc = ProvDocument()
+        self._add_namespaces()
+        # Objects created by the parent export for the previous version
+        for name in ('bundle_ent', 'export_act', 'exporter', 'export_time'):
+            if hasattr(self, name):
+                delattr(self, name)
+        super(FSLtoNIDMExporter, self).parse()
+
+    def export(self):
+        """
+        Generate the NIDM-Results export of each version (unless it is up
+        to date) and write the manifest of its inputs next to it. Return the
+        path to the pack (or the list of paths with several versions).
+        """
+        if self.up_to_date:
+            return self.outputs
+
+        for num, export in enumerate(self.exports):
+            if num > 0:
+                self._set_export(*export)
+                self._parse_version()
+
+            cwd = os.getcwd()
+            try:
+                super(FSLtoNIDMExporter, self).export()
+            finally:
+                # The export changes the working directory when zipping
+                os.chdir(cwd)
+                self._release_clusters()
+
+            move_atomic(self.out_dir, self.pack)
+            self.out_dir = self.pack
+            write_manifest(self.manifest_file, self.manifest)
+        self.cleanup()
+
+        return self.outputs
+
+    def _release_clusters(self):
+        """
+        Release the Cluster and Peak objects created while serializing the
+        document (see ClusterList).
+        """
+        for con_inferences in self.inferences.values():
+            for inference in con_inferences:
+                if isinstance(inference.clusters, ClusterList):
+                    inference.clusters.release()
+
+    def cleanup(self):
+        """
+        Overload of parent cleanup to also remove the staging directory.
+        """
+        super(FSLtoNIDMExporter, self).cleanup()
+        if self.staging_dir is not None and os.path.isdir(self.staging_dir):
+            shutil.rmtree(self.staging_dir)
+
+    def add_object(self, nidm_object, export_file=True):
+        """
+        Overload of parent add_object: images that are not gzipped NIfTI
+        files (e.g. written with FSLOUTPUTTYPE=NIFTI) are compressed in the
+        export directory as the exported file names end with ".nii.gz",
+        derived maps shared by the packs of several versions are linked into
+        the export directory and, if link_files is set, so are the other FSL
+        outputs (rather than copied). The SHA512 of the images exported for
+        a previous version are reused.
+        """
+        path = None
+        if isinstance(nidm_object, NIDMFile) and \
+                nidm_object.path is not None:
+            path = nidm_object.path
+            if nidm_object.sha is None:
+                nidm_object.sha = self._shas.get(path)
+
+        if export_file and path is not None:
+            new_file = os.path.join(self.export_dir, nidm_object.filename)
+            placed = False
+            shared = False
+            if path != new_file:
+                if nidm_object.filename.endswith('.nii.gz') and \
+                        split_image_ext(path)[1] not in ('', '.nii.gz'):
+                    compress_image(path, new_file, self.compresslevel)
+                    placed = True
+                elif os.path.dirname(path) == self.derived_dir:
+                    link_file(path, new_file, symlink=False)
+                    placed = shared = True
+                elif self.link_files and not nidm_object.temporary:
+                    link_file(path, new_file)
+                    placed = True
+
+            if placed:
+                # Name of the original file (recorded by the parent export
+                # for NIDM-Results 1.0.0 and 1.1.0 from the path, which now
+                # points to the export directory)
+                if self.version['num'] in ("1.0.0", "1.1.0") and \
+                        not nidm_object.temporary:
+                    nidm_object.add_attributes(
+                        [(NFO['fileName'], os.path.basename(path))])
+                if nidm_object.temporary and not shared:
+                    os.remove(path)
+                nidm_object.path = new_file
+
+        super(FSLtoNIDMExporter, self).add_object(nidm_object, export_file)
+        if path is not None:
+            self._shas[path] = nidm_object.sha
+
     def _add_namespaces(self):
         """
         Overload of parent _add_namespaces to add FSL namespace.
@@ -164,8 +478,7 @@ class FSLtoNIDMExporter(NIDMExporter, object):
         Return an object of type Software describing the version of FSL used to
         compute the current analysis.
         """
-        version_re = r'.*set fmri\(version\) (?P<info>\d+\.?\d+).*'
-        feat_version = self._search_in_fsf(version_re)
+        feat_version = self.fsf.raw('fmri(version)')
 
         software = FSLNeuroimagingSoftware(feat_version=feat_version)
 
@@ -247,10 +560,10 @@ class FSLtoNIDMExporter(NIDMExporter, object):
 
             # We must get the T statistics first. We need to have recorded all
             # T statistics in order to then record F statistics.
-            exc_sets_t = glob.glob(os.path.join(analysis_dir,
-                                                'thresh_zstat*.nii.gz'))
-            exc_sets_f = glob.glob(os.path.join(analysis_dir,
-                                                'thresh_zfstat*.nii.gz'))
+            exc_sets_t = image_files(os.path.join(analysis_dir,
+                                                  'thresh_zstat*'))
+            exc_sets_f = image_files(os.path.join(analysis_dir,
+                                                  'thresh_zfstat*'))
 
             # If we have F contrasts we need to record certain T contrast
             # details.
@@ -270,25 +583,18 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                 if stat_type == 'T':
 
                     # Contrast name
-                    name_re = r'.*set fmri\(conname_real\.' + str(con_num) +\
-                        '\) "(?P<info>[^"]+)".*'
-                    contrast_name = self._search_in_fsf(name_re)
+                    contrast_name = self.fsf.get(
+                        'fmri(conname_real.' + str(con_num) + ')')
                     self.t_contrast_names_by_num[con_num] = contrast_name
 
                     # Contrast weights
-                    weights_re = r'.*set fmri\(con_real' + str(con_num) +\
-                        '\.\d+\) (?P<info>-?\d+)'
-                    weight_search = re.compile(weights_re)
-                    contrast_weights = str(
-                        re.findall(weight_search,
-                                   self.design_txt)).replace("'", '')
+                    weights = self._get_contrast_weights(con_num)
+                    contrast_weights = str(weights).replace("'", '')
 
                     # If we have F contrasts we need to record some T contrast
                     # details.
                     if len(exc_sets_f) > 0:
-                        tWeights[con_num-1] = [
-                            float(i) for i in re.findall(
-                                weight_search, self.design_txt)]
+                        tWeights[con_num-1] = [float(i) for i in weights]
                         tNames[con_num-1] = contrast_name
 
                     # For parameter estimate maps.
@@ -300,12 +606,8 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                 else:
 
                     # Record relations between T and F stats.
-                    TtoF_re = r'.*set fmri\(ftest_real' + str(con_num) +\
-                        '\.\d+\) (?P<info>-?\d+)'
-
-                    TtoF_search = re.compile(TtoF_re)
-                    TtoF_vec = re.findall(TtoF_search, self.design_txt)
-                    TtoF_vec = [float(i) for i in TtoF_vec]
+                    TtoF_vec = [float(i) for i in self.fsf.vector(
+                        'fmri(ftest_real' + str(con_num) + '.*)')]
 
                     # Using the T contrast weights that have been recorded
                     # already, create the F contrast weight matrix and contrast
@@ -379,9 +681,9 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                 pe_ids = tuple(pe_ids)
 
                 # Statistic Map
-                stat_file = os.path.join(
+                stat_file = image_file(os.path.join(
                     stat_dir,
-                    stat_type.lower() + 'stat' + str(con_num) + '.nii.gz')
+                    stat_type.lower() + 'stat' + str(con_num)))
 
                 stat_map = StatisticMap(
                     location=stat_file, stat_type=stat_type,
@@ -391,13 +693,13 @@ class FSLtoNIDMExporter(NIDMExporter, object):
 
                 # Z-Statistic Map
                 if stat_type == "F":
-                    z_stat_file = os.path.join(
+                    z_stat_file = image_file(os.path.join(
                         stat_dir,
-                        'zfstat' + str(con_num) + '.nii.gz')
+                        'zfstat' + str(con_num)))
                 elif stat_type == "T":
-                    z_stat_file = os.path.join(
+                    z_stat_file = image_file(os.path.join(
                         stat_dir,
-                        'zstat' + str(con_num) + '.nii.gz')
+                        'zstat' + str(con_num)))
 
                 # Create the Z statistic map file.
                 z_stat_map = StatisticMap(
@@ -409,14 +711,14 @@ class FSLtoNIDMExporter(NIDMExporter, object):
 
                 if stat_type is "T":
                     # Contrast Map
-                    con_file = os.path.join(stat_dir,
-                                            'cope' + str(con_num) + '.nii.gz')
+                    con_file = image_file(os.path.join(
+                        stat_dir, 'cope' + str(con_num)))
                     contrast_map = ContrastMap(con_file, stat_num_idx,
                                                contrast_name, self.coord_space)
 
                     # Contrast Variance and Standard Error Maps
-                    varcontrast_file = os.path.join(
-                        stat_dir, 'varcope' + str(con_num) + '.nii.gz')
+                    varcontrast_file = image_file(os.path.join(
+                        stat_dir, 'varcope' + str(con_num)))
                     is_variance = True
                     std_err_map = ContrastStdErrMap(
                         stat_num_idx,
@@ -426,8 +728,8 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                 elif stat_type is "F":
                     contrast_map = None
 
-                    sigma_sq_file = os.path.join(
-                        stat_dir, 'sigmasquareds.nii.gz')
+                    sigma_sq_file = image_file(os.path.join(
+                        stat_dir, 'sigmasquareds'))
 
                     expl_mean_sq_map = ContrastExplainedMeanSquareMap(
                         stat_file, sigma_sq_file, stat_num_idx,
@@ -473,6 +775,104 @@ class FSLtoNIDMExporter(NIDMExporter, object):
 
         return (con_num, stat_type, stat_num_idx)
 
+    def _extract_analyses(self):
+        """
+        Extract the AnalysisContext of each analysis directory, or load them
+        from the cache (if used) if the same inputs were already extracted.
+        """
+        contexts = None
+        if self.cache_dir is not None:
+            with phase(self.profile, 'cache'):
+                contexts = load_analyses(
+                    self.cache_dir, self.cache_key, self.derived_dir)
+
+        if contexts is None:
+            contexts = self._compute_analyses()
+            if self.cache_dir is not None:
+                with phase(self.profile, 'cache'):
+                    try:
+                        store_analyses(self.cache_dir, self.cache_key,
+                                       contexts, self.derived_dir,
+                                       self.cache_size)
+                    except (IOError, OSError) as e:
+                        warnings.warn("Analyses not cached: " + str(e))
+
+        self.analysis_contexts = dict(
+            (context.analysis_dir, context) for context in contexts)
+        for context in contexts:
+            # Tables already read to compute the cluster labels maps
+            self._tables.update(context.tables)
+
+        if self.profile is not None:
+            # Phases run by the workers (summed over analysis directories)
+            for context in contexts:
+                if context.profile is not None:
+                    self.profile.merge(context.profile)
+
+    def _compute_analyses(self):
+        """
+        Extract and return the AnalysisContext of each analysis directory
+        (in the order of self.analysis_dirs). With more than one job,
+        analysis directories are processed in a pool of processes and the
+        remaining jobs are used as threads to process the excursion sets of
+        each analysis directory, so that no more than self.jobs workers run
+        at the same time.
+        """
+        num_jobs = max(1, min(self.jobs, len(self.analysis_dirs)))
+        num_threads = max(1, self.jobs // num_jobs)
+
+        tasks = list()
+        for analysis_dir in self.analysis_dirs:
+            exc_sets = image_files(os.path.join(analysis_dir, 'thresh_z*'))
+
+            # Other outputs are written next to FSL's outputs unless a
+            # scratch directory is used
+            if self.scratch_dir is None:
+                scratch_dir = None
+            else:
+                scratch_dir = os.path.join(
+                    self.staging_dir,
+                    'analysis' + self.analyses_num[analysis_dir])
+                if not os.path.isdir(scratch_dir):
+                    os.mkdir(scratch_dir)
+
+            # Derived maps are written with the name of the exported file so
+            # that they are not copied (nor compressed) again
+            excursion_sets = list()
+            for filename in exc_sets:
+                stat_num, stat_type, stat_num_idx = self._get_stat_num(
+                    filename, analysis_dir, exc_sets)
+                cluster_labels_map = os.path.join(
+                    self.derived_dir,
+                    'ClusterLabels' + stat_num_idx + '.nii.gz')
+                excursion_sets.append(ExcursionSetFile(
+                    filename, stat_num, stat_type, stat_num_idx,
+                    cluster_labels_map))
+
+            residuals_file = None
+            if not self.first_level:
+                residuals_file = os.path.join(
+                    self.derived_dir, 'ResidualMeanSquares' +
+                    self.analyses_num[analysis_dir] + '.nii.gz')
+
+            tasks.append((analysis_dir, excursion_sets, self.fsf,
+                          self.first_level, self.feat_dir, self.fsl_path,
+                          num_threads, self.profile is not None,
+                          self.native_smoothness, self.label_memory,
+                          scratch_dir, residuals_file, self.compresslevel))
+
+        if num_jobs > 1:
+            pool = multiprocessing.Pool(num_jobs)
+            try:
+                contexts = pool.map(extract_analysis, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            contexts = [extract_analysis(task) for task in tasks]
+
+        return contexts
+
     def _find_inferences(self):
         """
         Parse FSL result directory to retreive information about inference
@@ -483,21 +883,20 @@ class FSLtoNIDMExporter(NIDMExporter, object):
         inferences = dict()
 
         # Any contrast masking?
-        m = re.search(r"set fmri\(conmask1_1\) (?P<con_maskg>[0|1])",
-                      self.design_txt)
-        assert m is not None
-        contrast_masking = bool(int(m.group("con_maskg")))
+        con_maskg = self.fsf.get('fmri(conmask1_1)')
+        assert con_maskg in (0, 1)
+        contrast_masking = bool(con_maskg)
 
         for analysis_dir in self.analysis_dirs:
-            exc_sets = glob.glob(os.path.join(analysis_dir,
-                                              'thresh_z*.nii.gz'))
+            analysis = self.analysis_contexts[analysis_dir]
 
             # Find excursion sets (in a given feat directory we have one
             # excursion set per contrast)
-            for filename in exc_sets:
-
-                stat_num, stat_type, stat_num_idx = self._get_stat_num(
-                    filename, analysis_dir, exc_sets)
+            for excursion_set in analysis.excursion_sets:
+                filename = excursion_set.filename
+                stat_num = excursion_set.stat_num
+                stat_type = excursion_set.stat_type
+                stat_num_idx = excursion_set.stat_num_idx
 
                 # Find corresponding contrast estimation activity
                 con_id = None
@@ -532,173 +931,8 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                 # Excursion set png image
                 zFileImg = filename
 
-                # Cluster Labels Map
-                cluster_labels_map = os.path.join(
-                    analysis_dir, 'tmp_clustmap' + stat_num_idx + '.nii.gz')
-
-                excset_img = nib.load(filename)
-                # Get cluster connectivity
-                # There is not table display listing peaks and clusters for
-                # voxelwise correction
-                feat_post_log_file = os.path.join(
-                    analysis_dir, 'logs', 'feat4_post')
-                if os.path.isfile(feat_post_log_file):
-                    with open(feat_post_log_file, 'r') as log:
-                        feat_post_log = log.read()
-                    connectivity = self._get_connectivity(feat_post_log)
-                else:
-                    warnings.warn(
-                        "Log file feat4_post not found, " +
-                        "connectivity information will not be reported")
-                    feat_post_log = None
-                    connectivity = 26  # FSL's default
-
-                if connectivity == 6:
-                    structure = np.array([[[0, 0, 0],
-                                           [0, 1, 0],
-                                           [0, 0, 0]],
-                                          [[0, 1, 0],
-                                           [1, 1, 1],
-                                           [0, 1, 0]],
-                                          [[0, 0, 0],
-                                           [0, 1, 0],
-                                           [0, 0, 0]]], dtype='uint8')
-                elif connectivity == 18:
-                    structure = np.array([[[0, 1, 0],
-                                           [1, 1, 1],
-                                           [0, 1, 0]],
-                                         [[1, 1, 1],
-                                          [1, 1, 1],
-                                          [1, 1, 1]],
-                                         [[0, 1, 0],
-                                          [1, 1, 1],
-                                          [0, 1, 0]]], dtype='uint8')
-                if connectivity == 26:
-                    structure = np.array([[[1, 1, 1],
-                                           [1, 1, 1],
-                                           [1, 1, 1]],
-                                          [[1, 1, 1],
-                                           [1, 1, 1],
-                                           [1, 1, 1]],
-                                          [[1, 1, 1],
-                                           [1, 1, 1],
-                                           [1, 1, 1]]], dtype='uint8')
-                else:
-                    raise Exception('Unknown connectivity: ' +
-                                    str(connectivity))
-
-                # Compute connected clusters from excursion set
-                labels, num_labels = scipy.ndimage.label(excset_img.get_data(),
-                                                         structure)
-
-                # Update labels to match FSL's table
-                # If clusters are available in voxel space
-                if stat_type == 'T':
-                    cluster_vox_file = glob.glob(
-                        os.path.join(analysis_dir,
-                                     'cluster_zstat' + str(stat_num) + '.txt'))
-                else:
-                    cluster_vox_file = glob.glob(
-                        os.path.join(
-                            analysis_dir, 'cluster_zfstat' + str(stat_num) +
-                            '.txt'))
-
-                if not cluster_vox_file:
-                    cluster_vox_tab = None
-                elif len(cluster_vox_file) > 1:
-                    print(cluster_vox_file)
-                    warnings.warn("Found more than 1 cluster vox file")
-                else:
-                    with warnings.catch_warnings():
-                        # Ignore "Empty input file" for no significant cluster
-                        warnings.simplefilter("ignore")
-                        cluster_vox_tab = np.loadtxt(cluster_vox_file[0],
-                                                     skiprows=1)
-
-                # If cluster vox table was not found look for coordinates in
-                # world space and convert to voxel space
-                if cluster_vox_tab is None:
-                    cluster_file = glob.glob(
-                        os.path.join(analysis_dir,
-                                     'cluster*' + str(stat_num) + '*_std.txt'))
-                    if not cluster_file:
-                        cluster_mm_tab = None
-                    elif len(cluster_file) > 1:
-                        print(cluster_file)
-                        warnings.warn("Found more than 1 cluster file")
-                    else:
-                        with warnings.catch_warnings():
-                            # Ignore "Empty input file" for no significant
-                            # cluster
-                            warnings.simplefilter("ignore")
-                            cluster_mm_tab = np.loadtxt(cluster_file[0],
-                                                        skiprows=1)
-
-                    if cluster_mm_tab is not None:
-
-                        # Work out which are z-max xyz columns.
-                        xcol = self._get_column_indices(
-                            cluster_file[0], 'Z-MAX X')[0]
-
-                        # Transform cluster positions in mm into voxels
-                        # Read in coordinates of clusters in mm space
-                        cluster_mm = cluster_mm_tab[:, xcol:(xcol+3)]
-
-                        # Read in excursion set image header to obtain
-                        # world to voxel mapping
-                        excset_img = nib.load(filename)
-                        worldToVox = npla.inv(excset_img.affine)
-
-                        # Transform cluster coordinates to voxel space
-                        cluster_vox = apply_affine(worldToVox, cluster_mm)
-
-                        # Record coordinates
-                        cluster_vox_tab = cluster_mm_tab
-                        cluster_vox_tab[:, xcol:(xcol+3)] = cluster_vox
-
-                if cluster_vox_tab is not None:
-
-                    # If we have a voxel table it was either derived from the
-                    # mm table and must have the same column layout...
-                    if not cluster_vox_file:
-
-                        cluster_file = glob.glob(
-                            os.path.join(analysis_dir,
-                                         'cluster*' + str(stat_num) +
-                                         '*_std.txt'))
-
-                        # Work out which are z-max xyz columns and cluster
-                        # labels id.
-                        xcol = self._get_column_indices(
-                            cluster_file[0], 'Z-MAX X')[0]
-                        clidcol = self._get_column_indices(
-                            cluster_file[0], 'Cluster Index')[0]
-
-                    # Or we had a cluster_vox_file already!
-                    else:
-
-                        # Work out which are z-max xyz columns and cluster
-                        # labels id.
-                        xcol = self._get_column_indices(
-                            cluster_vox_file[0], 'Z-MAX X')[0]
-                        clidcol = self._get_column_indices(
-                            cluster_vox_file[0], 'Cluster Index')[0]
-
-                    # Relabel using a different set of labels to avoid conflict
-                    # when doing the replacment with FSL labels
-                    labels = labels*max(num_labels, 10000)
-
-                    # Replace existing labels by FSL labels
-                    for i in range(0, np.shape(cluster_vox_tab)[0]):
-
-                        clid = cluster_vox_tab[i, clidcol]
-                        x, y, z = cluster_vox_tab[i, xcol:(xcol+3)]
-                        labels[labels == labels[int(x), int(y), int(z)]] = clid
-
-                clusterlabels_img = nib.Nifti1Image(
-                    labels,
-                    excset_img.affine)
-                nib.save(clusterlabels_img, cluster_labels_map)
+                # Cluster Labels Map (computed by extract_analysis)
+                cluster_labels_map = excursion_set.cluster_labels_map
 
                 temporary = True
                 clust_map = ClusterLabelsMap(
@@ -727,13 +961,9 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                     suffix=stat_num_idx, clust_map=clust_map)
 
                 # Height Threshold
-                prob_re = r'.*set fmri\(prob_thresh\) (?P<info>\d+\.?\d+).*'
-                z_re = r'.*set fmri\(z_thresh\) (?P<info>\d+\.?\d+).*'
-                type_re = r'.*set fmri\(thresh\) (?P<info>\d+).*'
-
-                prob_thresh = float(self._search_in_fsf(prob_re))
-                z_thresh = float(self._search_in_fsf(z_re))
-                thresh_type = int(self._search_in_fsf(type_re))
+                prob_thresh = analysis.prob_thresh
+                z_thresh = analysis.z_thresh
+                thresh_type = analysis.thresh_type
 
                 # FIXME: deal with 0 = no thresh?
                 voxel_uncorr = (thresh_type == 1)
@@ -762,18 +992,18 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                 # Clusters (and associated peaks)
                 clusters = self._get_clusters_peaks(
                     analysis_dir,
-                    stat_num, stat_type, len(exc_sets))
+                    stat_num, stat_type, len(analysis.excursion_sets))
 
                 if clusters is not None:
                     # Peak and Cluster are only reported for cluster-wise
                     # thresholds
                     peak_criteria = PeakCriteria(
                         stat_num,
-                        self._get_peak_dist(feat_post_log),
-                        self._get_num_peaks(feat_post_log))
+                        analysis.peak_dist,
+                        analysis.num_peaks)
                     clus_criteria = ClusterCriteria(
                         stat_num,
-                        connectivity)
+                        analysis.connectivity)
                 else:
                     # Missing peaks and clusters (this happens for voxel-wise
                     # threshold with FSL < x.x)
@@ -786,23 +1016,18 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                 display_mask = list()
                 if contrast_masking:
                     # Find all contrast masking definitions for current stat
-                    con_mask_defs = re.findall(
-                        r"set fmri\(conmask" + str(stat_num) + "_\d+\) 1",
-                        self.design_txt)
-
-                    for con_mask_def in con_mask_defs:
-                        m = re.search(
-                            r"set fmri\(conmask" + str(stat_num) +
-                            "_(?P<c2>\d+)\) 1",
-                            con_mask_def)
-                        assert m is not None
-
-                        c2 = int(m.group("c2"))
+                    con_mask_defs = self.fsf.items(
+                        'fmri(conmask' + str(stat_num) + '_*)')
+
+                    for c2, con_mask in con_mask_defs:
+                        if con_mask != 1:
+                            continue
+
                         if not (stat_num == 1 and c2 == 1):
                             contrast_masks.append(c2)
-                            conmask_file = os.path.join(
+                            conmask_file = image_file(os.path.join(
                                 analysis_dir,
-                                'thresh_zstat' + str(c2) + '.nii.gz')
+                                'thresh_zstat' + str(c2)))
 
                             display_mask.append(DisplayMaskMap(
                                 stat_num,
@@ -826,45 +1051,34 @@ class FSLtoNIDMExporter(NIDMExporter, object):
         Parse FSL result directory to retreive information about the design
         matrix. Return an object of type DesignMatrix.
         """
-        design_mat_file = os.path.join(analysis_dir, 'design.mat')
-        design_mat_fid = open(design_mat_file, 'r')
-        design_mat_values = np.loadtxt(design_mat_fid, skiprows=5, ndmin=2)
+        # Read by extract_analysis
+        design_mat_values = self.analysis_contexts[analysis_dir].design_matrix
         design_mat_image = os.path.join(analysis_dir, 'design.png')
 
         # Regressor names (not taking into account HRF model)
-        regnames_re = r'.*set fmri\(evtitle\d+\).*'
-        ev_names = re.findall(regnames_re, self.design_txt)
-
-        orig_ev = dict()
-        for ev_name in ev_names:
-            regname_re = r'.*set fmri\(evtitle(?P<num>\d+)\)\s*"(?P<name>.*)"'
-            info_search = re.compile(regname_re)
-            info_found = info_search.search(ev_name)
-            num = info_found.group('num')
-            name = info_found.group('name')
-            orig_ev[int(num)] = name
+        orig_ev = collections.OrderedDict(self.fsf.items('fmri(evtitle*)'))
 
         # For first-level fMRI only
         if self.first_level:
             # Design-type: event, mixed or block
             # Deal only with the "custom" option (latest NIDM-Results version
-            # do not include design type)
-            onsets_re = r'.*set fmri\(custom(?P<num>\d+)\)\s*"(?P<file>.*)".*'
-            r = re.compile(onsets_re)
-            onsets = [m.groupdict() for m in r.finditer(self.design_txt)]
+            # do not include design type). Unquoted values (parsed as
+            # numbers) are not onset files.
+            onset_files = [f for f in self.fsf.vector('fmri(custom*)')
+                           if isinstance(f, str)]
             max_duration = 0
             min_duration = 36000
 
             missing_onset_file = list()
-            for onset in onsets:
-                if os.path.isfile(onset['file']):
-                    aa = np.loadtxt(onset['file'], ndmin=2)
+            for onset_file in onset_files:
+                if os.path.isfile(onset_file):
+                    aa = np.loadtxt(onset_file, ndmin=2)
                     max_duration = max(
                         max_duration, np.amax(aa[:, 2], axis=None))
                     min_duration = min(
                         min_duration, np.amin(aa[:, 2], axis=None))
                 else:
-                    missing_onset_file.append(onset['file'])
+                    missing_onset_file.append(onset_file)
                     max_duration = None
 
             if max_duration is not None:
@@ -880,11 +1094,9 @@ class FSLtoNIDMExporter(NIDMExporter, object):
             # HRF model
             prev_hrf = None
             for ev_num, ev_name in list(orig_ev.items()):
-                m = re.search(
-                    r"set fmri\(convolve" + str(ev_num) + "\) (?P<hrf>\d)",
-                    self.design_txt)
-                assert m is not None
-                hrf = int(m.group("hrf"))
+                hrf = self.fsf.get('fmri(convolve' + str(ev_num) + ')')
+                assert hrf is not None
+                hrf = int(hrf)
 
                 if prev_hrf is not None:
                     # Sanity check: all regressors should have the same hrf
@@ -912,10 +1124,9 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                 hrf_model = [NIDM_FINITE_IMPULSE_RESPONSE_HRB]
 
             # Drift model
-            m = re.search(
-                r"set fmri\(paradigm_hp\) (?P<cut_off>\d+)", self.design_txt)
-            assert m is not None
-            cut_off = float(m.group("cut_off"))
+            cut_off = self.fsf.get('fmri(paradigm_hp)')
+            assert cut_off is not None
+            cut_off = float(cut_off)
 
             drift_model = DriftModel(
                 FSL_GAUSSIAN_RUNNING_LINE_DRIFT_MODEL, cut_off)
@@ -940,26 +1151,23 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                     basis = 'FIRBasis'
 
                 # Number of basis functions
-                fir_basis_num_re = \
-                    r'.*set fmri\(basisfnum'+str(ev_num)+'\) (?P<info>[\d]+).*'
-                fir_basis_num = int(self._search_in_fsf(fir_basis_num_re))
+                fir_basis_num = int(
+                    self.fsf.get('fmri(basisfnum' + str(ev_num) + ')'))
                 for i in range(1, fir_basis_num):
                     real_ev.append(ev_name+'*'+basis+'_'+str(i))
 
             # Add one regressor name if there is an extra column for a temporal
             # derivative
-            tempo_deriv_re = \
-                r'.*set fmri\(deriv_yn'+str(ev_num)+'\) (?P<info>[\d]+).*'
-            tempo_deriv = bool(int(self._search_in_fsf(tempo_deriv_re)))
+            tempo_deriv = bool(int(
+                self.fsf.get('fmri(deriv_yn' + str(ev_num) + ')')))
 
             if tempo_deriv:
                 real_ev.append(ev_name+'*temporal_derivative')
 
         # Add regressor names for motion regressors
-        m = re.search(
-            r"set fmri\(motionevs\) (?P<motionreg>\d+)", self.design_txt)
-        assert m is not None
-        motion_reg = int(m.group("motionreg"))
+        motion_reg = self.fsf.get('fmri(motionevs)')
+        assert motion_reg is not None
+        motion_reg = int(motion_reg)
         # 6 motion regressors added
         if motion_reg == 1:
             real_ev.extend(('mot_1', 'mot_2', 'mot_3',
@@ -1015,10 +1223,9 @@ class FSLtoNIDMExporter(NIDMExporter, object):
             variance_spatial = SPATIALLY_LOCAL
             dependance_spatial = SPATIALLY_REGUL
         else:
-            m = re.search(r"set fmri\(mixed_yn\) (?P<mixed>\d)",
-                          self.design_txt)
-            assert m is not None
-            variance_homo = (int(m.group("mixed")) == 0)
+            mixed = self.fsf.get('fmri(mixed_yn)')
+            assert mixed is not None
+            variance_homo = (int(mixed) == 0)
             dependance = NIDM_INDEPEDENT_ERROR
             variance_spatial = SPATIALLY_LOCAL
             dependance_spatial = None
@@ -1038,33 +1245,12 @@ class FSLtoNIDMExporter(NIDMExporter, object):
         Parse FSL result directory to retreive information about the residual
         mean squares map. Return an object of type ResidualMeanSquares.
         """
-        stat_dir = os.path.join(analysis_dir, 'stats')
-
-        if self.first_level:
-            residuals_file = os.path.join(stat_dir, 'sigmasquareds.nii.gz')
-            temporary = False
-        else:
-            sigma2_group_file = os.path.join(stat_dir,
-                                             'mean_random_effects_var1.nii.gz')
-            sigma2_sub_file = os.path.join(stat_dir,
-                                           'varcope1.nii.gz')
-            # Create residual mean squares map
-            sigma2_group_img = nib.load(sigma2_group_file)
-            sigma2_group = sigma2_group_img.get_data()
-
-            sigma2_sub_img = nib.load(sigma2_sub_file)
-            sigma2_sub = sigma2_sub_img.get_data()
-
-            residuals_file = os.path.join(stat_dir,
-                                          'calculated_sigmasquareds.nii.gz')
-            temporary = True
-            residuals_img = nib.Nifti1Image(sigma2_group + sigma2_sub,
-                                            sigma2_sub_img.get_qform())
-            nib.save(residuals_img, residuals_file)
+        # For group analyses the map was computed by extract_analysis
+        residuals_file = self.analysis_contexts[analysis_dir].residuals_file
+        temporary = not self.first_level
 
         # In FSL all files will be in the same coordinate space
-        self.coord_space = CoordinateSpace(self._get_coordinate_system(),
-                                           residuals_file)
+        self.coord_space = self._get_coordinate_space(residuals_file)
 
         rms_map = ResidualMeanSquares(residuals_file,
                                       self.coord_space, temporary,
@@ -1082,7 +1268,7 @@ class FSLtoNIDMExporter(NIDMExporter, object):
 
         for filename in os.listdir(stat_dir):
             if filename.startswith("pe"):
-                if filename.endswith(".nii.gz"):
+                if split_image_ext(filename)[1]:
                     s = re.compile('pe\d+')
                     penum = s.search(filename)
                     penum = penum.group()
@@ -1103,7 +1289,7 @@ class FSLtoNIDMExporter(NIDMExporter, object):
         created as part of Model Parameters Estimation. Return an object of
         type MaskMap.
         """
-        mask_file = os.path.join(analysis_dir, 'mask.nii.gz')
+        mask_file = image_file(os.path.join(analysis_dir, 'mask'))
         mask_map = MaskMap(mask_file,
                            coord_space=self.coord_space,
                            user_defined=False,
@@ -1115,31 +1301,48 @@ class FSLtoNIDMExporter(NIDMExporter, object):
         Parse FSL result directory to retreive information about the grand
         mean map. Return an object of type GrandMeanMap.
         """
-        grand_mean_file = os.path.join(analysis_dir, 'mean_func.nii.gz')
+        grand_mean_file = image_file(os.path.join(analysis_dir, 'mean_func'))
 
         if not os.path.isfile(grand_mean_file):
             raise Exception("Grand mean file " + grand_mean_file +
                             " not found.")
         else:
-            grand_mean = GrandMeanMap(grand_mean_file, mask_file,
-                                      self.coord_space,
-                                      self.analyses_num[analysis_dir])
+            grand_mean = GrandMeanMap(
+                grand_mean_file, mask_file, self.coord_space,
+                self.analyses_num[analysis_dir],
+                masked_median=self.analysis_contexts[
+                    analysis_dir].grand_mean_median)
 
         return grand_mean
 
+    def _get_coordinate_space(self, nifti_file):
+        """
+        Return an object of type CoordinateSpace describing the space of image
+        'nifti_file' (only the image header is read).
+        """
+        geometry = read_geometry(nifti_file)
+        numdim = len(geometry.shape)
+
+        coord_space = CoordinateSpace(
+            self._get_coordinate_system(),
+            vox_to_world=np.array(geometry.qform),
+            vox_size=geometry.pixdim[1:(numdim + 1)].copy(),
+            dimensions=np.asarray(geometry.shape),
+            numdim=numdim,
+            units=["mm", "mm", "mm"])
+
+        return coord_space
+
     def _get_coordinate_system(self):
         """
         Parse FSL result directory to retreive information about the
         coordinate system used in the current analysis (dependent on the
         template).
         """
-        space_re = r'.*set fmri\(regstandard_yn\) (?P<info>[\d]+).*'
-        standard_space = bool(self._search_in_fsf(space_re))
+        standard_space = bool(self.fsf.raw('fmri(regstandard_yn)'))
 
         if standard_space:
-            custom_re = \
-                r'.*set fmri\(alternateReference_yn\) (?P<info>[\d]+).*'
-            custom_space = self._search_in_fsf(custom_re, True)
+            custom_space = self.fsf.raw('fmri(alternateReference_yn)')
             if custom_space is not None:
                 custom_space = (custom_space == "1")
             else:
@@ -1148,8 +1351,7 @@ class FSLtoNIDMExporter(NIDMExporter, object):
             if custom_space is not None:
                 custom_standard = (custom_space == "1")
             else:
-                custom_re = r'.*set fmri\(regstandard\) (?P<info>.+).*'
-                custom_space = self._search_in_fsf(custom_re)
+                custom_space = self.fsf.raw('fmri(regstandard)')
 
                 if custom_space is not None:
                     custom_standard = True
@@ -1168,196 +1370,35 @@ class FSLtoNIDMExporter(NIDMExporter, object):
 
         return coordinate_system
 
-    def _search_in_fsf(self, regexp, return_not_found=False):
-        """
-        Look for information matching regular expression 'regexp' in the design
-        file of the current study.
-        """
-        info_search = re.compile(regexp)
-        info_found = info_search.search(self.design_txt)
-        if not info_found and return_not_found:
-            info = None
-        else:
-            info = info_found.group('info')
-        return info
-
-    def _get_num_peaks(self, feat_post_log):
-        if feat_post_log is not None:
-            num_peak_search = re.compile(r'.* --num=(?P<numpeak>\d+)+ .*')
-            num_peak_found = num_peak_search.search(feat_post_log)
-            if num_peak_found:
-                num_peak = int(num_peak_found.group('numpeak'))
-            else:
-                num_peak_search = re.compile(r'.* -n=(?P<numpeak>\d+)+ .*')
-                num_peak_found = num_peak_search.search(feat_post_log)
-                if num_peak_found:
-                    num_peak = int(num_peak_found.group('numpeak'))
-                else:
-                    # If not specified, default value is inf?
-                    # (cf. http://fsl.fmrib.ox.ac.uk/fsl/fslwiki/Cluster)
-                    # Is it ok to say no limit with -1 (as for Inf
-                    # we would need float...)
-                    # FIXME: for now omitted if not explicitely defined
-                    num_peak = None
-        else:
-            num_peak = None
-        return num_peak
-
-    def _get_peak_dist(self, feat_post_log):
-        if feat_post_log is not None:
-            peak_dist_search = re.compile(
-                r'.* --peakdist=(?P<peakdist>\d+)+ .*')
-            peak_dist_found = peak_dist_search.search(feat_post_log)
-            if peak_dist_found:
-                peak_dist = float(peak_dist_found.group('peakdist'))
-            else:
-                # If not specified, default value is zero (cf.
-                # http://fsl.fmrib.ox.ac.uk/fsl/fslwiki/Cluster)
-                peak_dist = 0.0
-        else:
-            peak_dist = 0.0
-
-        return peak_dist
-
-    def _get_connectivity(self, feat_post_log):
+    def _get_contrast_weights(self, con_num):
         """
-        Parse FSL result directory to retreive peak connectivity within a
-        cluster.
+        Return the weights of T contrast 'con_num' as strings holding the
+        integer part of the values found in the design file.
         """
-        # Default connectivity in FSL (26)
-        connectivity = 26
-
-        if feat_post_log is not None:
-            conn_re = r'cluster.* --connectivity=(?P<connectivity>\d+)+ .*'
-            connectivity_search = re.compile(conn_re)
-            conn_in_log = connectivity_search.search(feat_post_log)
-            if conn_in_log is not None:
-                connectivity = int(conn_in_log.group('connectivity'))
-
-        return connectivity
-
-    # Given a text file containing a table and a string, this function finds
-    # the indices of all columns whose headers contain the string. If a single
-    # character is entered, e.g. 'P', 'x', etc, this function will look for an
-    # exact match to the string.
-    def _get_column_indices(self, tableFile, colHeadStr):
-
-        with open(tableFile) as f:
-            header = f.readline().split('\t')
-
-        if len(colHeadStr) > 1:
-            return([i for i, s in enumerate(header) if colHeadStr in s])
-        else:
-            return([i for i, s in enumerate(header) if s == colHeadStr])
+        weights = list()
+        for weight in self.fsf.vector(
+                'fmri(con_real' + str(con_num) + '.*)', raw=True):
+            m = re.match(r'-?\d+', weight)
+            if m is not None:
+                weights.append(m.group())
+        return weights
 
     def _get_search_space(self, analysis_dir):
         """
         Parse FSL result directory to retreive information about the search
         space. Return an object of type SearchSpace.
         """
-        # FIXME this needs to be estimated
-        search_space_file = os.path.join(analysis_dir, 'mask.nii.gz')
-
-        smoothness_file = os.path.join(analysis_dir, 'stats', 'smoothness')
-
-        # Load DLH, VOLUME, RESELS and noise FWHM
-        with open(smoothness_file, "r") as fp:
-            smoothness_txt = fp.read()
-
-        sm_reg = \
-            r"FWHMx = (?P<FWHMx_vx>\d+\.?\d*) voxels, " + \
-            r"FWHMy = (?P<FWHMy_vx>\d+\.?\d*) voxels, " + \
-            r"FWHMz = (?P<FWHMz_vx>\d+\.?\d*) voxels\n" + \
-            r"FWHMx = (?P<FWHMx_mm>\d+\.?\d*) mm, " + \
-            r"FWHMy = (?P<FWHMy_mm>\d+\.?\d*) mm, " + \
-            r"FWHMz = (?P<FWHMz_mm>\d+\.?\d*) mm\n" + \
-            r"DLH (?P<DLH>\d+\.?\d*) voxels\^\-3\n" + \
-            r"VOLUME (?P<volume>\d+) voxels\n" + \
-            r"RESELS (?P<vox_per_resels>\d+\.?\d*) voxels per resel"
-
-        sm_match = re.search(sm_reg, smoothness_txt, re.DOTALL)
-
-        if sm_match:
-            d = sm_match.groupdict()
-        else:
-            # smoothness was estimated without the "-V" option, recompute
-            if self.first_level:
-                log_file = os.path.join(analysis_dir, 'logs', 'feat3_stats')
-
-                if not os.path.isfile(log_file):
-                    log_file = os.path.join(
-                        self.feat_dir, 'logs', 'feat3_film')
-            else:
-                log_file = os.path.join(analysis_dir, 'logs', 'feat3c_flame')
-
-            if not os.path.isfile(log_file):
-                warnings.warn(
-                    "Log file feat3_stats/feat3_film not found, " +
-                    "noise FWHM will not be reported")
-                noise_fwhm_in_voxels = None
-                noise_fwhm_in_units = None
-
-                # Load DLH, VOLUME and RESELS
-                d = dict()
-                d['DLH'], d['volume'], d['vox_per_resels'] = \
-                    np.loadtxt(smoothness_file, usecols=[1])
-            else:
-                with open(log_file, "r") as fp:
-                    log_txt = fp.read()
-
-                if self.fsl_path is not None:
-                    cmd_match = re.search(r"(?P<cmd>smoothest.*)\n", log_txt)
-                    cmd = cmd_match.group("cmd")
-                    cmd = cmd.replace("stats/smoothness", "stats/smoothness_v")
-                    cmd = cmd.replace(
-                        "smoothest",
-                        os.path.join(self.fsl_path,
-                                     "bin", "smoothest") + " -V")
-
-                    # Discard stdout
-                    FNULL = open(os.devnull, 'w')
-                    subprocess.check_call(
-                        "cd "+analysis_dir+";"+cmd, shell=True,
-                        stdout=FNULL, stderr=subprocess.STDOUT)
-                    with open(smoothness_file+"_v", "r") as fp:
-                        smoothness_txt = fp.read()
-
-                    sm_match = re.search(sm_reg, smoothness_txt, re.DOTALL)
-                    d = sm_match.groupdict()
-                else:
-                    warnings.warn(
-                        "'smoothest' command (from FSL) not found, " +
-                        "noise FWHM will not be reported")
-                    noise_fwhm_in_voxels = None
-                    noise_fwhm_in_units = None
-
-                    # Load DLH, VOLUME and RESELS
-                    d = dict()
-                    d['DLH'], d['volume'], d['vox_per_resels'] = \
-                        np.loadtxt(smoothness_file, usecols=[1])
-
-        vol_in_units = float(d['volume'])*np.prod(self.coord_space.voxel_size)
-        vol_in_resels = float(d['volume'])/float(d['vox_per_resels'])
-
-        if 'FWHMx_vx' in d:
-            noise_fwhm_in_voxels = json.dumps(
-                [float(d['FWHMx_vx']), float(d['FWHMy_vx']),
-                 float(d['FWHMz_vx'])])
-            noise_fwhm_in_units = json.dumps(
-                [float(d['FWHMx_mm']), float(d['FWHMy_mm']),
-                 float(d['FWHMz_mm'])])
+        # The search space is estimated once per analysis directory but each
+        # inference is given its own SearchSpace entity
+        search_space = self.analysis_contexts[analysis_dir].search_space
+        vol_in_units = search_space['vol_in_voxels'] *\
+            np.prod(self.coord_space.voxel_size)
 
         search_space = SearchSpace(
-            search_space_file=search_space_file,
-            vol_in_voxels=int(d['volume']),
             vol_in_units=vol_in_units,
-            vol_in_resels=vol_in_resels,
-            resel_size_in_voxels=float(d['vox_per_resels']),
             random_field_stationarity=True,
-            noise_fwhm_in_voxels=noise_fwhm_in_voxels,
-            noise_fwhm_in_units=noise_fwhm_in_units,
             coord_space=self.coord_space,
-            noise_roughness=float(d['DLH']),)
+            **search_space)
 
         return search_space
 
@@ -1365,11 +1406,9 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                             max_stat_num):
         """
         Parse FSL result directory to retreive information about the clusters
-        and peaks declared significant for statistic 'stat_num'. Return a list
-        of Cluster objects.
+        and peaks declared significant for statistic 'stat_num'. Return a
+        ClusterList (the Cluster objects are created when accessed).
         """
-        clusters = list()
-
         if stat_type.lower() == "f":
             prefix = 'zfstat'
         else:
@@ -1380,15 +1419,12 @@ class FSLtoNIDMExporter(NIDMExporter, object):
             analysis_dir, 'cluster_' + prefix + str(stat_num) + '.txt')
 
         if not os.path.isfile(cluster_vox_file):
-            cluster_vox_file = None
+            cluster_vox = None
         else:
-            with warnings.catch_warnings():
-                # Ignore "Empty input file" for no significant cluster
-                warnings.simplefilter("ignore")
-                cluster_table = np.loadtxt(
-                    cluster_vox_file, skiprows=1, ndmin=2)
+            cluster_vox = self._read_table(cluster_vox_file)
 
         # Cluster list (positions in mm)
+        cluster_mm = None
         if not self.first_level:
             cluster_mm_file = os.path.join(
                 analysis_dir, 'cluster_' + prefix + str(stat_num) + '_std.txt')
@@ -1402,8 +1438,6 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                 with open(log_file, "r") as fp:
                     log_txt = fp.read()
 
-                cmd = os.path.join(self.fsl_path, "bin", "cluster")
-
                 cluster_name = "cluster_" + prefix + str(stat_num) + ".txt"
 
                 cmd_match = re.search(
@@ -1411,26 +1445,24 @@ class FSLtoNIDMExporter(NIDMExporter, object):
 
                 if cmd_match:
 
-                    # Read in filtered functional image to get header.
-                    filterfunc = os.path.join(analysis_dir,
-                                              "filtered_func_data.nii.gz")
-                    filterfunc_img = nib.load(filterfunc)
+                    # Read in filtered functional image header.
+                    filterfunc = image_file(os.path.join(
+                        analysis_dir, "filtered_func_data"))
 
                     # Get transformation matrix from voxels to subject mm from
                     # the header.
-                    voxToWorld = filterfunc_img.affine
+                    voxToWorld = read_geometry(filterfunc).affine
 
-                    # Read in cluster file as table and make new header.
+                    # Read in cluster file as table (the table in mm has the
+                    # same columns).
                     cluster_file = os.path.join(analysis_dir, cluster_name)
-                    clus_tab = np.loadtxt(cluster_file, skiprows=1)
-                    with open(cluster_file) as f:
-                        tab_hdr = f.readline().replace('(vox)', '(mm)')
+                    cluster_tab = self._read_table(cluster_file)
+                    clus_tab = cluster_tab.data.copy()
 
                     # Look for Z-MAX, Z-COG and COPE-MAX xyz coordinates.
-                    xcol_zm = self._get_column_indices(cluster_file, 'Z-MAX X')
-                    xcol_zc = self._get_column_indices(cluster_file, 'Z-COG X')
-                    xcol_cm = self._get_column_indices(cluster_file,
-                                                       'COPE-MAX X')
+                    xcol_zm = cluster_tab.indices('Z-MAX X')
+                    xcol_zc = cluster_tab.indices('Z-COG X')
+                    xcol_cm = cluster_tab.indices('COPE-MAX X')
 
                     # Transform coordinates from voxels to subject mm,
                     # checking whether each column is present first,
@@ -1443,56 +1475,23 @@ class FSLtoNIDMExporter(NIDMExporter, object):
 
                     if xcol_zc:
                         ind = xcol_zc[0]
-                        clus_tab[:, ind:(ind+3)] = [[float(
-                            '%.3g' % j) for j in i] for i in apply_affine(
-                                voxToWorld, clus_tab[:, ind:(ind+3)])]
+                        clus_tab[:, ind:(ind+3)] = np.char.mod(
+                            '%.3g', apply_affine(
+                                voxToWorld, clus_tab[:, ind:(ind+3)])
+                        ).astype(float).reshape(-1, 3)
 
                     if xcol_cm:
                         ind = xcol_cm[0]
                         clus_tab[:, ind:(ind+3)] = apply_affine(
                             voxToWorld, clus_tab[:, ind:(ind+3)])
 
-                    # Work out the header format.
-                    hdrfmt = ''
-                    for colhdr in tab_hdr.split('\t'):
-
-                        # These columns should be displayed as ints.
-                        if (('Cluster Index' in colhdr) or (
-                                'Z-MAX' in colhdr) or (
-                                    'COPE' in colhdr) or (
-                                        'Voxels' in colhdr)):
-
-                            if not ((colhdr == 'Z-MAX') or
-                                    (colhdr == 'Z-MAX ')):
+                    cluster_mm = FSLTable(cluster_tab.header, clus_tab)
 
-                                hdrfmt = hdrfmt + '%i '
-
-                            else:
-
-                                hdrfmt = hdrfmt + '%3g '
-
-                        # These should be displayed to 3sf.
-                        if 'log10' in colhdr:
-
-                            hdrfmt = hdrfmt + '%3g '
-
-                        # These have already been formatted and should
-                        # be displayed as they are.
-                        if 'Z-COG' in colhdr:
-
-                            hdrfmt = hdrfmt + '%s '
-
-                        # P values are given to 2 places.
-                        if (colhdr == 'P') or (colhdr == 'P '):
-
-                            hdrfmt = hdrfmt + '%.2e '
-
-                    # Write into a new file.
-                    cluster_mm_file = os.path.join(analysis_dir, 'cluster_' +
-                                                   prefix + str(stat_num) +
-                                                   '_sub.txt')
-                    np.savetxt(cluster_mm_file, clus_tab, header=tab_hdr,
-                               comments='', fmt=hdrfmt)
+                    if self.write_sub_tables:
+                        self._write_cluster_sub_table(
+                            cluster_tab.header, clus_tab, os.path.join(
+                                analysis_dir, 'cluster_' + prefix +
+                                str(stat_num) + '_sub.txt'))
 
                 else:
                     warnings.warn(
@@ -1507,326 +1506,186 @@ class FSLtoNIDMExporter(NIDMExporter, object):
                 analysis_dir, 'cluster_' + prefix + str(stat_num) + '_sub.txt')
             peak_mm_suffix = "_sub"
 
-        if not os.path.isfile(cluster_mm_file):
-            cluster_mm_file = None
-            # cluster_mm_table = np.zeros_like(cluster_table)*float('nan')
-        else:
-            with warnings.catch_warnings():
-                # Ignore "Empty input file" for no significant cluster
-                warnings.simplefilter("ignore")
-                cluster_mm_table = np.loadtxt(
-                    cluster_mm_file, skiprows=1, ndmin=2)
+        if cluster_mm is None and os.path.isfile(cluster_mm_file):
+            cluster_mm = self._read_table(cluster_mm_file)
 
         # Peaks
         peak_file_vox = os.path.join(
             analysis_dir, 'lmax_' + prefix + str(stat_num) + '.txt')
         if not os.path.isfile(peak_file_vox):
-            peak_file_vox = None
+            peak_vox = None
         else:
-            with warnings.catch_warnings():
-                # Ignore "Empty input file" for no significant peak
-                warnings.simplefilter("ignore")
-                peak_table = np.loadtxt(peak_file_vox, skiprows=1, ndmin=2)
+            peak_vox = self._read_table(peak_file_vox)
 
+        # Peak list (positions in mm)
+        peak_mm = None
         peak_file_mm = os.path.join(
             analysis_dir,
             'lmax_' + prefix + str(stat_num) + peak_mm_suffix + '.txt')
 
         if not os.path.isfile(peak_file_mm):
 
-            # Check if this is first level
-            if not self.first_level:
-
-                peak_file_mm = None
-
-            else:
-
-                # If in first level we recreate the peak_sub file if we can.
-                if peak_file_vox is not None:
+            # In first level we compute the positions in subject mm if we can.
+            if self.first_level and peak_vox is not None:
 
-                    # Read in filtered functional image to get header.
-                    filterfunc = os.path.join(analysis_dir,
-                                              "filtered_func_data.nii.gz")
-                    filterfunc_img = nib.load(filterfunc)
+                # Read in filtered functional image header.
+                filterfunc = image_file(os.path.join(
+                    analysis_dir, "filtered_func_data"))
 
-                    # Get transformation matrix from voxels to subject mm from
-                    # the header.
-                    voxToWorld = filterfunc_img.affine
+                # Get transformation matrix from voxels to subject mm from
+                # the header.
+                voxToWorld = read_geometry(filterfunc).affine
 
-                    # Read in peak file as table and save header.
-                    peak_tab = np.loadtxt(peak_file_vox, skiprows=1)
-                    with open(peak_file_vox) as f:
-                        tab_hdr = f.readline().replace('(vox)', '(mm)')
+                # The table in mm has the same columns as the table in voxels.
+                peak_tab = peak_vox.data.copy()
 
-                    # Find out which columns are the coordinates.
-                    x_col = self._get_column_indices(peak_file_vox, 'x')[0]
+                # Find out which columns are the coordinates.
+                x_col = peak_vox.indices('x')[0]
 
-                    # Transform coordinates from voxels to subject mm.
-                    peak_tab[:, x_col:x_col+3] = apply_affine(
-                        voxToWorld, peak_tab[:, x_col:x_col+3])
+                # Transform coordinates from voxels to subject mm.
+                peak_tab[:, x_col:x_col+3] = apply_affine(
+                    voxToWorld, peak_tab[:, x_col:x_col+3])
 
-                    # Write into a new file.
+                if self.write_sub_tables:
+                    tab_hdr = '\t'.join(peak_vox.header).replace(
+                        '(vox)', '(mm)')
                     np.savetxt(peak_file_mm, peak_tab, header=tab_hdr,
                                comments='', fmt='%i %.2e %3f %3f %3f')
 
-                    peak_mm_table = peak_tab
-
-                else:
-
-                    peak_file_mm = None
+                peak_mm = FSLTable(peak_vox.header, peak_tab)
 
         else:
-            with warnings.catch_warnings():
-                # Ignore "Empty input file" for no significant peak
-                warnings.simplefilter("ignore")
-                peak_mm_table = np.loadtxt(
-                    peak_file_mm, skiprows=1, ndmin=2)
-
-        peaks = dict()
-        prev_cluster = -1
-
-        if (peak_file_vox is not None) and (peak_file_mm is not None):
-
-            peaks_join_table = np.column_stack(
-                (peak_table, peak_mm_table))
-
-            # Find out which columns are the coordinates.
-            x_col = self._get_column_indices(peak_file_vox, 'x')[0]
-            x_col_std = np.shape(peak_table)[1] + \
-                self._get_column_indices(peak_file_mm, 'x')[0]
-
-            # Find out which column is equivalent Z.
-            ez_col = self._get_column_indices(peak_file_vox, 'Z')[0]
-
-            # Find out which column is cluster index.
-            ci_col = self._get_column_indices(peak_file_vox,
-                                              'Cluster Index')[0]
-
-            num_clusters = peaks_join_table.max(axis=0)[0]
-            max_num_peaks = peaks_join_table.shape[0]
-
-            for peak_row in peaks_join_table:
-                cluster_id = int(peak_row[ci_col])
-
-                if not cluster_id == prev_cluster:
-                    # First peak in this cluster
-                    peakIndex = 1
-
-                # Though peak coordinates in voxels are integer, we use a
-                # float type to comply with the rdfs:range
-                suffix = self._get_peak_suffix(analysis_dir, stat_type,
-                                               stat_num, cluster_id, peakIndex,
-                                               num_clusters, max_num_peaks,
-                                               max_stat_num)
-
-                peak = Peak(
-                    x=int(peak_row[x_col]), y=int(peak_row[x_col+1]),
-                    z=int(peak_row[x_col+2]), x_std=peak_row[x_col_std],
-                    y_std=peak_row[x_col_std+1], z_std=peak_row[x_col_std+2],
-                    equiv_z=float(peak_row[ez_col]), suffix=suffix)
-                if cluster_id in peaks:
-                    peaks[cluster_id].append(peak)
-                else:
-                    peaks[cluster_id] = list([peak])
-
-                prev_cluster = cluster_id
-
-                peakIndex = peakIndex + 1
-        elif (peak_file_vox is not None):
-            num_clusters = peak_table.max(axis=0)[0]
-            max_num_peaks = peak_table.shape[0]
-
-            # Find out which columns are the coordinates.
-            x_col = self._get_column_indices(peak_file_vox, 'x')[0]
-
-            # Find out which column is equivalent Z.
-            ez_col = self._get_column_indices(peak_file_vox, 'Z')[0]
-
-            # Find out which column is cluster index.
-            ci_col = self._get_column_indices(peak_file_vox,
-                                              'Cluster Index')[0]
-
-            for peak_row in peak_table:
-                cluster_id = int(peak_row[ci_col])
-
-                if not cluster_id == prev_cluster:
-                    peakIndex = 1
-
-                suffix = self._get_peak_suffix(analysis_dir, stat_type,
-                                               stat_num, cluster_id, peakIndex,
-                                               num_clusters, max_num_peaks,
-                                               max_stat_num)
-                peak = Peak(
-                    x=int(peak_row[x_col]), y=int(peak_row[x_col+1]),
-                    z=int(peak_row[x_col+2]), equiv_z=float(peak_row[ez_col]),
-                    suffix=suffix)
-                if cluster_id in peaks:
-                    peaks[cluster_id].append(peak)
-                else:
-                    peaks[cluster_id] = list([peak])
-
-                prev_cluster = cluster_id
-
-                peakIndex = peakIndex + 1
-        elif (peak_file_mm is not None) and (peak_mm_table.size > 0):
-            num_clusters = peak_mm_table.max(axis=0)[0]
-            max_num_peaks = peak_mm_table.shape[0]
-
-            # Find out which columns are the coordinates.
-            x_col_std = self._get_column_indices(peak_file_mm, 'x')[0]
-
-            # Find out which column is equivalent Z.
-            ez_col = self._get_column_indices(peak_file_mm, 'Z')[0]
-
-            # Find out which column is cluster index.
-            ci_col = self._get_column_indices(peak_file_mm, 'Cluster Index')[0]
-
-            for peak_row in peak_mm_table:
-                cluster_id = int(peak_row[ci_col])
-
-                if not cluster_id == prev_cluster:
-                    peakIndex = 1
-
-                suffix = self._get_peak_suffix(analysis_dir, stat_type,
-                                               stat_num, cluster_id, peakIndex,
-                                               num_clusters, max_num_peaks,
-                                               max_stat_num)
-                peak = Peak(
-                    x_std=peak_row[x_col_std], y_std=peak_row[x_col_std+1],
-                    z_std=peak_row[x_col_std+2],
-                    equiv_z=float(peak_row[ez_col]), suffix=suffix)
-                if cluster_id in peaks:
-                    peaks[cluster_id].append(peak)
-                else:
-                    peaks[cluster_id] = list([peak])
-                prev_cluster = cluster_id
-
-                peakIndex = peakIndex + 1
-
-        if (cluster_vox_file is not None) and (cluster_mm_file is not None):
-            clusters_join_table = np.column_stack((cluster_table,
-                                                   cluster_mm_table))
-
-            # Find out which columns have the coordinates.
-            xyzcols = self._get_column_indices(cluster_vox_file, 'Z-COG ')
-            xyzcols_std = [cluster_table.shape[1] + i for i in
-                           self._get_column_indices(cluster_mm_file, 'Z-COG ')]
-
+            peak_mm = self._read_table(peak_file_mm)
+
+        # An empty peak table (no significant cluster) gives no peak
+        if (peak_vox is not None) and (peak_vox.data.size == 0):
+            peak_vox = None
+        if (peak_mm is not None) and (peak_mm.data.size == 0):
+            peak_mm = None
+
+        peaks = None
+        peak_table = peak_vox if peak_vox is not None else peak_mm
+
+        if peak_table is not None:
+            num_peaks = len(peak_table)
+
+            # Cluster index of each peak and index of each peak in its cluster
+            # (the peaks of a cluster are listed consecutively)
+            cluster_ids = peak_table.data[
+                :, peak_table.indices('Cluster Index')[0]].astype(int)
+            first_peaks = np.concatenate(
+                ([True], cluster_ids[1:] != cluster_ids[:-1]))
+            peak_ids = np.arange(num_peaks) - np.maximum.accumulate(
+                np.where(first_peaks, np.arange(num_peaks), 0)) + 1
+
+            suffixes = self._get_peak_suffixes(
+                analysis_dir, stat_type, stat_num, cluster_ids, peak_ids,
+                peak_table.data.max(axis=0)[0], num_peaks, max_stat_num)
+
+            # Positions in voxels (integers) and in mm
+            coords = None
+            if peak_vox is not None:
+                x_col = peak_vox.indices('x')[0]
+                coords = peak_vox.data[:, x_col:x_col+3]
+
+            coords_std = None
+            if peak_mm is not None:
+                x_col_std = peak_mm.indices('x')[0]
+                coords_std = peak_mm.data[:, x_col_std:x_col_std+3]
+
+            peaks = PeakList(
+                cluster_ids, suffixes,
+                peak_table.data[:, peak_table.indices('Z')[0]],
+                coords, coords_std)
+
+        cluster_table = cluster_vox if cluster_vox is not None else cluster_mm
+
+        if cluster_table is not None:
             # Find out which columns has the p values.
-            pcol = self._get_column_indices(cluster_vox_file, 'P')
-
-            # Find out which column is cluster index.
-            ci_col = self._get_column_indices(cluster_vox_file,
-                                              'Cluster Index')[0]
-
-            # Find out which column is cluster size.
-            s_col = self._get_column_indices(cluster_vox_file, 'Voxels')[0]
-
-            for cluster_row in clusters_join_table:
-
-                cluster_id = int(cluster_row[ci_col])
-                size = int(cluster_row[s_col])
-
-                if pcol:
-                    pFWER = float(cluster_row[pcol[0]])
-                else:
-                    pFWER = None
-
-                x = float(cluster_row[xyzcols[0]])
-                y = float(cluster_row[xyzcols[1]])
-                z = float(cluster_row[xyzcols[2]])
-                x_std = float(cluster_row[xyzcols_std[0]])
-                y_std = float(cluster_row[xyzcols_std[1]])
-                z_std = float(cluster_row[xyzcols_std[2]])
-                clusters.append(
-                    Cluster(cluster_num=cluster_id, size=size,
-                            pFWER=pFWER, peaks=peaks[
-                                cluster_id], x=x, y=y, z=z,
-                            x_std=x_std, y_std=y_std, z_std=z_std))
+            pcol = cluster_table.indices('P')
+            p_fwers = None
+            if pcol:
+                p_fwers = cluster_table.data[:, pcol[0]]
+
+            # Centres of gravity in voxels and in mm
+            cogs = None
+            if cluster_vox is not None:
+                cogs = cluster_vox.data[:, cluster_vox.indices('Z-COG ')[:3]]
+
+            cogs_std = None
+            if cluster_mm is not None:
+                cogs_std = cluster_mm.data[
+                    :, cluster_mm.indices('Z-COG ')[:3]]
+
+            clusters = ClusterList(
+                cluster_table.data[
+                    :, cluster_table.indices('Cluster Index')[0]],
+                cluster_table.data[:, cluster_table.indices('Voxels')[0]],
+                peaks, p_fwers, cogs, cogs_std)
+        else:
+            clusters = None
 
-        elif (cluster_vox_file is not None):
+        return clusters
 
-            # Find out which columns have the coordinates.
-            xyzcols = self._get_column_indices(cluster_vox_file, 'Z-COG ')
+    def _write_cluster_sub_table(self, header, clus_tab, cluster_mm_file):
+        """
+        Write 'clus_tab', a table of clusters with positions in subject-space
+        mm (and columns 'header'), in 'cluster_mm_file'.
+        """
+        tab_hdr = '\t'.join(header).replace('(vox)', '(mm)')
 
-            # Find out which columns has the p values.
-            pcol = self._get_column_indices(cluster_vox_file, 'P')
+        # Work out the header format.
+        hdrfmt = ''
+        for colhdr in tab_hdr.split('\t'):
 
-            # Find out which column is cluster index.
-            ci_col = self._get_column_indices(cluster_vox_file,
-                                              'Cluster Index')[0]
+            # These columns should be displayed as ints.
+            if (('Cluster Index' in colhdr) or ('Z-MAX' in colhdr) or (
+                    'COPE' in colhdr) or ('Voxels' in colhdr)):
 
-            # Find out which column is cluster size.
-            s_col = self._get_column_indices(cluster_vox_file, 'Voxels')[0]
+                if not ((colhdr == 'Z-MAX') or (colhdr == 'Z-MAX ')):
 
-            for cluster_row in cluster_table:
-                cluster_id = int(cluster_row[ci_col])
-                size = int(cluster_row[s_col])
+                    hdrfmt = hdrfmt + '%i '
 
-                if pcol:
-                    pFWER = float(cluster_row[pcol[0]])
                 else:
-                    pFWER = None
-
-                x = float(cluster_row[xyzcols[0]])
-                y = float(cluster_row[xyzcols[1]])
-                z = float(cluster_row[xyzcols[2]])
-                x_std = None
-                y_std = None
-                z_std = None
-                clusters.append(
-                    Cluster(cluster_num=cluster_id, size=size,
-                            pFWER=pFWER, peaks=peaks[
-                                cluster_id], x=x, y=y, z=z,
-                            x_std=x_std, y_std=y_std, z_std=z_std))
-        elif (cluster_mm_file is not None):
 
-            # Find out which columns has the p values.
-            pcol = self._get_column_indices(cluster_mm_file, 'P')
+                    hdrfmt = hdrfmt + '%3g '
 
-            # Find out which columns have the coordinates.
-            xyzcols_std = self._get_column_indices(cluster_mm_file,
-                                                   'Z-COG ')
+            # These should be displayed to 3sf.
+            if 'log10' in colhdr:
 
-            # Find out which column is cluster index.
-            ci_col = self._get_column_indices(cluster_mm_file,
-                                              'Cluster Index')[0]
+                hdrfmt = hdrfmt + '%3g '
 
-            # Find out which column is cluster size.
-            s_col = self._get_column_indices(cluster_mm_file, 'Voxels')[0]
+            # These have already been formatted and should be displayed as
+            # they are.
+            if 'Z-COG' in colhdr:
 
-            for cluster_row in cluster_mm_table:
+                hdrfmt = hdrfmt + '%s '
 
-                cluster_id = int(cluster_row[ci_col])
-                size = int(cluster_row[s_col])
+            # P values are given to 2 places.
+            if (colhdr == 'P') or (colhdr == 'P '):
 
-                if pcol:
-                    pFWER = float(cluster_row[pcol[0]])
-                else:
-                    pFWER = None
-
-                x_std = float(cluster_row[xyzcols_std[0]])
-                y_std = float(cluster_row[xyzcols_std[1]])
-                z_std = float(cluster_row[xyzcols_std[2]])
-                x = None
-                y = None
-                z = None
-
-                clusters.append(
-                    Cluster(cluster_num=cluster_id, size=size,
-                            pFWER=pFWER, peaks=peaks[
-                                cluster_id], x=x, y=y, z=z,
-                            x_std=x_std, y_std=y_std, z_std=z_std))
-        else:
-            clusters = None
+                hdrfmt = hdrfmt + '%.2e '
 
-        return clusters
+        np.savetxt(cluster_mm_file, clus_tab, header=tab_hdr, comments='',
+                   fmt=hdrfmt)
 
-    def _get_peak_suffix(self, analysis_dir, stat_type, con_num,
-                         cluster_idx, peak_idx, num_clusters, num_peaks,
-                         max_stat_num):
-        max_cluster_digits = str(len(str(int(num_clusters))))
-        max_peak_digits = str(len(str(int(num_peaks))))
+    def _read_table(self, path):
+        """
+        Return the FSLTable of the cluster or peak table 'path' (each table
+        is read once per export).
+        """
+        return read_table(path, self._tables)
+
+    def _get_peak_suffixes(self, analysis_dir, stat_type, con_num,
+                           cluster_ids, peak_ids, num_clusters, num_peaks,
+                           max_stat_num):
+        """
+        Return the array of suffixes of the peaks of statistic 'con_num'
+        given the arrays of their cluster indices and of their indices
+        within their cluster.
+        """
+        max_cluster_digits = len(str(int(num_clusters)))
+        max_peak_digits = len(str(int(num_peaks)))
 
         ana_prefix = ""
         if self.analyses_num[analysis_dir]:
@@ -1837,9 +1696,11 @@ class FSLtoNIDMExporter(NIDMExporter, object):
             stat_prefix = stat_type.upper() + \
                 ("{0:0>" + str(max_stat_num) + "}").format(con_num) + "_"
 
-        suffix = ana_prefix + \
-            stat_prefix + \
-            ("{0:0>" + max_cluster_digits + "}").format(cluster_idx) + \
-            ("_{0:0>" + max_peak_digits + "}").format(peak_idx)
+        suffixes = np.char.add(
+            np.char.zfill(np.asarray(cluster_ids).astype(str),
+                          max_cluster_digits),
+            np.char.add(
+                "_", np.char.zfill(np.asarray(peak_ids).astype(str),
+                                   max_peak_digits)))
 
-        return suffix
+        return np.char.add(ana_prefix + stat_prefix, suffixes)
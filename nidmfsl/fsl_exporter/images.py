@@ -0,0 +1,177 @@
+"""
+Access to the NIfTI images created by FSL (in any FSL output type) and to
+their geometry without loading the image data.
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+import os
+import glob
+import shutil
+import collections
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener, Opener
+from nibabel.spatialimages import HeaderDataError
+
+# Extensions of the images written by FSL (FSLOUTPUTTYPE: NIFTI_GZ, NIFTI,
+# NIFTI_PAIR_GZ and NIFTI_PAIR), from the most to the least common
+IMAGE_EXTENSIONS = ('.nii.gz', '.nii', '.hdr.gz', '.hdr')
+
+# Geometry of an image as read from its header
+ImageGeometry = collections.namedtuple(
+    'ImageGeometry', ['shape', 'affine', 'qform', 'zooms', 'pixdim'])
+
+# Cache of image geometries: (path, modification time, size) -> geometry
+_GEOMETRY_CACHE = dict()
+_MAX_CACHED_GEOMETRIES = 4096
+
+
+def _file_key(path):
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    mtime = getattr(stat, 'st_mtime_ns', stat.st_mtime)
+    return (path, mtime, stat.st_size)
+
+
+def _read_header(path):
+    """
+    Read the header of a NIfTI image (only the first bytes of the file are
+    decompressed).
+    """
+    try:
+        with ImageOpener(path) as fobj:
+            return nib.Nifti1Header.from_fileobj(fobj)
+    except HeaderDataError:
+        # Not a NIfTI-1 single file, let nibabel find the header
+        return nib.load(path).header
+
+
+def read_geometry(path):
+    """
+    Return the geometry (shape, affine, qform, zooms and pixdim) of image
+    'path' reading only its header. Geometries are cached per path and
+    modification time.
+    """
+    key = _file_key(path)
+    geometry = _GEOMETRY_CACHE.get(key)
+
+    if geometry is None:
+        header = _read_header(path)
+        geometry = ImageGeometry(
+            shape=tuple(int(d) for d in header.get_data_shape()),
+            affine=header.get_best_affine(),
+            qform=header.get_qform(),
+            zooms=tuple(float(z) for z in header.get_zooms()),
+            pixdim=np.array(header['pixdim']))
+        # Cached arrays are shared between callers
+        for array in (geometry.affine, geometry.qform, geometry.pixdim):
+            array.flags.writeable = False
+
+        if len(_GEOMETRY_CACHE) >= _MAX_CACHED_GEOMETRIES:
+            _GEOMETRY_CACHE.clear()
+        _GEOMETRY_CACHE[key] = geometry
+
+    return geometry
+
+
+def split_image_ext(path):
+    """
+    Return the path of image 'path' without its extension and its extension
+    (the extension is empty if it is not one of IMAGE_EXTENSIONS).
+    """
+    for ext in IMAGE_EXTENSIONS:
+        if path.endswith(ext):
+            return path[:-len(ext)], ext
+    return path, ''
+
+
+def image_file(path):
+    """
+    Return the file of image 'path', given with or without extension (as in
+    FSL): the first file found with an extension of IMAGE_EXTENSIONS, or
+    'path' with the ".nii.gz" extension if there is none.
+    """
+    if split_image_ext(path)[1] and os.path.isfile(path):
+        return path
+    for ext in IMAGE_EXTENSIONS:
+        if os.path.isfile(path + ext):
+            return path + ext
+    return path + IMAGE_EXTENSIONS[0]
+
+
+def image_files(pattern):
+    """
+    Return the image files matching 'pattern' (a glob pattern without
+    extension). An image found with several extensions is only returned
+    once (with the first extension of IMAGE_EXTENSIONS).
+    """
+    files = list()
+    found = set()
+    for ext in IMAGE_EXTENSIONS:
+        for path in glob.glob(pattern + ext):
+            name = split_image_ext(path)[0]
+            if name not in found:
+                found.add(name)
+                files.append(path)
+    return files
+
+
+def load_data(path):
+    """
+    Return the data array of image 'path'. Uncompressed images are
+    memory-mapped (read-only) rather than read in memory.
+    """
+    return np.asanyarray(nib.load(path, mmap='r').dataobj)
+
+
+def _open_image(path, compresslevel=None):
+    """
+    Open image file 'path' for writing, compressing gzipped files at
+    'compresslevel' (by default nibabel's level).
+    """
+    if compresslevel is None:
+        compresslevel = Opener.default_compresslevel
+    return ImageOpener(path, 'wb', compresslevel=compresslevel)
+
+
+def save_image(img, path, compresslevel=None):
+    """
+    Save the NIfTI-1 image 'img' as 'path' (as nib.save), compressing
+    gzipped files at 'compresslevel' (by default nibabel's level).
+    """
+    with _open_image(path, compresslevel) as fid:
+        img.to_file_map(img.make_file_map({'image': fid}))
+
+
+def compress_image(path, new_file, compresslevel=None):
+    """
+    Write image 'path' as the gzipped NIfTI-1 image 'new_file' (at
+    'compresslevel'). NIfTI-1 single files are compressed as they are,
+    image pairs are converted.
+    """
+    if path.endswith('.nii'):
+        with open(path, 'rb') as fid:
+            with _open_image(new_file, compresslevel) as gz_fid:
+                shutil.copyfileobj(fid, gz_fid, 1 << 20)
+    else:
+        save_image(nib.Nifti1Image.from_image(nib.load(path)), new_file,
+                   compresslevel)
+
+
+def save_slabs(path, slabs, shape, dtype, affine, compresslevel=None):
+    """
+    Save the integer NIfTI-1 image 'path' of shape 'shape' and type 'dtype'
+    from 'slabs', the arrays of consecutive slabs along its last axis, as
+    nib.save would but without holding the whole image in memory. Gzipped
+    files are compressed at 'compresslevel'.
+    """
+    header = nib.Nifti1Image(np.zeros((1, 1, 1), dtype=dtype), affine).header
+    header.set_data_shape(shape)
+    header.set_slope_inter(1, 0)
+    with _open_image(path, compresslevel) as fid:
+        header.write_to(fid)
+        fid.write(b'\0' * (int(header.get_data_offset()) - fid.tell()))
+        for slab in slabs:
+            fid.write(np.asarray(slab, dtype=dtype).tobytes(order='F'))
@@ -0,0 +1,124 @@
+"""
+Manifest of the FSL outputs read to create a NIDM-Results export, used to
+skip exports whose inputs did not change.
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+import os
+import glob
+import json
+import fnmatch
+import hashlib
+
+# Suffix of the manifest file written next to a NIDM-Results pack
+MANIFEST_SUFFIX = '.manifest.json'
+
+# Inputs read in each analysis directory (a .feat directory or a cope*.feat
+# directory of a .gfeat), images are matched in any FSL output type
+INPUT_PATTERNS = (
+    'design.fsf', 'design.mat', 'design.png', 'mask.*', 'mean_func.*',
+    'filtered_func_data.*', 'thresh_z*.*', 'rendered_thresh_z*.png',
+    'cluster_z*.txt', 'lmax_z*.txt', os.path.join('stats', '*'),
+    os.path.join('logs', '*'))
+
+# Files written next to the inputs by the exporter itself
+DERIVED_PATTERNS = (
+    'tmp_clustmap*', '*_sub.txt', 'smoothness_v',
+    'calculated_sigmasquareds.nii.gz')
+
+
+def input_files(feat_dir, extra_files=()):
+    """
+    Return the sorted list of inputs of the export of 'feat_dir' (plus
+    'extra_files', e.g. custom onset files).
+    """
+    analysis_dirs = [feat_dir] + \
+        glob.glob(os.path.join(feat_dir, 'cope*.feat'))
+
+    files = set()
+    for analysis_dir in analysis_dirs:
+        for pattern in INPUT_PATTERNS:
+            for path in glob.glob(os.path.join(analysis_dir, pattern)):
+                name = os.path.basename(path)
+                if not os.path.isfile(path) or any(
+                        fnmatch.fnmatch(name, derived)
+                        for derived in DERIVED_PATTERNS):
+                    continue
+                files.add(path)
+
+    files.update(f for f in extra_files if os.path.isfile(f))
+    return sorted(files)
+
+
+def _sha1(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fid:
+        for block in iter(lambda: fid.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def build_manifest(feat_dir, files, options, hashes=False):
+    """
+    Return the manifest of 'files': size and modification time of each file
+    (and SHA-1 if 'hashes' is True), keyed by path relative to 'feat_dir',
+    along with the export 'options' (a dictionary of JSON values).
+    """
+    entries = dict()
+    for path in files:
+        stat = os.stat(path)
+        entry = {'size': stat.st_size,
+                 'mtime': getattr(stat, 'st_mtime_ns', stat.st_mtime)}
+        if hashes:
+            entry['sha1'] = _sha1(path)
+
+        rel_path = os.path.relpath(path, feat_dir)
+        if rel_path.startswith(os.pardir):
+            rel_path = os.path.abspath(path)
+        entries[rel_path] = entry
+
+    # Options are stored as read back from JSON (e.g. tuples as lists)
+    return {'options': json.loads(json.dumps(options)), 'files': entries}
+
+
+def read_manifest(manifest_file):
+    """
+    Return the manifest stored in 'manifest_file' (None if missing or
+    unreadable).
+    """
+    try:
+        with open(manifest_file, 'r') as fid:
+            return json.load(fid)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_manifest(manifest_file, manifest):
+    with open(manifest_file, 'w') as fid:
+        json.dump(manifest, fid, indent=1, sort_keys=True)
+
+
+def manifest_matches(saved, current):
+    """
+    Return True if manifest 'saved' describes the same options and inputs as
+    manifest 'current'. A file whose modification time changed still matches
+    if both manifests have the same SHA-1 for it.
+    """
+    if saved is None or saved.get('options') != current['options']:
+        return False
+
+    saved_files = saved.get('files', dict())
+    if set(saved_files) != set(current['files']):
+        return False
+
+    for path, entry in current['files'].items():
+        saved_entry = saved_files[path]
+        if saved_entry.get('size') != entry['size']:
+            return False
+        if saved_entry.get('mtime') != entry['mtime']:
+            if 'sha1' not in entry or \
+                    saved_entry.get('sha1') != entry['sha1']:
+                return False
+    return True
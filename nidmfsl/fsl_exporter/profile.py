@@ -0,0 +1,161 @@
+"""
+Lightweight profiling of the phases of an export: wall time, CPU time, bytes
+read and written and peak resident memory.
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+import os
+import sys
+import json
+import time
+import functools
+import contextlib
+import collections
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# File reporting the I/O of the current process (Linux only)
+PROC_IO_FILE = '/proc/self/io'
+
+
+def _io_counters():
+    """
+    Return the number of bytes read and written by the current process
+    (including cached I/O), (None, None) if unavailable.
+    """
+    try:
+        with open(PROC_IO_FILE, 'r') as fid:
+            counters = dict(line.split(':') for line in fid)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peak_rss():
+    """
+    Return the peak resident set size of the current process in bytes (None
+    if unavailable).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    else:
+        # In kilobytes on Linux
+        return peak * 1024
+
+
+def _sample():
+    # CPU time includes child processes (e.g. smoothest, pool workers) once
+    # they have been waited for
+    times = os.times()
+    read_bytes, written_bytes = _io_counters()
+    return (time.time(), sum(times[:4]), read_bytes, written_bytes)
+
+
+class Profiler(object):
+    """
+    Accumulate the cost of nested phases. Each phase is identified by its
+    path (names of the enclosing phases and its own name separated by '/'),
+    calls of the same phase are summed.
+    """
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self._stack = list()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager profiling a phase named 'name' (nested in the phase
+        currently running, if any).
+        """
+        self._stack.append(name)
+        path = '/'.join(self._stack)
+        # Phases are reported in the order they are started
+        self.phases.setdefault(path, None)
+        start = _sample()
+        try:
+            yield
+        finally:
+            end = _sample()
+            self._stack.pop()
+
+            if start[2] is None or end[2] is None:
+                read_bytes = written_bytes = None
+            else:
+                read_bytes = end[2] - start[2]
+                written_bytes = end[3] - start[3]
+            self._add(path, {
+                'calls': 1, 'wall': end[0] - start[0],
+                'cpu': end[1] - start[1], 'read_bytes': read_bytes,
+                'written_bytes': written_bytes, 'peak_rss': _peak_rss()})
+
+    def wrap(self, name, function):
+        """
+        Return 'function' profiled as phase 'name'.
+        """
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return profiled
+
+    def merge(self, phases):
+        """
+        Add 'phases' (the 'phases' of another Profiler, e.g. of a worker
+        process) as sub-phases of the phase currently running.
+        """
+        for path, record in phases.items():
+            self._add('/'.join(self._stack + [path]), record)
+
+    def _add(self, path, record):
+        total = self.phases.get(path)
+        if total is None:
+            self.phases[path] = dict(record)
+            return
+
+        for key, value in record.items():
+            if total[key] is None or value is None:
+                total[key] = None
+            elif key == 'peak_rss':
+                total[key] = max(total[key], value)
+            else:
+                total[key] += value
+
+    def to_dict(self):
+        """
+        Return the profile as a dictionary of JSON values: one entry per
+        phase with its number of calls, wall and CPU times in seconds, bytes
+        read and written and peak resident set size in bytes at the end of
+        the phase (None when unavailable on this platform).
+        """
+        return {'phases': [
+            collections.OrderedDict([('phase', path)] + sorted(record.items()))
+            for path, record in self.phases.items() if record is not None]}
+
+    def write(self, filename):
+        with open(filename, 'w') as fid:
+            json.dump(self.to_dict(), fid, indent=2)
+
+
+@contextlib.contextmanager
+def _no_phase():
+    yield
+
+
+def phase(profiler, name):
+    """
+    Return a context manager profiling phase 'name' with 'profiler' (doing
+    nothing if 'profiler' is None).
+    """
+    if profiler is None:
+        return _no_phase()
+    return profiler.phase(name)
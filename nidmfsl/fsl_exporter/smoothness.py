@@ -0,0 +1,184 @@
+"""
+Estimation of the smoothness of the residuals (or of a statistic map) of an
+FSL analysis, as computed by FSL's smoothest, without FSL.
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+import os
+import shlex
+import numpy as np
+import nibabel as nib
+
+from nidmfsl.fsl_exporter.images import image_file, load_data, \
+    read_geometry
+
+# Options of smoothest (short and long names) used to find its inputs in
+# the command logged by FEAT
+SMOOTHEST_OPTIONS = {
+    '-d': 'dof', '--dof': 'dof',
+    '-m': 'mask', '--mask': 'mask',
+    '-r': 'res', '--res': 'res',
+    '-z': 'zstat', '--zstat': 'zstat',
+}
+
+# Number of volumes of the residuals loaded at once
+CHUNK_SIZE = 16
+
+
+def parse_smoothest_command(cmd):
+    """
+    Return a dictionary of the inputs ('dof', 'mask', 'res' or 'zstat') of
+    the smoothest command 'cmd' (as logged by FEAT, e.g. "smoothest -d 95
+    -m mask -r stats/res4d > stats/smoothness").
+    """
+    args = dict()
+    tokens = shlex.split(cmd.split('>')[0])
+    i = 1
+    while i < len(tokens):
+        token = tokens[i]
+        if '=' in token:
+            option, value = token.split('=', 1)
+        elif i + 1 < len(tokens) and not tokens[i + 1].startswith('-'):
+            option, value = token, tokens[i + 1]
+            i += 1
+        else:
+            # Flag (e.g. -V)
+            option, value = token, None
+        if option in SMOOTHEST_OPTIONS:
+            args[SMOOTHEST_OPTIONS[option]] = value
+        i += 1
+
+    if 'dof' in args:
+        args['dof'] = float(args['dof'])
+    return args
+
+
+def _sums(data, mask, sumsq, cross):
+    """
+    Add to 'sumsq' the sum of squares of each voxel of 'data' (a 4D array)
+    and to 'cross[d]' the sum of the products of each voxel with its
+    previous neighbour along axis d.
+    """
+    data = data * mask[..., np.newaxis]
+    sumsq += np.einsum('xyzt,xyzt->xyz', data, data)
+    cross[0][1:, :, :] += np.einsum(
+        'xyzt,xyzt->xyz', data[1:, :, :], data[:-1, :, :])
+    cross[1][:, 1:, :] += np.einsum(
+        'xyzt,xyzt->xyz', data[:, 1:, :], data[:, :-1, :])
+    cross[2][:, :, 1:] += np.einsum(
+        'xyzt,xyzt->xyz', data[:, :, 1:], data[:, :, :-1])
+
+
+def estimate_smoothness(mask_file, res_file=None, zstat_file=None):
+    """
+    Estimate the smoothness from the residuals 'res_file' (normalised by
+    their standard deviation in each voxel) or from the statistic map
+    'zstat_file', within 'mask_file'. As in smoothest, the variance of the
+    Gaussian kernel along each axis is derived from the correlation of
+    neighbouring voxels: sigma^2 = -1 / (4 log(rho)).
+
+    Return a dictionary with keys FWHM[xyz]_vx, FWHM[xyz]_mm, DLH, volume
+    and vox_per_resels, as parsed from the output of "smoothest -V".
+
+    The estimate is approximate: smoothest corrects the smoothness of the
+    residuals for their degrees of freedom (with a lookup table), which is
+    not done here, so FWHMs, DLH and resels estimated from residuals differ
+    slightly from FSL's. They are consistent with each other (the resel
+    size is the product of the FWHMs in voxels).
+    """
+    mask = load_data(mask_file) > 0.5
+    if mask.ndim > 3:
+        mask = mask[..., 0]
+    voxel_size = read_geometry(mask_file).zooms[:3]
+
+    # The file is kept open so that gzipped volumes are decompressed once
+    # (rather than from the start of the file for each chunk)
+    img = nib.load(res_file if res_file is not None else zstat_file,
+                   mmap='r', keep_file_open=True)
+    shape = img.shape[:3]
+    num_volumes = img.shape[3] if len(img.shape) > 3 else 1
+
+    sumsq = np.zeros(shape)
+    cross = [np.zeros(shape) for d in range(3)]
+    for start in range(0, num_volumes, CHUNK_SIZE):
+        if len(img.shape) > 3:
+            data = np.asarray(img.dataobj[..., start:start + CHUNK_SIZE],
+                              dtype=float)
+        else:
+            data = np.asarray(img.dataobj, dtype=float)[..., np.newaxis]
+        _sums(data, mask, sumsq, cross)
+
+    # Residuals are normalised by their standard deviation in each voxel
+    # (the scale of the normalisation cancels out in the correlations)
+    if res_file is not None:
+        norm = np.zeros(shape)
+        norm[sumsq > 0] = 1 / np.sqrt(sumsq[sumsq > 0])
+    else:
+        norm = np.ones(shape)
+
+    sigmasq = list()
+    for d in range(3):
+        # Pairs of neighbouring voxels both in the mask
+        current = [slice(None)] * 3
+        previous = [slice(None)] * 3
+        current[d] = slice(1, None)
+        previous[d] = slice(None, -1)
+        current, previous = tuple(current), tuple(previous)
+        pairs = mask[current] & mask[previous]
+
+        ss_minus = np.sum((cross[d][current] * norm[current] *
+                           norm[previous])[pairs])
+        s2 = np.sum(0.5 * (sumsq[current] * norm[current] ** 2 +
+                           sumsq[previous] * norm[previous] ** 2)[pairs])
+        sigmasq.append(-1.0 / (4 * np.log(abs(ss_minus / s2))))
+
+    fwhm = [np.sqrt(8 * np.log(2) * s) for s in sigmasq]
+
+    smoothness = dict()
+    for axis, value, size in zip('xyz', fwhm, voxel_size):
+        smoothness['FWHM' + axis + '_vx'] = float(value)
+        smoothness['FWHM' + axis + '_mm'] = float(value * size)
+    smoothness['DLH'] = float(np.prod(sigmasq) ** -0.5 * 8 ** -0.5)
+    smoothness['volume'] = int(mask.sum())
+    smoothness['vox_per_resels'] = float(np.prod(fwhm))
+    return smoothness
+
+
+def smoothest_inputs(cmd, analysis_dir):
+    """
+    Return a dictionary of the files of the mask and of the residuals ('res')
+    or statistic map ('zstat') used by the smoothest command 'cmd' run by
+    FEAT in 'analysis_dir', or None if the command is not supported or if
+    one of these files is missing (e.g. stats/res4d deleted after the
+    analysis).
+    """
+    args = parse_smoothest_command(cmd)
+    inputs = dict()
+    for key in ('mask', 'res', 'zstat'):
+        if args.get(key):
+            inputs[key] = image_file(os.path.join(analysis_dir, args[key]))
+            if not os.path.isfile(inputs[key]):
+                return None
+
+    if 'mask' not in inputs or not ('res' in inputs or 'zstat' in inputs):
+        return None
+    return inputs
+
+
+def estimate_smoothness_from_command(cmd, analysis_dir):
+    """
+    Estimate the smoothness with the inputs of the smoothest command 'cmd'
+    run by FEAT in 'analysis_dir'.
+    """
+    inputs = smoothest_inputs(cmd, analysis_dir)
+    if inputs is None:
+        raise Exception(
+            "Unsupported smoothest command or missing inputs: " + cmd)
+
+    if 'res' in inputs:
+        return estimate_smoothness(inputs['mask'], res_file=inputs['res'])
+    else:
+        return estimate_smoothness(inputs['mask'],
+                                   zstat_file=inputs['zstat'])
@@ -0,0 +1,133 @@
+"""
+Staging of the files written during an export (derived maps and pack being
+built) outside of the FEAT directory, atomic move of the final pack and
+linking of unchanged input files into the pack.
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+import os
+import shutil
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+# ioctl request cloning a file (reflink) on Linux (btrfs, xfs...)
+FICLONE = 0x40049409
+
+
+def same_device(path, directory):
+    """
+    Return True if 'path' and 'directory' are on the same file system (so
+    that 'path' can be renamed into 'directory').
+    """
+    return os.stat(path).st_dev == os.stat(directory).st_dev
+
+
+def _swap(src, dst):
+    """
+    Rename 'src' to 'dst' (both in the same file system), replacing an
+    existing file or directory 'dst'.
+    """
+    if os.path.isdir(dst):
+        # A directory cannot be replaced by a rename: the previous output
+        # is moved aside (and removed) once the new one is in place
+        old_dir = tempfile.mkdtemp(
+            prefix='.' + os.path.basename(dst) + '.',
+            dir=os.path.dirname(dst))
+        old = os.path.join(old_dir, os.path.basename(dst))
+        os.rename(dst, old)
+        try:
+            os.rename(src, dst)
+        except OSError:
+            os.rename(old, dst)
+            raise
+        finally:
+            shutil.rmtree(old_dir)
+    else:
+        os.rename(src, dst)
+
+
+def move_atomic(src, dst):
+    """
+    Move the file or directory 'src' to 'dst' (replacing it if it exists)
+    so that 'dst' is never seen partially written. If 'src' is on another
+    file system it is first copied to a temporary name next to 'dst' and
+    then renamed.
+    """
+    dst_dir = os.path.dirname(os.path.abspath(dst))
+    if same_device(src, dst_dir):
+        _swap(src, dst)
+        return
+
+    tmp_dir = tempfile.mkdtemp(prefix='.' + os.path.basename(dst) + '.',
+                               dir=dst_dir)
+    try:
+        tmp = os.path.join(tmp_dir, os.path.basename(dst))
+        if os.path.isdir(src):
+            shutil.copytree(src, tmp)
+        else:
+            shutil.copy2(src, tmp)
+        _swap(tmp, dst)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if os.path.isdir(src):
+        shutil.rmtree(src)
+    else:
+        os.remove(src)
+
+
+def _reflink(src, dst):
+    """
+    Create 'dst' as a copy-on-write clone of 'src'. Raise OSError if the
+    file system does not support it.
+    """
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(src, 'rb') as src_fid:
+        # 'dst' is created (never truncated, as it could be a link to 'src')
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fid.fileno())
+        except (IOError, OSError):
+            os.close(dst_fd)
+            os.remove(dst)
+            raise
+        os.close(dst_fd)
+
+
+def link_file(src, dst, symlink=True):
+    """
+    Make the file 'src' available as 'dst' without copying its content if
+    possible: by a hard link (same file system), a reflink (copy-on-write
+    clone) or a symbolic link (unless 'symlink' is False, e.g. if 'src' may
+    be removed), or by a copy if none of them is supported. Return the
+    method used: 'hardlink', 'reflink', 'symlink' or 'copy'. An existing
+    'dst' is replaced.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except (AttributeError, OSError):
+        pass
+    try:
+        _reflink(src, dst)
+        return 'reflink'
+    except (IOError, OSError):
+        pass
+    if symlink:
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return 'symlink'
+        except (AttributeError, NotImplementedError, OSError):
+            pass
+    shutil.copy(src, dst)
+    return 'copy'
@@ -0,0 +1,81 @@
+"""
+Reader of the tables of clusters and peaks written by FSL's cluster
+(cluster_*.txt and lmax_*.txt).
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+import numpy as np
+
+
+class FSLTable(object):
+
+    """
+    Table made of a header line of tab-separated column names followed by
+    rows of whitespace-separated values. An empty table (no significant
+    cluster or peak) has no row.
+    """
+
+    def __init__(self, header, data):
+        # Fields of the header line, split on tabs (e.g. a trailing tab gives
+        # a last field "\n")
+        self.header = header
+        # 2D array of values (one row per cluster or peak)
+        self.data = data
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as fid:
+            header = fid.readline().split('\t')
+            rows = [line.split() for line in fid
+                    if line.strip() and not line.startswith('#')]
+
+        if rows:
+            num_cols = len(rows[0])
+        else:
+            num_cols = len([name for name in header if name.strip()])
+        data = np.array(rows, dtype=float).reshape(len(rows), num_cols)
+        return cls(header, data)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def names(self):
+        """
+        Column names.
+        """
+        return [name.strip() for name in self.header if name.strip()]
+
+    @property
+    def records(self):
+        """
+        Record array of the table with one field per column (named as in
+        the header, e.g. table.records['Cluster Index']).
+        """
+        return np.rec.fromarrays(
+            [self.data[:, i] for i in range(self.data.shape[1])],
+            names=self.names)
+
+    def indices(self, col_head):
+        """
+        Return the indices of the columns whose name contains 'col_head' (is
+        equal to 'col_head' for single-character names, e.g. "P" or "x").
+        """
+        if len(col_head) > 1:
+            return [i for i, s in enumerate(self.header) if col_head in s]
+        else:
+            return [i for i, s in enumerate(self.header) if s == col_head]
+
+
+def read_table(path, cache=None):
+    """
+    Return the FSLTable stored in 'path'. If 'cache' (a dictionary) is
+    given, each file is only read once.
+    """
+    if cache is None:
+        return FSLTable.from_file(path)
+    if path not in cache:
+        cache[path] = FSLTable.from_file(path)
+    return cache[path]
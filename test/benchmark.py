@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+Benchmark of the export of synthetic FEAT directories: time of parse() and
+export() and of their hot steps, and peak memory, compared to the baseline
+stored in benchmark_baseline.json.
+
+    python benchmark.py                    # small and medium cases
+    python benchmark.py --cases huge       # volumes of 91x109x91 voxels
+    python benchmark.py --save-baseline    # record the current timings
+
+Exits with status 1 if a timing or the peak memory increased by more than
+the threshold (--threshold) compared to the baseline. As for the exporter,
+FSLDIR must be set to export first-level analyses.
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+import os
+import sys
+import json
+import shutil
+import platform
+import tempfile
+import argparse
+import collections
+import multiprocessing
+
+RELPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Add FSL NIDM export to python path
+sys.path.append(RELPATH)
+
+from pyld import jsonld
+from nidmfsl.fsl_exporter.fsl_exporter import FSLtoNIDMExporter
+from nidmfsl.fsl_exporter.batch import get_output_path
+from nidmfsl.fsl_exporter.manifest import MANIFEST_SUFFIX
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(TEST_DIR)
+from synthetic_feat import make_feat_dir, make_gfeat_dir
+
+BASELINE_FILE = os.path.join(TEST_DIR, 'benchmark_baseline.json')
+
+# Parameters of the synthetic first-level (feat) and group (gfeat) analyses
+# of each case
+CASES = collections.OrderedDict([
+    ('small', {
+        'feat': dict(shape=(20, 24, 20), num_contrasts=2, num_clusters=3),
+        'gfeat': dict(shape=(20, 24, 20), num_copes=2, num_clusters=3)}),
+    ('medium', {
+        'feat': dict(shape=(64, 64, 36), num_evs=4, num_contrasts=6,
+                     num_clusters=20),
+        'gfeat': dict(shape=(64, 64, 36), num_copes=4, num_contrasts=2,
+                      num_clusters=20)}),
+    ('huge', {
+        'feat': dict(shape=(91, 109, 91), num_evs=6, num_contrasts=20,
+                     num_ftests=2, num_clusters=50),
+        'gfeat': dict(shape=(91, 109, 91), num_copes=10, num_contrasts=2,
+                      num_clusters=50)}),
+])
+DEFAULT_CASES = ['small', 'medium']
+GROUPS = [['control', '10']]
+
+# Timed phases of the profile of the export (see FSLtoNIDMExporter.profile)
+PHASES = collections.OrderedDict([
+    ('parse', 'parse'),
+    ('export', 'export'),
+    ('cluster_labels_maps', 'parse/_extract_analyses/cluster_labels_maps'),
+    ('smoothness', 'parse/_extract_analyses/search_space'),
+    ('design_matrix', 'parse/_find_model_fitting/_get_design_matrix'),
+    ('clusters_peaks', 'parse/_find_inferences/_get_clusters_peaks'),
+    ('search_space', 'parse/_find_inferences/_get_search_space'),
+])
+
+# Measures whose increase always fails the benchmark (the slowdowns of the
+# other phases only fail it if they took more than MIN_TIME)
+TOTALS = ['parse', 'export', 'peak_rss']
+# Noise margin: timing differences below this duration (in seconds) are
+# never reported
+MIN_TIME_DIFF = 0.1
+# Phases (other than TOTALS) that took less than this duration (in seconds)
+# are too sensitive to the load of the machine for their slowdowns to fail
+# the benchmark: they are only reported as warnings
+MIN_TIME = 1.0
+
+# JSON-LD context used to compact nidm.json instead of the one published at
+# http://purl.org/nidash/context, so that export() is timed without network
+# access (nor its latency)
+OFFLINE_CONTEXT = {'@context': {}}
+
+
+def make_case(data_dir, case):
+    """
+    Return the FEAT directories of 'case' (generated in 'data_dir' if they
+    do not exist yet).
+    """
+    feat_dirs = collections.OrderedDict()
+    for kind, make_dir in (('feat', make_feat_dir),
+                           ('gfeat', make_gfeat_dir)):
+        feat_dir = os.path.join(data_dir, case, 'analysis.' + kind)
+        if not os.path.isdir(feat_dir):
+            print("Generating " + feat_dir)
+            make_dir(feat_dir, **CASES[case][kind])
+        feat_dirs[kind] = feat_dir
+    return feat_dirs
+
+
+def _remove_outputs(feat_dir):
+    output = get_output_path(feat_dir)
+    for path in (output, output + MANIFEST_SUFFIX):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def load_document(url, options=None):
+    """
+    Document loader of pyld returning OFFLINE_CONTEXT for any URL.
+    """
+    return {'contextUrl': None, 'documentUrl': url,
+            'document': OFFLINE_CONTEXT}
+
+
+def run_export(task):
+    """
+    Export 'feat_dir' (parse only if 'export' is False) and return the
+    duration of each phase of PHASES and the peak resident set size.
+
+    'task' is a tuple (feat_dir, groups, export) so that this function can
+    be run in a separate process (for the peak memory of each export to be
+    measured separately).
+    """
+    feat_dir, groups, export = task
+
+    jsonld.set_document_loader(load_document)
+    _remove_outputs(feat_dir)
+    cwd = os.getcwd()
+    exporter = FSLtoNIDMExporter(
+        feat_dir, version="1.3.0", groups=groups, profile=True)
+    try:
+        exporter.parse()
+        if export:
+            exporter.export()
+    finally:
+        # The export changes the working directory when zipping
+        os.chdir(cwd)
+        exporter.cleanup()
+        _remove_outputs(feat_dir)
+
+    phases = exporter.profile.phases
+    result = collections.OrderedDict(
+        (name, phases[path]['wall']) for name, path in PHASES.items()
+        if phases.get(path) is not None)
+    result['peak_rss'] = max(
+        phase['peak_rss'] for phase in phases.values()
+        if phase is not None)
+    return result
+
+
+def run_benchmark(cases, data_dir, repeat=3, export=True):
+    """
+    Return the results of the benchmark: for each analysis ('<case>/feat'
+    or '<case>/gfeat'), the minimum duration of each phase and the maximum
+    peak resident set size (in bytes) over 'repeat' exports.
+    """
+    results = collections.OrderedDict()
+    for case in cases:
+        for kind, feat_dir in make_case(data_dir, case).items():
+            groups = GROUPS if kind == 'gfeat' else None
+            runs = list()
+            for i in range(repeat):
+                pool = multiprocessing.Pool(1)
+                try:
+                    runs.append(pool.apply(
+                        run_export, ((feat_dir, groups, export),)))
+                finally:
+                    pool.close()
+                    pool.join()
+
+            result = collections.OrderedDict()
+            for name in runs[0]:
+                if name == 'peak_rss':
+                    result[name] = max(run[name] for run in runs)
+                else:
+                    result[name] = round(min(run[name] for run in runs), 4)
+            results[case + '/' + kind] = result
+            print(case + '/' + kind + ": " + ", ".join(
+                name + "=" + ("%.3fs" % value if name != 'peak_rss' else
+                              "%.1fMB" % (value / 1e6))
+                for name, value in result.items()))
+    return results
+
+
+def compare(results, baseline, threshold=0.25):
+    """
+    Return the regressions and the warnings of 'results' compared to
+    'baseline': the durations (by more than MIN_TIME_DIFF) and peak memory
+    that increased by more than 'threshold' (a ratio), the durations of the
+    phases other than TOTALS shorter than MIN_TIME being warnings. Measures
+    that are not in the baseline are ignored.
+    """
+    regressions = list()
+    warnings = list()
+    for analysis, result in results.items():
+        for name, value in result.items():
+            reference = baseline.get(analysis, dict()).get(name)
+            if reference is None:
+                continue
+            if name != 'peak_rss' and value - reference < MIN_TIME_DIFF:
+                continue
+            if value > reference * (1 + threshold):
+                message = (
+                    analysis + " " + name + ": " + "%.3g" % value +
+                    " (baseline: " + "%.3g" % reference + ", +" +
+                    "%.0f" % (100 * (value / reference - 1)) + "%)")
+                if name not in TOTALS and value < MIN_TIME:
+                    warnings.append(message)
+                else:
+                    regressions.append(message)
+    return regressions, warnings
+
+
+def _machine():
+    return platform.platform() + ", Python " + platform.python_version()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the NIDM-Results export of synthetic FEAT '
+        'directories.')
+    parser.add_argument(
+        "--cases", nargs='+', choices=list(CASES.keys()),
+        default=DEFAULT_CASES, help='Cases to run (default: small medium).')
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3,
+        help='Number of exports per analysis, the fastest is kept '
+        '(default: 3).')
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=0.25,
+        help='Relative increase of a timing or of the peak memory reported '
+        'as a regression (default: 0.25).')
+    parser.add_argument(
+        "--parse-only", action='store_true',
+        help='Only time parse().')
+    parser.add_argument(
+        "--baseline", default=BASELINE_FILE,
+        help='Baseline file (default: benchmark_baseline.json).')
+    parser.add_argument(
+        "--save-baseline", action='store_true',
+        help='Store the results in the baseline file (replacing the '
+        'baseline of the analyses that were run).')
+    parser.add_argument(
+        "-d", "--data-dir",
+        default=os.path.join(tempfile.gettempdir(), 'nidmfsl_benchmark'),
+        help='Directory of the synthetic FEAT directories (generated if '
+        'missing).')
+    parser.add_argument(
+        "-o", "--output", help='Also write the results to this JSON file.')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.cases, args.data_dir, args.repeat,
+                            export=(not args.parse_only))
+    if args.output:
+        with open(args.output, 'w') as fid:
+            json.dump(results, fid, indent=2)
+
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as fid:
+            baseline = json.load(fid)
+    else:
+        baseline = {'machine': None, 'results': dict()}
+
+    if args.save_baseline:
+        baseline['machine'] = _machine()
+        baseline['results'].update(results)
+        with open(args.baseline, 'w') as fid:
+            json.dump(baseline, fid, indent=2, sort_keys=True)
+        print("Baseline saved in " + args.baseline)
+        sys.exit(0)
+
+    if baseline['machine'] != _machine():
+        print("Warning: baseline recorded on a different machine (" +
+              str(baseline['machine']) + ")")
+
+    regressions, warnings = compare(
+        results, baseline['results'], args.threshold)
+    for warning in warnings:
+        print("Warning: " + warning + " (shorter than " +
+              "%.3g" % MIN_TIME + "s)")
+    for regression in regressions:
+        print("Regression: " + regression)
+    if regressions:
+        sys.exit(1)
+    print("No regression (threshold: +" + "%.0f" % (100 * args.threshold) +
+          "%)")
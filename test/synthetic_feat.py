@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+"""
+Generate synthetic FSL FEAT directories (first-level .feat and higher-level
+.gfeat) that can be exported with nidmfsl without FSL or external test data,
+e.g. to exercise the exporter on large volumes or many contrasts, clusters
+and copes:
+    python synthetic_feat.py --shape 91 109 91 --contrasts 20 big.feat
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+
+import os
+import argparse
+import numpy as np
+import nibabel as nib
+import scipy.ndimage
+
+# Affines of the synthetic images: 2mm MNI-like grid for higher-level
+# analyses and 3mm subject space for first-level analyses
+STD_AFFINE = np.array([[-2., 0., 0., 90.],
+                       [0., 2., 0., -126.],
+                       [0., 0., 2., -72.],
+                       [0., 0., 0., 1.]])
+SUB_AFFINE = np.array([[3., 0., 0., -96.],
+                       [0., 3., 0., -120.],
+                       [0., 0., 3., -60.],
+                       [0., 0., 0., 1.]])
+
+CLUSTER_HDR = [
+    'Cluster Index', 'Voxels', 'P', '-log10(P)', 'Z-MAX',
+    'Z-MAX X ({u})', 'Z-MAX Y ({u})', 'Z-MAX Z ({u})',
+    'Z-COG X ({u})', 'Z-COG Y ({u})', 'Z-COG Z ({u})',
+    'COPE-MAX', 'COPE-MAX X ({u})', 'COPE-MAX Y ({u})', 'COPE-MAX Z ({u})',
+    'COPE-MEAN']
+LMAX_HDR = ['Cluster Index', 'Z', 'x', 'y', 'z']
+
+# Smoothness (FWHM in voxels) of the residuals
+FWHM_VX = [2.51, 2.63, 2.42]
+
+# Minimal 8-bit greyscale PNG (1x1 pixel) used for rendered images
+PNG_1X1 = (
+    b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01'
+    b'\x08\x00\x00\x00\x00:~\x9bU\x00\x00\x00\nIDATx\x9cc`\x00\x00\x00\x02'
+    b'\x00\x01H\xaf\xa4q\x00\x00\x00\x00IEND\xaeB`\x82')
+
+
+def _save(data, affine, path):
+    img = nib.Nifti1Image(data, affine)
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    nib.save(img, path)
+
+
+def _write_png(path):
+    with open(path, 'wb') as fid:
+        fid.write(PNG_1X1)
+
+
+def _write_table(path, header, rows, fmts):
+    with open(path, 'w') as fid:
+        fid.write('\t'.join(header) + '\t\n')
+        for row in rows:
+            fid.write('\t'.join(
+                fmt % val for fmt, val in zip(fmts, row)) + '\t\n')
+
+
+def _blob_centres(shape, num_clusters, rng):
+    """
+    Centres of 'num_clusters' non-overlapping blobs laid on a regular grid
+    (one blob per 8x8x8 voxels at most).
+    """
+    step = 8
+    grid = [np.arange(step // 2 + 1, s - step // 2, step) for s in shape]
+    centres = np.array(np.meshgrid(*grid, indexing='ij')).reshape(3, -1).T
+    if len(centres) < num_clusters:
+        raise Exception("Volume " + str(shape) + " too small for " +
+                        str(num_clusters) + " clusters")
+    idx = rng.choice(len(centres), num_clusters, replace=False)
+    return centres[np.sort(idx)]
+
+
+def _make_stat(shape, num_clusters, z_thresh, rng):
+    """
+    Z-statistic volume made of gaussian blobs over a sub-threshold background.
+    """
+    zstat = rng.normal(0, 0.4, shape).astype(np.float32)
+    for centre in _blob_centres(shape, num_clusters, rng):
+        radius = rng.uniform(1.2, 2.2)
+        height = rng.uniform(z_thresh + 2, z_thresh + 6)
+        # Blobs are only computed up to 5 standard deviations (plus the
+        # offset of the second lobe) from their centre
+        half_width = int(np.ceil(5 * radius)) + 1
+        box = tuple(slice(max(0, centre[i] - half_width),
+                          min(shape[i], centre[i] + half_width + 1))
+                    for i in range(3))
+        grid = np.mgrid[box].astype(np.float32)
+        dist2 = sum((grid[i] - centre[i])**2 for i in range(3))
+        # Two lobes per blob so that clusters contain several local maxima
+        lobe = np.array(centre) + [1, 1, 0]
+        dist2b = sum((grid[i] - lobe[i])**2 for i in range(3))
+        zstat[box] += height * np.exp(-dist2 / (2 * radius**2))
+        zstat[box] += 0.6 * height * np.exp(-dist2b / (2 * radius**2))
+    return zstat
+
+
+def _cluster_tables(thresh, cope, affine, units, max_peaks=3):
+    """
+    Cluster and local maxima tables (as written by FSL's 'cluster') for an
+    excursion set.
+    """
+    labels, num = scipy.ndimage.label(thresh > 0, np.ones((3, 3, 3)))
+    local_max = thresh == scipy.ndimage.maximum_filter(thresh, size=3)
+    clusters = list()
+    # Each cluster is processed within its bounding box
+    for lab, box in enumerate(scipy.ndimage.find_objects(labels), start=1):
+        offset = np.array([s.start for s in box])
+        in_cluster = labels[box] == lab
+        vox = np.argwhere(in_cluster) + offset
+        z = thresh[box][in_cluster]
+        zmax = vox[np.argmax(z)]
+        cog = np.average(vox, axis=0, weights=z)
+        c = cope[box][in_cluster]
+        cmax = vox[np.argmax(c)]
+        # Local maxima within the cluster, strongest first
+        peaks = np.argwhere(in_cluster & local_max[box]) + offset
+        peaks = peaks[np.argsort(-thresh[tuple(peaks.T)])][:max_peaks]
+        clusters.append((len(vox), zmax, cog, cmax, c, z, peaks))
+
+    # FSL numbers clusters by increasing size and lists the largest first
+    order = sorted(range(num), key=lambda i: clusters[i][0])
+    cl_rows = list()
+    lm_rows = list()
+    for fsl_idx, i in reversed(list(enumerate(order, start=1))):
+        size, zmax, cog, cmax, c, z, peaks = clusters[i]
+        if units == 'mm':
+            zmax, cog, cmax = (nib.affines.apply_affine(affine, v)
+                               for v in (zmax, cog, cmax))
+            peaks = nib.affines.apply_affine(affine, peaks)
+        p = 10 ** -(2 + size / 10.0)
+        cl_rows.append([fsl_idx, size, p, -np.log10(p), z.max()] +
+                       list(zmax) + list(cog) + [c.max()] + list(cmax) +
+                       [c.mean()])
+        for peak in peaks:
+            vox = np.round(nib.affines.apply_affine(
+                np.linalg.inv(affine), peak)).astype(int) \
+                if units == 'mm' else peak
+            lm_rows.append([fsl_idx, thresh[tuple(vox)]] + list(peak))
+
+    if units == 'mm':
+        cfmt = ['%d', '%d', '%.2e', '%.2f', '%.2f'] + ['%.3g'] * 6 + \
+            ['%.3g'] + ['%.3g'] * 3 + ['%.3g']
+        lfmt = ['%d', '%.2f', '%.3g', '%.3g', '%.3g']
+    else:
+        cfmt = ['%d', '%d', '%.2e', '%.2f', '%.2f'] + ['%d'] * 3 + \
+            ['%.3g'] * 3 + ['%.3g'] + ['%d'] * 3 + ['%.3g']
+        lfmt = ['%d', '%.2f', '%d', '%d', '%d']
+    return cl_rows, cfmt, lm_rows, lfmt
+
+
+def _design_fsf(level, num_evs, contrasts, ftests, onset_dir=None,
+                num_copes=1):
+    lines = ['', '# FEAT version number', 'set fmri(version) 6.00',
+             '', '# Analysis level', 'set fmri(level) ' + str(level),
+             'set fmri(analysis) 7',
+             'set fmri(mixed_yn) 2',
+             'set fmri(thresh) 3',
+             'set fmri(prob_thresh) 0.05',
+             'set fmri(z_thresh) 2.3',
+             'set fmri(paradigm_hp) 100',
+             'set fmri(regstandard_yn) 1',
+             'set fmri(alternateReference_yn) 0',
+             'set fmri(regstandard) "/usr/share/fsl/data/standard/'
+             'MNI152_T1_2mm_brain"',
+             'set fmri(motionevs) 0',
+             'set fmri(npts) ' + str(num_copes),
+             'set fmri(evs_orig) ' + str(num_evs),
+             'set fmri(evs_real) ' + str(num_evs),
+             'set fmri(ncon_real) ' + str(len(contrasts)),
+             'set fmri(nftests_real) ' + str(len(ftests))]
+    for ev in range(1, num_evs + 1):
+        lines += ['', '# Title for EV ' + str(ev),
+                  'set fmri(evtitle%d) "ev%d"' % (ev, ev),
+                  'set fmri(shape%d) 3' % ev,
+                  'set fmri(convolve%d) 3' % ev,
+                  'set fmri(deriv_yn%d) 0' % ev]
+        if onset_dir is not None:
+            lines.append('set fmri(custom%d) "%s"' % (
+                ev, os.path.join(onset_dir, 'ev%d.txt' % ev)))
+    for con, weights in enumerate(contrasts, start=1):
+        lines.append('set fmri(conname_real.%d) "contrast %d"' % (con, con))
+        for ev, w in enumerate(weights, start=1):
+            lines.append('set fmri(con_real%d.%d) %s' % (con, ev, w))
+    for ftest, tcons in enumerate(ftests, start=1):
+        for con in range(1, len(contrasts) + 1):
+            lines.append('set fmri(ftest_real%d.%d) %d' % (
+                ftest, con, int(con in tcons)))
+    ncon = len(contrasts) + len(ftests)
+    lines.append('set fmri(conmask_zerothresh_yn) 0')
+    for c1 in range(1, ncon + 1):
+        for c2 in range(1, ncon + 1):
+            if c1 != c2:
+                lines.append('set fmri(conmask%d_%d) 0' % (c1, c2))
+    lines.append('set fmri(conmask1_1) 0')
+    return '\n'.join(lines) + '\n'
+
+
+def _design_mat(num_points, num_evs, rng):
+    values = rng.normal(0, 1, (num_points, num_evs))
+    hdr = ['/NumWaves\t' + str(num_evs), '/NumPoints\t' + str(num_points),
+           '/PPheights\t' + '\t'.join(['1'] * num_evs), '', '/Matrix']
+    return '\n'.join(hdr) + '\n' + '\n'.join(
+        '\t'.join('%.6e' % v for v in row) for row in values) + '\n'
+
+
+def _feat4_post(stats, first_level, connectivity=26):
+    cmds = list()
+    for prefix, num in stats:
+        name = prefix + str(num)
+        if first_level:
+            tables = ('--othresh=thresh_' + name + ' -o cluster_mask_' +
+                      name + ' --olmax=lmax_' + name + '.txt')
+            out = 'cluster_' + name + '.txt'
+        else:
+            tables = ('--othresh=thresh_' + name + ' -o cluster_mask_' +
+                      name + ' --olmax=lmax_' + name + '_std.txt ' +
+                      '--stdvol=../reg/standard')
+            out = 'cluster_' + name + '_std.txt'
+        cmds.append(
+            '/usr/share/fsl/5.0/bin/cluster -i thresh_' + name + ' -c stats/'
+            'cope1 -t 2.3 -p 0.05 -d 0.0493 --volume=12345 ' + tables +
+            ' --connectivity=' + str(connectivity) + ' --mm --num=3 '
+            '--peakdist=0 > ' + out)
+    return '\n'.join(cmds) + '\n'
+
+
+def _smoothness(mask, affine, verbose):
+    volume = int(mask.sum())
+    fwhm_mm = [f * abs(affine[i, i]) for i, f in enumerate(FWHM_VX)]
+    resels = float(np.prod(FWHM_VX))
+    dlh = 1.0 / (resels * (4 * np.log(2)) ** -1.5)
+    txt = ''
+    if verbose:
+        txt += ('FWHMx = %g voxels, FWHMy = %g voxels, FWHMz = %g voxels\n' %
+                tuple(FWHM_VX))
+        txt += ('FWHMx = %g mm, FWHMy = %g mm, FWHMz = %g mm\n' %
+                tuple(fwhm_mm))
+    txt += 'DLH %g voxels^-3\n' % dlh if verbose else 'DLH %g\n' % dlh
+    txt += 'VOLUME %d voxels\n' % volume if verbose else \
+        'VOLUME %d\n' % volume
+    txt += 'RESELS %g voxels per resel\n' % resels if verbose else \
+        'RESELS %g\n' % resels
+    return txt
+
+
+def _write_analysis(analysis_dir, shape, affine, num_evs, contrasts, ftests,
+                    num_clusters, first_level, rng, num_points=20,
+                    verbose_smoothness=True):
+    stats_dir = os.path.join(analysis_dir, 'stats')
+    logs_dir = os.path.join(analysis_dir, 'logs')
+    for d in (analysis_dir, stats_dir, logs_dir):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    units = 'vox' if first_level else 'mm'
+    z_thresh = 2.3
+
+    with open(os.path.join(analysis_dir, 'design.mat'), 'w') as fid:
+        fid.write(_design_mat(num_points, num_evs, rng))
+    _write_png(os.path.join(analysis_dir, 'design.png'))
+
+    _save(mask, affine, os.path.join(analysis_dir, 'mask.nii.gz'))
+    _save((mask.astype(np.float32) * 10000 +
+           rng.normal(0, 50, shape)).astype(np.float32),
+          affine, os.path.join(analysis_dir, 'mean_func.nii.gz'))
+    if first_level:
+        _save(rng.normal(10000, 50, shape + (num_points,)).astype(
+            np.float32), affine,
+            os.path.join(analysis_dir, 'filtered_func_data.nii.gz'))
+
+    dof = num_points - num_evs
+    with open(os.path.join(stats_dir, 'dof'), 'w') as fid:
+        fid.write(str(dof) + '\n')
+    for pe in range(1, num_evs + 1):
+        _save(rng.normal(0, 1, shape).astype(np.float32), affine,
+              os.path.join(stats_dir, 'pe%d.nii.gz' % pe))
+    sigmasq = rng.uniform(1, 2, shape).astype(np.float32) * mask
+    _save(sigmasq, affine, os.path.join(stats_dir, 'sigmasquareds.nii.gz'))
+    if not first_level:
+        _save(sigmasq / 2, affine,
+              os.path.join(stats_dir, 'mean_random_effects_var1.nii.gz'))
+    with open(os.path.join(stats_dir, 'smoothness'), 'w') as fid:
+        fid.write(_smoothness(mask, affine, verbose_smoothness))
+
+    stats = [('zstat', c) for c in range(1, len(contrasts) + 1)] + \
+        [('zfstat', f) for f in range(1, len(ftests) + 1)]
+    for prefix, num in stats:
+        zstat = _make_stat(shape, num_clusters, z_thresh, rng) * mask
+        cope = zstat * rng.uniform(50, 100)
+        stat = ('tstat' if prefix == 'zstat' else 'fstat') + str(num)
+        _save(zstat, affine, os.path.join(stats_dir, prefix + '%d.nii.gz' %
+                                          num))
+        _save(zstat * 1.1, affine,
+              os.path.join(stats_dir, stat + '.nii.gz'))
+        if prefix == 'zstat':
+            _save(cope, affine, os.path.join(stats_dir, 'cope%d.nii.gz' % num))
+            _save(np.abs(cope / (zstat + 10)) + 1, affine,
+                  os.path.join(stats_dir, 'varcope%d.nii.gz' % num))
+
+        thresh = np.where(zstat > z_thresh, zstat, 0).astype(np.float32)
+        _save(thresh, affine, os.path.join(
+            analysis_dir, 'thresh_' + prefix + '%d.nii.gz' % num))
+        _write_png(os.path.join(
+            analysis_dir, 'rendered_thresh_' + prefix + '%d.png' % num))
+
+        cl_rows, cfmt, lm_rows, lfmt = _cluster_tables(
+            thresh, cope, affine, units)
+        sfx = '' if first_level else '_std'
+        cl_hdr = [h.format(u=units) for h in CLUSTER_HDR]
+        _write_table(os.path.join(
+            analysis_dir, 'cluster_' + prefix + str(num) + sfx + '.txt'),
+            cl_hdr, cl_rows, cfmt)
+        _write_table(os.path.join(
+            analysis_dir, 'lmax_' + prefix + str(num) + sfx + '.txt'),
+            LMAX_HDR, lm_rows, lfmt)
+
+    with open(os.path.join(logs_dir, 'feat4_post'), 'w') as fid:
+        fid.write(_feat4_post(stats, first_level))
+
+    if not verbose_smoothness:
+        # Residuals smoothed as described in stats/smoothness and the
+        # smoothest command run by FEAT, so that the noise FWHM can be
+        # estimated
+        sigma = np.array(FWHM_VX) / np.sqrt(8 * np.log(2))
+        res4d = np.stack([scipy.ndimage.gaussian_filter(
+            rng.normal(0, 1, shape), sigma) for t in range(num_points)], -1)
+        _save((res4d * mask[..., np.newaxis]).astype(np.float32), affine,
+              os.path.join(stats_dir, 'res4d.nii.gz'))
+        log_name = 'feat3_stats' if first_level else 'feat3c_flame'
+        with open(os.path.join(logs_dir, log_name), 'w') as fid:
+            fid.write('smoothest -d ' + str(dof) + ' -m mask -r stats/res4d '
+                      '> stats/smoothness\n')
+
+
+def make_feat_dir(path, shape=(20, 24, 20), num_evs=2, num_contrasts=2,
+                  num_ftests=1, num_clusters=3, num_points=20,
+                  verbose_smoothness=True, seed=0):
+    """
+    Write a synthetic first-level FEAT directory at 'path' and return its
+    path. The design has 'num_evs' EVs (with custom onset files),
+    'num_contrasts' T-contrasts and 'num_ftests' F-tests (over all
+    T-contrasts), each statistic map has about 'num_clusters' clusters in a
+    volume of size 'shape' and the functional data has 'num_points' volumes.
+    """
+    rng = np.random.RandomState(seed)
+    contrasts = [[int(i == c % num_evs) for i in range(num_evs)]
+                 for c in range(num_contrasts)]
+    ftests = [list(range(1, num_contrasts + 1))] * num_ftests
+    _write_analysis(path, tuple(shape), SUB_AFFINE, num_evs, contrasts,
+                    ftests, num_clusters, True, rng, num_points,
+                    verbose_smoothness)
+
+    onset_dir = os.path.join(path, 'custom_timing_files')
+    os.makedirs(onset_dir)
+    for ev in range(1, num_evs + 1):
+        np.savetxt(os.path.join(onset_dir, 'ev%d.txt' % ev),
+                   [[10 * i, 2, 1] for i in range(1, 5)], fmt='%g')
+    with open(os.path.join(path, 'design.fsf'), 'w') as fid:
+        fid.write(_design_fsf(1, num_evs, contrasts, ftests, onset_dir))
+    return path
+
+
+def make_gfeat_dir(path, shape=(20, 24, 20), num_copes=2, num_clusters=3,
+                   num_subjects=5, verbose_smoothness=True, seed=0,
+                   num_contrasts=1):
+    """
+    Write a synthetic higher-level FEAT directory at 'path' and return its
+    path. There is one cope*.feat analysis directory per lower-level cope
+    ('num_copes'), each with 'num_contrasts' contrasts on the group mean of
+    'num_subjects' subjects (alternatively positive and negative).
+    """
+    rng = np.random.RandomState(seed)
+    contrasts = [[1 - 2 * (c % 2)] for c in range(num_contrasts)]
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for cope in range(1, num_copes + 1):
+        _write_analysis(os.path.join(path, 'cope%d.feat' % cope),
+                        tuple(shape), STD_AFFINE, 1, contrasts, [],
+                        num_clusters, False, rng, num_subjects,
+                        verbose_smoothness)
+    with open(os.path.join(path, 'design.fsf'), 'w') as fid:
+        fid.write(_design_fsf(2, 1, contrasts, [], num_copes=num_copes))
+    return path
+
+
+def convert_images(path, ext='.nii'):
+    """
+    Convert the images of the FEAT directory 'path' (written by the
+    functions above as .nii.gz) to another FSL output type, given by its
+    extension (".nii" for NIFTI or ".hdr" for NIFTI_PAIR).
+    """
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            if name.endswith('.nii.gz'):
+                img_file = os.path.join(root, name)
+                img = nib.load(img_file)
+                if ext == '.hdr':
+                    img = nib.Nifti1Pair.from_image(img)
+                nib.save(img, img_file[:-len('.nii.gz')] + ext)
+                os.remove(img_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic FSL feat directories.')
+    parser.add_argument('out_dir', help='Path to output feat directory.')
+    parser.add_argument('--gfeat', action='store_true',
+                        help='Create a higher-level (.gfeat) directory.')
+    parser.add_argument('--shape', type=int, nargs=3, default=[20, 24, 20],
+                        help='Volume size in voxels (default: 20 24 20).')
+    parser.add_argument('--evs', type=int, default=2,
+                        help='Number of EVs of a first-level design.')
+    parser.add_argument('--contrasts', type=int, default=None,
+                        help='Number of T-contrasts (default: 2 for a '
+                        'first-level and 1 for a higher-level analysis).')
+    parser.add_argument('--ftests', type=int, default=1,
+                        help='Number of F-tests of a first-level design.')
+    parser.add_argument('--clusters', type=int, default=3,
+                        help='Number of clusters per statistic map.')
+    parser.add_argument('--copes', type=int, default=2,
+                        help='Number of cope*.feat directories of a .gfeat.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random number generator.')
+    parser.add_argument('--uncompressed', action='store_true',
+                        help='Write uncompressed images (.nii) as with '
+                        'FSLOUTPUTTYPE=NIFTI.')
+    args = parser.parse_args()
+
+    if args.gfeat:
+        make_gfeat_dir(args.out_dir, args.shape, args.copes, args.clusters,
+                       seed=args.seed, num_contrasts=args.contrasts or 1)
+    else:
+        make_feat_dir(args.out_dir, args.shape, num_evs=args.evs,
+                      num_contrasts=args.contrasts or 2,
+                      num_ftests=args.ftests, num_clusters=args.clusters,
+                      seed=args.seed)
+    if args.uncompressed:
+        convert_images(args.out_dir)
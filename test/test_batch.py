@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Test of the batch export of FEAT directories
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+import os
+import shutil
+import tempfile
+
+from nidmfsl.fsl_exporter.batch import BatchItem, read_batch_file, \
+    run_batch, get_output_path, get_output_paths, discover_feat_dirs, \
+    estimate_cost
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_batch_file(self):
+        """
+        Test: Check that FEAT directories and per-item groups are read from
+        a batch file.
+        """
+        batch_file = os.path.join(self.tmp_dir, 'exports.txt')
+        with open(batch_file, 'w') as fid:
+            fid.write('# First-level\n'
+                      '/data/sub01.feat\n'
+                      '\n'
+                      '"/data/group analysis.gfeat" control 12 patient 10\n')
+
+        self.assertEqual(read_batch_file(batch_file), [
+            BatchItem('/data/sub01.feat', None),
+            BatchItem('/data/group analysis.gfeat',
+                      [['control', '12'], ['patient', '10']])])
+
+        with open(batch_file, 'w') as fid:
+            fid.write('/data/group.gfeat control\n')
+        self.assertRaises(Exception, read_batch_file, batch_file)
+
+    def test_failures_are_isolated(self):
+        """
+        Test: Check that failing exports are reported in the summary without
+        stopping the other exports.
+        """
+        existing_dir = os.path.join(self.tmp_dir, 'done.feat')
+        os.mkdir(existing_dir)
+        with open(get_output_path(existing_dir), 'w') as fid:
+            fid.write('previous export')
+
+        items = [BatchItem(os.path.join(self.tmp_dir, 'missing.feat'), None),
+                 BatchItem(existing_dir, None)]
+
+        for jobs in (1, 2):
+            summaries = run_batch(items, jobs=jobs)
+
+            self.assertEqual([s['feat_dir'] for s in summaries],
+                             [item.feat_dir for item in items])
+            self.assertEqual([s['status'] for s in summaries],
+                             ['failure', 'failure'])
+            self.assertIn('No such a directory', summaries[0]['error'])
+            self.assertIn('already exists', summaries[1]['error'])
+            self.assertTrue(all(s['output'] is None for s in summaries))
+
+    def test_several_versions(self):
+        """
+        Test: Check that the packs of each version are checked before
+        exporting several versions in batch mode.
+        """
+        feat_dir = os.path.join(self.tmp_dir, 'sub.feat')
+        os.mkdir(feat_dir)
+        self.assertEqual(get_output_paths(feat_dir), [
+            get_output_path(feat_dir)])
+        outputs = get_output_paths(feat_dir, version=["1.2.0", "1.3.0-rc2"])
+        self.assertEqual(outputs, [
+            os.path.join(feat_dir, 'sub.feat_120.nidm.zip'),
+            os.path.join(feat_dir, 'sub.feat_130.nidm.zip')])
+
+        with open(outputs[1], 'w') as fid:
+            fid.write('previous export')
+        summary, = run_batch([BatchItem(feat_dir, None)],
+                             version=["1.2.0", "1.3.0"])
+        self.assertEqual(summary['status'], 'failure')
+        self.assertIn(outputs[1] + ' already exists', summary['error'])
+
+    def test_failed_overwrite(self):
+        """
+        Test: Check that a previous export is kept when its replacement
+        fails.
+        """
+        feat_dir = self._make_feat_dir(os.path.join(self.tmp_dir, 'sub.feat'))
+        output = get_output_path(feat_dir)
+        with open(output, 'w') as fid:
+            fid.write('previous export')
+
+        summary, = run_batch([BatchItem(feat_dir, None)], overwrite=True)
+
+        self.assertEqual(summary['status'], 'failure')
+        with open(output, 'r') as fid:
+            self.assertEqual(fid.read(), 'previous export')
+        self.assertEqual(sorted(os.listdir(feat_dir)),
+                         ['design.fsf', 'stats', 'sub.feat.nidm.zip'])
+
+    def _make_feat_dir(self, path, level=1, image_size=10):
+        if level == 1:
+            stat_dir = os.path.join(path, 'stats')
+        else:
+            stat_dir = os.path.join(path, 'cope1.feat', 'stats')
+        os.makedirs(stat_dir)
+        with open(os.path.join(path, 'design.fsf'), 'w') as fid:
+            fid.write('set fmri(level) ' + str(level) + '\n')
+        with open(os.path.join(stat_dir, 'zstat1.nii.gz'), 'wb') as fid:
+            fid.write(b'0' * image_size)
+        return path
+
+    def test_discover_feat_dirs(self):
+        """
+        Test: Check that completed FEAT directories are found under a study
+        root and that groups are only given to group analyses.
+        """
+        run = self._make_feat_dir(
+            os.path.join(self.tmp_dir, 'sub-01', 'run-1.feat'))
+        # Nested analyses are not reported
+        self._make_feat_dir(os.path.join(run, 'reg', 'nested.feat'))
+        group = self._make_feat_dir(
+            os.path.join(self.tmp_dir, 'group', 'all.gfeat'), level=2)
+        # Incomplete FEAT directory
+        os.makedirs(os.path.join(self.tmp_dir, 'sub-02', 'run-1.feat'))
+
+        groups = [['control', '12']]
+        self.assertEqual(discover_feat_dirs(self.tmp_dir, groups), [
+            BatchItem(group, groups), BatchItem(run, None)])
+
+    def test_estimate_cost(self):
+        """
+        Test: Check that larger FEAT directories have a higher estimated
+        cost.
+        """
+        small = self._make_feat_dir(os.path.join(self.tmp_dir, 'small.feat'))
+        large = self._make_feat_dir(
+            os.path.join(self.tmp_dir, 'large.gfeat'), level=2,
+            image_size=1000)
+
+        self.assertEqual(estimate_cost(small), 10)
+        self.assertEqual(estimate_cost(large), 1000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Test of the comparison of benchmark results with their baseline
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+import os
+import sys
+
+# Add the test directory (with the benchmark) to python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from benchmark import compare
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_compare(self):
+        """
+        Test: Check that only significant increases of durations and peak
+        memory are reported as regressions.
+        """
+        baseline = {'small/feat': {'parse': 1.0, 'export': 0.01,
+                                   'peak_rss': 100e6}}
+        results = {'small/feat': {'parse': 1.2, 'export': 0.02,
+                                  'peak_rss': 100e6},
+                   'huge/feat': {'parse': 100.0}}
+        self.assertEqual(compare(results, baseline), ([], []))
+
+        results['small/feat']['parse'] = 1.5
+        results['small/feat']['peak_rss'] = 200e6
+        regressions, warnings = compare(results, baseline, threshold=0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertEqual(warnings, [])
+        self.assertIn('small/feat parse: 1.5 (baseline: 1, +50%)',
+                      regressions)
+        self.assertEqual(compare(results, baseline, threshold=1.5),
+                         ([], []))
+
+    def test_compare_short(self):
+        """
+        Test: Check that slowdowns of sub-second phases are only reported as
+        warnings, except for the durations of parse() and export() and
+        beyond the noise margin.
+        """
+        baseline = {'small/feat': {'parse': 0.3, 'export': 0.5,
+                                   'cluster_labels_maps': 0.02,
+                                   'clusters_peaks': 0.2}}
+        results = {'small/feat': {'parse': 0.6, 'export': 0.55,
+                                  'cluster_labels_maps': 0.1,
+                                  'clusters_peaks': 0.4}}
+        regressions, warnings = compare(results, baseline)
+        self.assertEqual(regressions,
+                         ['small/feat parse: 0.6 (baseline: 0.3, +100%)'])
+        self.assertEqual(
+            warnings,
+            ['small/feat clusters_peaks: 0.4 (baseline: 0.2, +100%)'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Test of the cache of the analyses extracted from FEAT directories
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+
+from nidmfsl.fsl_exporter.analysis import AnalysisContext, ExcursionSetFile
+from nidmfsl.fsl_exporter.tables import FSLTable
+from nidmfsl.fsl_exporter.cache import fingerprint, store_analyses, \
+    load_analyses, evict
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.derived_dir = os.path.join(self.tmp_dir, 'derived')
+        os.mkdir(self.cache_dir)
+        os.mkdir(self.derived_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _context(self, size=4):
+        analysis_dir = os.path.join(self.tmp_dir, 'sub.feat')
+        labels_map = os.path.join(self.derived_dir, 'ClusterLabels.nii.gz')
+        with open(labels_map, 'wb') as fid:
+            fid.write(b'0' * size)
+        cluster_file = os.path.join(analysis_dir, 'cluster_zstat1.txt')
+        table = FSLTable(['Cluster Index', 'Voxels\n'],
+                         np.array([[2., 30.], [1., 12.]]))
+        return AnalysisContext(
+            analysis_dir,
+            [ExcursionSetFile(
+                os.path.join(analysis_dir, 'thresh_zstat1.nii.gz'), 1, 'T',
+                '', labels_map)],
+            np.eye(3), connectivity=26, peak_dist=0.0, num_peaks=3,
+            prob_thresh=0.05, z_thresh=2.3, thresh_type=2,
+            search_space={'vol_in_voxels': 1000, 'noise_roughness': 1.5},
+            residuals_file=os.path.join(analysis_dir, 'stats',
+                                        'sigmasquareds.nii.gz'),
+            grand_mean_median=np.float64(10000.0),
+            tables={cluster_file: table})
+
+    def test_store_load(self):
+        """
+        Test: Check that the analyses and their derived maps are restored
+        from the cache.
+        """
+        manifest = {'files': {'design.fsf': {'size': 10, 'mtime': 1}}}
+        key = fingerprint(manifest, {'native_smoothness': False})
+        self.assertNotEqual(
+            key, fingerprint(manifest, {'native_smoothness': True}))
+        self.assertIsNone(
+            load_analyses(self.cache_dir, key, self.derived_dir))
+
+        context = self._context()
+        store_analyses(self.cache_dir, key, [context], self.derived_dir)
+        shutil.rmtree(self.derived_dir)
+        os.mkdir(self.derived_dir)
+
+        loaded, = load_analyses(self.cache_dir, key, self.derived_dir)
+        self.assertEqual(loaded.analysis_dir, context.analysis_dir)
+        self.assertEqual(loaded.excursion_sets, context.excursion_sets)
+        self.assertTrue(
+            os.path.isfile(loaded.excursion_sets[0].cluster_labels_map))
+        self.assertTrue(np.array_equal(loaded.design_matrix, np.eye(3)))
+        self.assertEqual(loaded.residuals_file, context.residuals_file)
+        self.assertEqual(loaded.search_space, context.search_space)
+        self.assertEqual(loaded.grand_mean_median, 10000.0)
+        for path, table in context.tables.items():
+            self.assertEqual(loaded.tables[path].header, table.header)
+            self.assertTrue(np.array_equal(loaded.tables[path].data,
+                                           table.data))
+
+    def test_read_only(self):
+        """
+        Test: Check that an entry whose last use cannot be recorded (e.g.
+        read-only cache) is a cache miss leaving no derived map behind.
+        """
+        store_analyses(self.cache_dir, 'a', [self._context()],
+                       self.derived_dir)
+        shutil.rmtree(self.derived_dir)
+        os.mkdir(self.derived_dir)
+
+        def utime(path, times):
+            raise OSError(30, 'Read-only file system', path)
+
+        os_utime = os.utime
+        os.utime = utime
+        try:
+            self.assertIsNone(
+                load_analyses(self.cache_dir, 'a', self.derived_dir))
+        finally:
+            os.utime = os_utime
+        self.assertEqual(os.listdir(self.derived_dir), [])
+
+    def test_evict(self):
+        """
+        Test: Check that the least recently used entries are evicted when
+        the cache is too large.
+        """
+        now = time.time()
+        for num, key in enumerate(('a', 'b', 'c')):
+            store_analyses(self.cache_dir, key, [self._context(1000)],
+                           self.derived_dir)
+            entry_dir = os.path.join(self.cache_dir, key)
+            os.utime(entry_dir, (now - 100 + num, now - 100 + num))
+        # 'a' is used again
+        load_analyses(self.cache_dir, 'a', self.derived_dir)
+
+        size = sum(os.path.getsize(os.path.join(self.cache_dir, 'a', f))
+                   for f in os.listdir(os.path.join(self.cache_dir, 'a')))
+        evict(self.cache_dir, 2 * size)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['a', 'c'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Test of the cluster labels map helpers and of the compact storage of
+clusters and peaks
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+import numpy as np
+import scipy.ndimage
+
+from nidmfsl.fsl_exporter.clusters import relabel_clusters, label_dtype, \
+    cluster_lut, connectivity_structure, slab_thickness, ClusterList, \
+    PeakList, SlabLabels
+
+
+class TestRelabelClusters(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        excset = scipy.ndimage.gaussian_filter(
+            rng.normal(size=(30, 30, 30)), 1.5)
+        self.labels, self.num_labels = scipy.ndimage.label(
+            excset > 0.05, np.ones((3, 3, 3)))
+        # One position per component (leaving the last one out of the
+        # table) and FSL-like indices by decreasing size
+        voxels = list()
+        for lab in range(1, self.num_labels):
+            voxels.append(np.argwhere(self.labels == lab)[0])
+        self.voxels = np.array(voxels, dtype=float)
+        self.cluster_ids = np.arange(len(voxels), 0, -1)
+
+    def test_relabel_clusters(self):
+        """
+        Test: Check that each component is given the FSL index of the
+        position it contains and that components missing from the table are
+        numbered after the last FSL index.
+        """
+        relabeled = relabel_clusters(
+            self.labels, self.num_labels, self.voxels, self.cluster_ids)
+
+        for (x, y, z), clid in zip(self.voxels, self.cluster_ids):
+            component = self.labels == self.labels[int(x), int(y), int(z)]
+            self.assertTrue(np.all(relabeled[component] == clid))
+
+        missing = self.labels == self.num_labels
+        self.assertTrue(np.all(relabeled[missing] == self.num_labels))
+        self.assertTrue(np.all(relabeled[self.labels == 0] == 0))
+
+    def test_relabel_clusters_empty_table(self):
+        """
+        Test: Check that an empty cluster table leaves the map unchanged.
+        """
+        relabeled = relabel_clusters(
+            self.labels, self.num_labels, np.zeros((0, 3)), [])
+
+        np.testing.assert_array_equal(relabeled, self.labels)
+
+    def test_relabel_clusters_background(self):
+        """
+        Test: Check that positions outside of the excursion set do not
+        relabel the background.
+        """
+        background = np.argwhere(self.labels == 0)[:1]
+        relabeled = relabel_clusters(
+            self.labels, self.num_labels, background, [1])
+
+        np.testing.assert_array_equal(relabeled, self.labels)
+
+    def test_label_dtype(self):
+        """
+        Test: Check that cluster labels maps are stored in the smallest
+        integer type.
+        """
+        relabeled = relabel_clusters(
+            self.labels, self.num_labels, self.voxels, self.cluster_ids)
+
+        self.assertEqual(relabeled.dtype, np.uint8)
+        self.assertEqual(label_dtype(255), np.uint8)
+        self.assertEqual(label_dtype(256), np.uint16)
+        self.assertEqual(label_dtype(70000), np.int32)
+
+
+class TestSlabLabels(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.excset = scipy.ndimage.gaussian_filter(
+            rng.normal(size=(20, 18, 25)), 1.2) > 0.05
+        self.voxels = np.argwhere(self.excset)[
+            rng.choice(self.excset.sum(), 6, replace=False)]
+
+    def test_connectivity_structure(self):
+        """
+        Test: Check that each connectivity used by FSL gives the expected
+        number of neighbours.
+        """
+        for connectivity in (6, 18, 26):
+            self.assertEqual(
+                connectivity_structure(connectivity).sum(), connectivity + 1)
+        self.assertRaises(Exception, connectivity_structure, 8)
+
+    def test_slab_labels(self):
+        """
+        Test: Check that labeling slab by slab gives the same labels as
+        labeling the whole volume, whatever the connectivity and the
+        thickness of the slabs.
+        """
+        for connectivity in (6, 18, 26):
+            structure = connectivity_structure(connectivity)
+            labels, num_labels = scipy.ndimage.label(self.excset, structure)
+            for thickness in (1, 2, 7, 25):
+                slab_labels = SlabLabels(self.excset, structure, thickness)
+                self.assertEqual(slab_labels.num_labels, num_labels)
+                np.testing.assert_array_equal(
+                    np.concatenate(list(slab_labels.slabs()), axis=2),
+                    labels)
+
+    def test_slab_relabel_clusters(self):
+        """
+        Test: Check that clusters labeled slab by slab are given the same
+        FSL indices as when labeled in memory.
+        """
+        structure = connectivity_structure(26)
+        labels, num_labels = scipy.ndimage.label(self.excset, structure)
+        cluster_ids = np.arange(len(self.voxels), 0, -1)
+        relabeled = relabel_clusters(
+            labels, num_labels, self.voxels, cluster_ids)
+
+        slab_labels = SlabLabels(self.excset, structure, 3, self.voxels)
+        lut = cluster_lut(slab_labels.num_labels, slab_labels.components,
+                          cluster_ids)
+        slabs = np.concatenate(list(slab_labels.slabs(lut)), axis=2)
+        self.assertEqual(slabs.dtype, relabeled.dtype)
+        np.testing.assert_array_equal(slabs, relabeled)
+
+    def test_slab_thickness(self):
+        """
+        Test: Check that slabs fit in the memory budget and have at least one
+        plane.
+        """
+        self.assertEqual(slab_thickness((100, 100, 80), 4, 2e6), 10)
+        self.assertEqual(slab_thickness((100, 100, 80), 4, 1), 1)
+
+
+class TestClusterList(unittest.TestCase):
+
+    def test_cluster_list(self):
+        """
+        Test: Check that the Cluster and Peak objects created on access have
+        the values of the tables and that each cluster gets its own peaks in
+        the order of the peak table.
+        """
+        peaks = PeakList(
+            cluster_ids=[2, 2, 1, 2], suffixes=['2_1', '2_2', '1_1', '2_3'],
+            equiv_z=[5.1, 4.2, 3.3, 3.1],
+            coords=[[1, 2, 3], [4, 5, 6], [7, 8, 9], [1, 1, 1]])
+        clusters = ClusterList(
+            cluster_ids=[2, 1], sizes=[120, 45], peaks=peaks,
+            p_fwers=[1e-8, 0.001], cogs_std=[[1.5, -2, 3], [4, 5, 6.25]])
+
+        self.assertEqual(len(clusters), 2)
+        self.assertEqual(len(peaks), 4)
+        self.assertEqual([c.num for c in clusters], [2, 1])
+
+        cluster = clusters[0]
+        self.assertEqual(cluster.size, 120)
+        self.assertEqual(cluster.pFWER, 1e-8)
+        self.assertEqual([p.label for p in cluster.peaks],
+                         ['Peak 2_1', 'Peak 2_2', 'Peak 2_3'])
+        self.assertEqual([p.equiv_z for p in cluster.peaks], [5.1, 4.2, 3.1])
+        self.assertIsNone(cluster.cog)
+
+        # Centres of gravity are only reported with positions in voxels
+        clusters.cogs = np.array([[10.5, 11, 12], [1, 2, 3]])
+        clusters.release()
+        self.assertEqual(clusters[1].peaks[0].label, 'Peak 1_1')
+        self.assertEqual(
+            list(clusters[1].cog.coordinate.coord_vector_std),
+            [4, 5, 6.25])
+
+    def test_cluster_list_identity(self):
+        """
+        Test: Check that each access to a cluster or a peak returns the same
+        object (with the same identifier) until the list is released.
+        """
+        peaks = PeakList(cluster_ids=[1, 1, 2], suffixes=['1_1', '1_2', '2_1'],
+                         equiv_z=[5.1, 4.2, 3.3])
+        clusters = ClusterList(cluster_ids=[1, 2], sizes=[120, 45],
+                               peaks=peaks)
+
+        first = list(clusters)
+        self.assertIs(clusters[0], clusters[0])
+        self.assertIs(clusters[-1], first[1])
+        self.assertEqual([c.id for c in clusters], [c.id for c in first])
+        self.assertEqual([p.id for p in clusters[0].peaks],
+                         [peaks.peak(0).id, peaks.peak(1).id])
+
+        clusters.release()
+        self.assertIsNot(clusters[0], first[0])
+        self.assertIsNot(clusters[0].peaks[0], first[0].peaks[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Test of the design.fsf parser
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+
+from nidmfsl.fsl_exporter.fsf import FSFDesign
+
+DESIGN_TXT = """
+# FEAT version number
+set fmri(version) 6.00
+
+# Analysis level
+set fmri(level) 1
+
+# Z threshold
+set fmri(z_thresh) 2.3
+
+# set fmri(thresh) 0
+set fmri(thresh) 3
+
+# EV 1 title
+set fmri(evtitle1) "motor"
+set fmri(evtitle10) "visual"
+set fmri(evtitle2) "auditory task"
+
+# Real contrast_real vector 1 element 2
+set fmri(con_real1.2) -1.0
+set fmri(con_real1.1) 1.0
+set fmri(con_real12.1) 0
+
+set fmri(conmask1_2) 1
+set fmri(conmask1_1) 0
+
+set feat_files(1) "/data/sub01/filtered_func_data"
+set fmri(regstandard) /usr/share/fsl/data/standard/MNI152_T1_2mm_brain
+"""
+
+
+class TestFSFDesign(unittest.TestCase):
+
+    def setUp(self):
+        self.fsf = FSFDesign(DESIGN_TXT)
+
+    def test_typed_values(self):
+        """
+        Test: Check that values are converted to ints, floats or strings and
+        that raw values are kept.
+        """
+        self.assertEqual(self.fsf.get('fmri(level)'), 1)
+        self.assertEqual(self.fsf.get('fmri(z_thresh)'), 2.3)
+        self.assertEqual(self.fsf.get('fmri(version)'), 6.0)
+        self.assertEqual(self.fsf.raw('fmri(version)'), '6.00')
+        self.assertEqual(self.fsf.get('fmri(evtitle2)'), 'auditory task')
+        self.assertEqual(self.fsf.get('fmri(regstandard)'),
+                         '/usr/share/fsl/data/standard/MNI152_T1_2mm_brain')
+        self.assertEqual(self.fsf.get('feat_files(1)'),
+                         '/data/sub01/filtered_func_data')
+
+    def test_comments_and_missing(self):
+        """
+        Test: Check that commented lines are ignored and that missing
+        variables return the default value.
+        """
+        self.assertEqual(self.fsf.get('fmri(thresh)'), 3)
+        self.assertIsNone(self.fsf.get('fmri(prob_thresh)'))
+        self.assertEqual(self.fsf.raw('fmri(prob_thresh)', '0.05'), '0.05')
+        self.assertNotIn('fmri(prob_thresh)', self.fsf)
+        self.assertIn('fmri(level)', self.fsf)
+
+    def test_families(self):
+        """
+        Test: Check that array elements are returned sorted by index.
+        """
+        self.assertEqual(self.fsf.vector('fmri(con_real1.*)'), [1.0, -1.0])
+        self.assertEqual(self.fsf.vector('fmri(con_real1.*)', raw=True),
+                         ['1.0', '-1.0'])
+        self.assertEqual(self.fsf.vector('fmri(con_real12.*)'), [0])
+        self.assertEqual(self.fsf.items('fmri(evtitle*)'),
+                         [(1, 'motor'), (2, 'auditory task'), (10, 'visual')])
+        self.assertEqual(self.fsf.items('fmri(conmask1_*)'), [(1, 0), (2, 1)])
+        self.assertEqual(self.fsf.vector('fmri(ftest_real1.*)'), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Test of the access to images and to their geometries
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+import os
+import gzip
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+
+from nidmfsl.fsl_exporter.images import read_geometry, image_file, \
+    image_files, load_data, compress_image, save_image, save_slabs
+
+
+class TestReadGeometry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.img_file = os.path.join(self.tmp_dir, 'zstat1.nii.gz')
+        affine = np.array([[-2., 0., 0., 90.],
+                           [0., 2., 0., -126.],
+                           [0., 0., 2., -72.],
+                           [0., 0., 0., 1.]])
+        nib.save(nib.Nifti1Image(np.zeros((5, 6, 7), dtype=np.float32),
+                                 affine), self.img_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_geometry_from_header(self):
+        """
+        Test: Check that the geometry read from the header matches the one
+        of the loaded image.
+        """
+        img = nib.load(self.img_file)
+        geometry = read_geometry(self.img_file)
+
+        self.assertEqual(geometry.shape, img.shape)
+        np.testing.assert_array_equal(geometry.affine, img.affine)
+        np.testing.assert_array_equal(geometry.qform, img.get_qform())
+        self.assertEqual(geometry.zooms, img.header.get_zooms())
+
+    def test_geometry_cache(self):
+        """
+        Test: Check that geometries are cached until the image is modified.
+        """
+        geometry = read_geometry(self.img_file)
+        self.assertIs(read_geometry(self.img_file), geometry)
+
+        nib.save(nib.Nifti1Image(np.zeros((3, 3, 3, 2), dtype=np.float32),
+                                 np.eye(4)), self.img_file)
+        # Make sure the modification time changes
+        stat = os.stat(self.img_file)
+        os.utime(self.img_file, (stat.st_atime, stat.st_mtime + 10))
+
+        self.assertEqual(read_geometry(self.img_file).shape, (3, 3, 3, 2))
+
+
+class TestImageFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data = np.arange(60, dtype=np.float32).reshape((3, 4, 5))
+        self.img = nib.Nifti1Image(self.data, np.diag([2., 2., 2., 1.]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_image_file(self):
+        """
+        Test: Check that images are found whatever their FSL output type and
+        that the ".nii.gz" extension is used when no file exists.
+        """
+        base = os.path.join(self.tmp_dir, 'zstat1')
+        self.assertEqual(image_file(base), base + '.nii.gz')
+
+        nib.save(self.img, base + '.nii')
+        self.assertEqual(image_file(base), base + '.nii')
+        self.assertEqual(image_file(base + '.nii'), base + '.nii')
+
+        nib.save(nib.Nifti1Pair.from_image(self.img),
+                 os.path.join(self.tmp_dir, 'thresh_zstat2.hdr'))
+        nib.save(self.img, os.path.join(self.tmp_dir, 'thresh_zstat1.nii'))
+        nib.save(self.img, os.path.join(self.tmp_dir, 'thresh_zstat1.nii.gz'))
+        self.assertEqual(
+            sorted(os.path.basename(f) for f in image_files(
+                os.path.join(self.tmp_dir, 'thresh_zstat*'))),
+            ['thresh_zstat1.nii.gz', 'thresh_zstat2.hdr'])
+
+    def test_load_data(self):
+        """
+        Test: Check that uncompressed images are memory-mapped and that
+        compressed images are read in memory, with the same data.
+        """
+        nii_file = os.path.join(self.tmp_dir, 'mask.nii')
+        nib.save(self.img, nii_file)
+        data = load_data(nii_file)
+        self.assertIsInstance(data, np.memmap)
+        np.testing.assert_array_equal(data, self.data)
+
+        gz_file = os.path.join(self.tmp_dir, 'mask.nii.gz')
+        nib.save(self.img, gz_file)
+        np.testing.assert_array_equal(load_data(gz_file), self.data)
+
+    def test_compress_image(self):
+        """
+        Test: Check that NIfTI-1 single files and image pairs are written as
+        gzipped NIfTI-1 files with the same data and geometry.
+        """
+        for ext in ('.nii', '.hdr'):
+            path = os.path.join(self.tmp_dir, 'cope1' + ext)
+            if ext == '.hdr':
+                nib.save(nib.Nifti1Pair.from_image(self.img), path)
+            else:
+                nib.save(self.img, path)
+            new_file = os.path.join(self.tmp_dir, 'Contrast' + ext + '.nii.gz')
+            compress_image(path, new_file)
+
+            img = nib.load(new_file)
+            self.assertIsInstance(img, nib.Nifti1Image)
+            np.testing.assert_array_equal(img.get_fdata(), self.data)
+            np.testing.assert_array_equal(img.affine, self.img.affine)
+
+    def test_save_image(self):
+        """
+        Test: Check that images are saved as by nibabel at any compression
+        level.
+        """
+        nib_file = os.path.join(self.tmp_dir, 'nib.nii.gz')
+        nib.save(self.img, nib_file)
+        with gzip.open(nib_file, 'rb') as fid:
+            nib_bytes = fid.read()
+
+        sizes = list()
+        for compresslevel in (None, 0, 9):
+            img_file = os.path.join(self.tmp_dir, 'labels.nii.gz')
+            save_image(self.img, img_file, compresslevel)
+            with gzip.open(img_file, 'rb') as fid:
+                self.assertEqual(fid.read(), nib_bytes)
+            sizes.append(os.path.getsize(img_file))
+        self.assertGreater(sizes[1], sizes[0])
+        self.assertGreater(sizes[0], sizes[2])
+
+    def test_save_slabs(self):
+        """
+        Test: Check that an image saved slab by slab is identical to the one
+        saved by nibabel.
+        """
+        data = (self.data % 7).astype(np.uint8)
+        nib_file = os.path.join(self.tmp_dir, 'nib.nii.gz')
+        nib.save(nib.Nifti1Image(data, self.img.affine), nib_file)
+
+        slabs_file = os.path.join(self.tmp_dir, 'slabs.nii.gz')
+        save_slabs(slabs_file, [data[:, :, :2], data[:, :, 2:]], data.shape,
+                   data.dtype, self.img.affine)
+
+        nib_img = nib.load(nib_file)
+        slabs_img = nib.load(slabs_file)
+        self.assertEqual(slabs_img.header.binaryblock,
+                         nib_img.header.binaryblock)
+        np.testing.assert_array_equal(slabs_img.dataobj, data)
+
+if __name__ == '__main__':
+    unittest.main()
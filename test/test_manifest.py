@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Test of the manifest of the inputs of an export
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+import os
+import shutil
+import tempfile
+
+from nidmfsl.fsl_exporter.manifest import input_files, build_manifest, \
+    read_manifest, write_manifest, manifest_matches
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.feat_dir = os.path.join(self.tmp_dir, 'analysis.feat')
+        os.makedirs(os.path.join(self.feat_dir, 'stats'))
+        self.options = {'version': '1.3.0', 'groups': None}
+
+        for name in ('design.fsf', 'thresh_zstat1.nii.gz',
+                     os.path.join('stats', 'zstat1.nii.gz'),
+                     # Written by the exporter itself
+                     'tmp_clustmap1.nii.gz', 'cluster_zstat1_std_sub.txt',
+                     os.path.join('stats', 'smoothness_v'),
+                     # Not read by the exporter
+                     'report.html'):
+            self._write(name, 'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.feat_dir, name)
+        with open(path, 'w') as fid:
+            fid.write(content)
+        return path
+
+    def _manifest(self, hashes=False, options=None):
+        return build_manifest(
+            self.feat_dir, input_files(self.feat_dir), options or self.options,
+            hashes=hashes)
+
+    def test_input_files(self):
+        """
+        Test: Check that only the FSL outputs read by the exporter are listed.
+        """
+        self.assertEqual(
+            [os.path.relpath(f, self.feat_dir)
+             for f in input_files(self.feat_dir)],
+            ['design.fsf', os.path.join('stats', 'zstat1.nii.gz'),
+             'thresh_zstat1.nii.gz'])
+
+    def test_manifest_matches(self):
+        """
+        Test: Check that a saved manifest matches unchanged inputs and options
+        only.
+        """
+        manifest_file = os.path.join(self.tmp_dir, 'manifest.json')
+        write_manifest(manifest_file, self._manifest())
+        saved = read_manifest(manifest_file)
+
+        self.assertTrue(manifest_matches(saved, self._manifest()))
+        self.assertFalse(manifest_matches(None, self._manifest()))
+        self.assertFalse(manifest_matches(
+            saved, self._manifest(options={'version': '1.2.0'})))
+
+        self._write('lmax_zstat1_std.txt', 'peaks')
+        self.assertFalse(manifest_matches(saved, self._manifest()))
+
+    def test_modified_input(self):
+        """
+        Test: Check that a modified input is detected from its modification
+        time unless its content is unchanged and hashes are computed.
+        """
+        saved = self._manifest(hashes=True)
+        stat_file = os.path.join(self.feat_dir, 'stats', 'zstat1.nii.gz')
+        stat = os.stat(stat_file)
+        os.utime(stat_file, (stat.st_atime, stat.st_mtime + 10))
+
+        self.assertFalse(manifest_matches(saved, self._manifest()))
+        self.assertTrue(manifest_matches(saved, self._manifest(hashes=True)))
+
+        self._write(os.path.join('stats', 'zstat1.nii.gz'), 'atad')
+        self.assertFalse(
+            manifest_matches(saved, self._manifest(hashes=True)))
+
+if __name__ == '__main__':
+    unittest.main()
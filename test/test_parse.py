@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+"""
+Test of the parsing of synthetic FEAT directories (no network access nor
+FSL installation is needed to parse a FEAT directory)
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import warnings
+import numpy as np
+import nibabel as nib
+
+from nidmfsl.fsl_exporter import fsl_exporter, analysis
+from nidmfsl.fsl_exporter.fsl_exporter import FSLtoNIDMExporter
+
+# Add the test directory (with the generator) to python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from synthetic_feat import make_feat_dir, make_gfeat_dir, convert_images
+
+
+class TestParse(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.feat_dir = make_feat_dir(
+            os.path.join(self.tmp_dir, 'sub.feat'), num_contrasts=1,
+            num_ftests=0)
+        # Only needed to be set for first-level analyses
+        self.fsl_dir = os.environ.get('FSLDIR')
+        os.environ['FSLDIR'] = self.tmp_dir
+
+    def tearDown(self):
+        if self.fsl_dir is None:
+            del os.environ['FSLDIR']
+        else:
+            os.environ['FSLDIR'] = self.fsl_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def _parse(self, version="1.3.0", **kwargs):
+        exporter = FSLtoNIDMExporter(
+            self.feat_dir, version=version, **kwargs)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                exporter.parse()
+            # Derived maps are written as exported files
+            for context in exporter.analysis_contexts.values():
+                for excursion_set in context.excursion_sets:
+                    self.assertEqual(
+                        os.path.dirname(excursion_set.cluster_labels_map),
+                        exporter.derived_dir)
+                    self.assertTrue(
+                        os.path.isfile(excursion_set.cluster_labels_map))
+        finally:
+            exporter.cleanup()
+
+        inferences = [inference for con_inferences in
+                      exporter.inferences.values()
+                      for inference in con_inferences]
+        self.assertEqual(len(inferences), 1)
+        return inferences[0].clusters
+
+    def test_subject_space_tables(self):
+        """
+        Test: Check that the positions of the peaks of first-level analyses
+        in subject-space mm are computed without writing tables in the feat
+        directory, unless requested.
+        """
+        clusters = self._parse()
+        self.assertEqual(
+            glob.glob(os.path.join(self.feat_dir, '*_sub.txt')), [])
+
+        affine = nib.load(os.path.join(
+            self.feat_dir, 'filtered_func_data.nii.gz')).affine
+        peaks = [peak for cluster in clusters for peak in cluster.peaks]
+        self.assertTrue(peaks)
+        for peak in peaks:
+            self.assertTrue(np.allclose(
+                nib.affines.apply_affine(
+                    affine, peak.coordinate.coord_vector),
+                peak.coordinate.coord_vector_std))
+
+        sub_clusters = self._parse(write_sub_tables=True)
+        self.assertEqual(
+            sorted(os.path.basename(f) for f in
+                   glob.glob(os.path.join(self.feat_dir, '*_sub.txt'))),
+            ['cluster_zstat1_sub.txt', 'lmax_zstat1_sub.txt'])
+        self.assertEqual(
+            [c.cog.coordinate.coord_vector_std for c in sub_clusters],
+            [c.cog.coordinate.coord_vector_std for c in clusters])
+
+    def test_peak_labels(self):
+        """
+        Test: Check that the peaks of each cluster are numbered from 1 in the
+        order of the peak table.
+        """
+        clusters = self._parse()
+        self.assertTrue(clusters)
+        for cluster in clusters:
+            self.assertTrue(cluster.peaks)
+            indices = [[int(i) for i in peak.label.split(' ')[1].split('_')]
+                       for peak in cluster.peaks]
+            self.assertEqual(
+                indices, [[cluster.num, i + 1]
+                          for i in range(len(cluster.peaks))])
+
+    def test_analysis_context(self):
+        """
+        Test: Check that the logs and smoothness of an analysis are read (and
+        the smoothness estimated) once for all its contrasts and that all
+        its inferences get the same settings and search space.
+        """
+        feat_dir = make_feat_dir(
+            os.path.join(self.tmp_dir, 'contrasts.feat'), num_contrasts=3,
+            num_ftests=1, verbose_smoothness=False)
+
+        reads = list()
+        estimates = list()
+
+        def counting_open(path, *args, **kwargs):
+            reads.append(os.path.relpath(path, feat_dir))
+            return open(path, *args, **kwargs)
+
+        def estimate_smoothness_from_command(cmd, analysis_dir):
+            estimates.append(analysis_dir)
+            return estimate(cmd, analysis_dir)
+
+        estimate = analysis.estimate_smoothness_from_command
+        analysis.open = counting_open
+        analysis.estimate_smoothness_from_command = \
+            estimate_smoothness_from_command
+        try:
+            exporter = FSLtoNIDMExporter(
+                feat_dir, version="1.3.0", native_smoothness=True)
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    exporter.parse()
+            finally:
+                exporter.cleanup()
+        finally:
+            del analysis.open
+            analysis.estimate_smoothness_from_command = estimate
+
+        self.assertEqual(reads.count(os.path.join('logs', 'feat4_post')), 1)
+        self.assertEqual(reads.count(os.path.join('stats', 'smoothness')), 1)
+        self.assertEqual(estimates, [feat_dir])
+
+        inferences = [inference for con_inferences in
+                      exporter.inferences.values()
+                      for inference in con_inferences]
+        self.assertEqual(len(inferences), 4)
+        settings = set(
+            (i.peak_criteria.peak_dist, i.peak_criteria.num_peak,
+             i.cluster_criteria.connectivity,
+             i.search_space.search_volume_in_voxels,
+             i.search_space.resel_size_in_voxels,
+             i.search_space.noise_fwhm_in_voxels,
+             i.search_space.noise_roughness)
+            for i in inferences)
+        self.assertEqual(len(settings), 1)
+
+    def test_unquoted_custom_value(self):
+        """
+        Test: Check that an unquoted fmri(customN) value in design.fsf is not
+        taken for an onset file.
+        """
+        clusters = self._parse()
+        with open(os.path.join(self.feat_dir, 'design.fsf'), 'a') as fid:
+            fid.write('set fmri(custom9) 2\n')
+
+        self.assertEqual(
+            [(c.num, c.size) for c in self._parse()],
+            [(c.num, c.size) for c in clusters])
+
+    def test_cluster_labels_dtype(self):
+        """
+        Test: Check that the cluster labels maps are written in the smallest
+        integer type that fits the labels (uint8 for a few clusters), whether
+        the excursion set is labeled at once or slab by slab.
+        """
+        for label_memory in (None, 1):
+            exporter = FSLtoNIDMExporter(
+                self.feat_dir, version="1.3.0", label_memory=label_memory)
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    exporter.parse()
+                for context in exporter.analysis_contexts.values():
+                    for excursion_set in context.excursion_sets:
+                        self.assertEqual(
+                            nib.load(excursion_set.cluster_labels_map)
+                            .get_data_dtype(), np.uint8)
+            finally:
+                exporter.cleanup()
+
+    def test_uncompressed_images(self):
+        """
+        Test: Check that a FEAT directory written with FSLOUTPUTTYPE=NIFTI
+        (uncompressed images) is parsed as the gzipped one.
+        """
+        clusters = self._parse()
+        convert_images(self.feat_dir, '.nii')
+        self.assertEqual(
+            glob.glob(os.path.join(self.feat_dir, '*.nii.gz')), [])
+
+        nii_clusters = self._parse()
+        self.assertEqual(
+            [(c.num, c.size, len(c.peaks)) for c in nii_clusters],
+            [(c.num, c.size, len(c.peaks)) for c in clusters])
+
+    def test_scratch_dir(self):
+        """
+        Test: Check that nothing is written in the feat directory when a
+        scratch directory is used and that the scratch directory is cleaned
+        up.
+        """
+        before = sorted(
+            os.path.join(root, name) for root, dirs, files in
+            os.walk(self.feat_dir) for name in dirs + files)
+        scratch_dir = os.path.join(self.tmp_dir, 'scratch')
+        os.mkdir(scratch_dir)
+
+        clusters = self._parse(
+            scratch_dir=scratch_dir,
+            out_dirname=os.path.join(self.tmp_dir, 'out'))
+
+        self.assertTrue(clusters)
+        self.assertEqual(sorted(
+            os.path.join(root, name) for root, dirs, files in
+            os.walk(self.feat_dir) for name in dirs + files), before)
+        self.assertEqual(os.listdir(scratch_dir), [])
+
+    def test_versions(self):
+        """
+        Test: Check that the objects of each NIDM-Results version are built
+        from a single extraction of the analyses, with one pack per version.
+        """
+        clusters = self._parse()
+
+        exporter = FSLtoNIDMExporter(
+            self.feat_dir, version=["1.2.0", "1.3.0"],
+            out_dirname=os.path.join(self.tmp_dir, 'out'))
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                exporter.parse()
+                self.assertEqual(exporter.outputs, [
+                    os.path.join(self.tmp_dir, 'out_120.nidm.zip'),
+                    os.path.join(self.tmp_dir, 'out_130.nidm.zip')])
+                self.assertNotEqual(exporter.export_dir, exporter.derived_dir)
+                self.assertEqual(exporter.version['num'], "1.2.0")
+                subjects = [mf.subjects for mf in
+                            exporter.model_fittings.values()]
+                self.assertEqual(subjects, [None])
+
+                analysis_contexts = exporter.analysis_contexts
+                exporter._set_export(*exporter.exports[1])
+                exporter._parse_version()
+                self.assertIs(exporter.analysis_contexts, analysis_contexts)
+                self.assertEqual(exporter.version['num'], "1.3.0")
+                subjects = [mf.subjects for mf in
+                            exporter.model_fittings.values()]
+                self.assertEqual(len(subjects[0]), 1)
+        finally:
+            exporter.cleanup()
+
+        inferences = [inference for con_inferences in
+                      exporter.inferences.values()
+                      for inference in con_inferences]
+        self.assertEqual(
+            [(c.num, c.size, len(c.peaks)) for c in inferences[0].clusters],
+            [(c.num, c.size, len(c.peaks)) for c in clusters])
+
+    def test_cache(self):
+        """
+        Test: Check that the analyses extracted are reloaded from the cache
+        when the same feat directory is parsed again.
+        """
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        clusters = self._parse(cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        def extract_analysis(task):
+            raise Exception("Analysis extracted again")
+
+        extract = fsl_exporter.extract_analysis
+        fsl_exporter.extract_analysis = extract_analysis
+        try:
+            cached_clusters = self._parse(version="1.2.0",
+                                          cache_dir=cache_dir)
+        finally:
+            fsl_exporter.extract_analysis = extract
+        self.assertEqual(
+            [(c.num, c.size, len(c.peaks)) for c in cached_clusters],
+            [(c.num, c.size, len(c.peaks)) for c in clusters])
+
+    def test_incremental_replace(self):
+        """
+        Test: Check that an out of date pack is kept until it is replaced by
+        the new export.
+        """
+        out_dirname = os.path.join(self.tmp_dir, 'out')
+        pack = out_dirname + '.nidm.zip'
+        with open(pack, 'w') as fid:
+            fid.write('previous export')
+        with open(pack + '.manifest.json', 'w') as fid:
+            fid.write('{}')
+
+        self._parse(out_dirname=out_dirname, incremental=True)
+        with open(pack, 'r') as fid:
+            self.assertEqual(fid.read(), 'previous export')
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), [
+            'out.nidm.zip', 'out.nidm.zip.manifest.json', 'sub.feat'])
+
+    def test_jobs_maps(self):
+        """
+        Test: Check that the derived maps of a group analysis (cluster labels
+        and residual mean squares maps) written by several processes are
+        byte-identical to the ones of a serial parse.
+        """
+        gfeat_dir = make_gfeat_dir(
+            os.path.join(self.tmp_dir, 'group.gfeat'), num_copes=3,
+            num_clusters=4)
+
+        serial = self._parse_outputs(gfeat_dir, groups=[['control', '5']],
+                                     jobs=1)
+        parallel = self._parse_outputs(gfeat_dir, groups=[['control', '5']],
+                                       jobs=2)
+
+        names = sorted(name for name in serial[2] if name.startswith(
+            ('ClusterLabels', 'ResidualMeanSquares')))
+        self.assertEqual(len(names), 6)
+        self.assertEqual(sorted(parallel[2]), sorted(serial[2]))
+        for name in names:
+            self.assertEqual(parallel[2][name], serial[2][name], name)
+        self.assertEqual(parallel[:2], serial[:2])
+
+    def _inferences_summary(self, exporter):
+        summary = list()
+        for con_inferences in exporter.inferences.values():
+            for inference in con_inferences:
+                search_space = inference.search_space
+                clusters = [
+                    (c.num, c.size, c.pFWER, c.punc, c.clust_size_resels,
+                     (list(c.cog.coordinate.coord_vector_std)
+                      if c.cog is not None else None),
+                     [(p.label, p.equiv_z, p.p_unc, p.p_fwer,
+                       list(p.coordinate.coord_vector_std))
+                      for p in c.peaks])
+                    for c in inference.clusters]
+                summary.append((
+                    inference.excursion_set.label,
+                    search_space.search_volume_in_voxels,
+                    search_space.search_volume_in_resels,
+                    search_space.resel_size_in_voxels,
+                    search_space.noise_fwhm_in_voxels,
+                    search_space.noise_fwhm_in_units,
+                    search_space.noise_roughness,
+                    search_space.expected_num_clusters,
+                    search_space.height_critical_fwe05,
+                    clusters))
+        return sorted(summary)
+
+    def _parse_outputs(self, feat_dir, **kwargs):
+        """
+        Parse 'feat_dir' and return the labels of its inferences (in the
+        order of the contrasts and of the inferences of each contrast), the
+        labels of the excursion sets of each analysis and the content of
+        each derived map.
+        """
+        exporter = FSLtoNIDMExporter(feat_dir, version="1.3.0", **kwargs)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                exporter.parse()
+            maps = dict()
+            for name in os.listdir(exporter.derived_dir):
+                with open(os.path.join(exporter.derived_dir, name),
+                          'rb') as fid:
+                    maps[name] = fid.read()
+        finally:
+            exporter.cleanup()
+
+        inferences = [inference.excursion_set.label
+                      for con_inferences in exporter.inferences.values()
+                      for inference in con_inferences]
+        excursion_sets = [
+            [e.stat_num_idx for e in
+             exporter.analysis_contexts[analysis_dir].excursion_sets]
+            for analysis_dir in exporter.analysis_dirs]
+        return inferences, excursion_sets, maps
+
+    def test_threads(self):
+        """
+        Test: Check that the excursion sets of an analysis processed in
+        several threads give the inferences (in the same order) and the
+        cluster labels maps of a single thread, and that no more than 'jobs'
+        threads are used.
+        """
+        feat_dir = make_feat_dir(
+            os.path.join(self.tmp_dir, 'contrasts.feat'), num_contrasts=3,
+            num_ftests=1)
+
+        pool_sizes = list()
+
+        def thread_pool(processes):
+            pool_sizes.append(processes)
+            return ThreadPool(processes)
+
+        ThreadPool = analysis.ThreadPool
+        analysis.ThreadPool = thread_pool
+        try:
+            serial = self._parse_outputs(feat_dir, jobs=1)
+            threaded = self._parse_outputs(feat_dir, jobs=3)
+        finally:
+            analysis.ThreadPool = ThreadPool
+
+        self.assertEqual(pool_sizes, [3])
+        self.assertEqual(len(serial[0]), 4)
+        self.assertEqual(
+            sorted(name for name in serial[2]
+                   if name.startswith('ClusterLabels')),
+            ['ClusterLabels_F001.nii.gz', 'ClusterLabels_T001.nii.gz',
+             'ClusterLabels_T002.nii.gz', 'ClusterLabels_T003.nii.gz'])
+        self.assertEqual(threaded, serial)
+
+    def test_threads_per_process(self):
+        """
+        Test: Check that the jobs are shared between the processes (one per
+        analysis directory) and the threads of each process.
+        """
+        gfeat_dir = make_gfeat_dir(
+            os.path.join(self.tmp_dir, 'group.gfeat'), num_copes=2,
+            num_contrasts=3)
+
+        pool_sizes = list()
+
+        def thread_pool(processes):
+            pool_sizes.append(processes)
+            return ThreadPool(processes)
+
+        class SerialPool(object):
+            # Runs the tasks in this process so that threads can be counted
+            def __init__(self, processes):
+                pool_sizes.append(('processes', processes))
+
+            def map(self, func, iterable, chunksize=None):
+                return [func(task) for task in iterable]
+
+            def close(self):
+                pass
+
+            def join(self):
+                pass
+
+        ThreadPool = analysis.ThreadPool
+        Pool = fsl_exporter.multiprocessing.Pool
+        analysis.ThreadPool = thread_pool
+        fsl_exporter.multiprocessing.Pool = SerialPool
+        try:
+            self._parse_outputs(gfeat_dir, groups=[['control', '5']],
+                                jobs=5)
+        finally:
+            analysis.ThreadPool = ThreadPool
+            fsl_exporter.multiprocessing.Pool = Pool
+
+        self.assertEqual(pool_sizes, [('processes', 2), 2, 2])
+
+    def test_jobs(self):
+        """
+        Test: Check that a group analysis with several cope*.feat directories
+        gives the same clusters, peaks and search space whatever the number
+        of workers.
+        """
+        gfeat_dir = make_gfeat_dir(
+            os.path.join(self.tmp_dir, 'group.gfeat'), num_copes=3,
+            num_clusters=4)
+
+        summaries = list()
+        for jobs in (1, 2):
+            exporter = FSLtoNIDMExporter(
+                gfeat_dir, version="1.3.0", groups=[['control', '5']],
+                jobs=jobs)
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    exporter.parse()
+            finally:
+                exporter.cleanup()
+            summaries.append(self._inferences_summary(exporter))
+
+        self.assertEqual(len(summaries[0]), 3)
+        self.assertTrue(all(inference[-1] for inference in summaries[0]))
+        self.assertEqual(summaries[0], summaries[1])
+
+if __name__ == '__main__':
+    unittest.main()
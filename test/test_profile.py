@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Test of the profiling of the phases of an export
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+
+from nidmfsl.fsl_exporter.profile import Profiler, phase
+
+
+class TestProfile(unittest.TestCase):
+
+    def test_nested_phases(self):
+        """
+        Test: Check that nested phases are reported by path in the order they
+        are started and that calls of a phase are summed.
+        """
+        profiler = Profiler()
+        step = profiler.wrap('step', lambda x: x + 1)
+        with profiler.phase('parse'):
+            self.assertEqual(step(1), 2)
+            self.assertEqual(step(2), 3)
+        step(3)
+
+        phases = profiler.to_dict()['phases']
+        self.assertEqual([(p['phase'], p['calls']) for p in phases],
+                         [('parse', 1), ('parse/step', 2), ('step', 1)])
+        for record in phases:
+            self.assertGreaterEqual(record['wall'], 0)
+            self.assertGreaterEqual(record['cpu'], 0)
+
+    def test_merge(self):
+        """
+        Test: Check that the phases of a worker are merged in the phase
+        currently running.
+        """
+        worker = Profiler()
+        with worker.phase('smoothness'):
+            pass
+
+        profiler = Profiler()
+        with profiler.phase('parse'):
+            profiler.merge(worker.phases)
+            profiler.merge(worker.phases)
+
+        self.assertEqual(profiler.phases['parse/smoothness']['calls'], 2)
+
+    def test_disabled(self):
+        """
+        Test: Check that phases can be used without a profiler.
+        """
+        with phase(None, 'parse'):
+            pass
+
+if __name__ == '__main__':
+    unittest.main()
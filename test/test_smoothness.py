@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Test of the estimation of the smoothness without FSL
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+import os
+import sys
+import json
+import shutil
+import tempfile
+import warnings
+import numpy as np
+
+from nidmfsl.fsl_exporter.fsl_exporter import FSLtoNIDMExporter
+from nidmfsl.fsl_exporter import smoothness as smoothness_module
+from nidmfsl.fsl_exporter.smoothness import parse_smoothest_command, \
+    smoothest_inputs, estimate_smoothness_from_command
+
+# Add the test directory (with the generator) to python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from synthetic_feat import make_feat_dir, FWHM_VX
+
+
+class TestSmoothness(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.feat_dir = make_feat_dir(
+            os.path.join(self.tmp_dir, 'sub.feat'), shape=(32, 32, 32),
+            num_contrasts=1, num_ftests=0, num_points=30,
+            verbose_smoothness=False)
+        # Only needed to be set for first-level analyses
+        self.fsl_dir = os.environ.get('FSLDIR')
+        os.environ['FSLDIR'] = self.tmp_dir
+
+    def tearDown(self):
+        if self.fsl_dir is None:
+            del os.environ['FSLDIR']
+        else:
+            os.environ['FSLDIR'] = self.fsl_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_smoothest_command(self):
+        """
+        Test: Check that the inputs of smoothest are found in the logged
+        command (with short or long options and flags).
+        """
+        self.assertEqual(
+            parse_smoothest_command(
+                "smoothest -d 28 -m mask -r stats/res4d > stats/smoothness"),
+            {'dof': 28.0, 'mask': 'mask', 'res': 'stats/res4d'})
+        self.assertEqual(
+            parse_smoothest_command(
+                "smoothest -V --mask=mask -z stats/zstat1"),
+            {'mask': 'mask', 'zstat': 'stats/zstat1'})
+
+    def test_estimate_smoothness(self):
+        """
+        Test: Check that the FWHM of smoothed residuals is recovered and that
+        the volume is the size of the mask.
+        """
+        smoothness = estimate_smoothness_from_command(
+            "smoothest -d 28 -m mask -r stats/res4d > stats/smoothness",
+            self.feat_dir)
+
+        estimated = [smoothness['FWHM' + axis + '_vx'] for axis in 'xyz']
+        self.assertTrue(np.allclose(estimated, FWHM_VX, rtol=0.1))
+        self.assertTrue(np.allclose(
+            [smoothness['FWHM' + axis + '_mm'] for axis in 'xyz'],
+            np.array(estimated) * 3))
+        self.assertEqual(smoothness['volume'], 30 ** 3)
+        self.assertAlmostEqual(smoothness['vox_per_resels'],
+                               np.prod(estimated))
+
+    def test_chunks(self):
+        """
+        Test: Check that residuals with more volumes than CHUNK_SIZE, read
+        chunk by chunk, give the same estimates as when read at once.
+        """
+        cmd = "smoothest -d 28 -m mask -r stats/res4d > stats/smoothness"
+        chunk_size = smoothness_module.CHUNK_SIZE
+        self.assertTrue(30 > chunk_size)
+        try:
+            chunked = estimate_smoothness_from_command(cmd, self.feat_dir)
+            smoothness_module.CHUNK_SIZE = 7
+            small_chunks = estimate_smoothness_from_command(
+                cmd, self.feat_dir)
+            smoothness_module.CHUNK_SIZE = 30
+            whole = estimate_smoothness_from_command(cmd, self.feat_dir)
+        finally:
+            smoothness_module.CHUNK_SIZE = chunk_size
+
+        for key in whole:
+            self.assertAlmostEqual(chunked[key], whole[key])
+            self.assertAlmostEqual(small_chunks[key], whole[key])
+
+    def test_native_smoothness(self):
+        """
+        Test: Check that the noise FWHM is reported when it was not stored by
+        FEAT without running FSL's smoothest.
+        """
+        exporter = FSLtoNIDMExporter(
+            self.feat_dir, version="1.3.0", native_smoothness=True)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                exporter.parse()
+        finally:
+            exporter.cleanup()
+
+        search_space = exporter.analysis_contexts[self.feat_dir].search_space
+        fwhm = json.loads(search_space['noise_fwhm_in_voxels'])
+        self.assertTrue(np.allclose(fwhm, FWHM_VX, rtol=0.1))
+        # Resels are computed from the estimated FWHM
+        self.assertAlmostEqual(search_space['resel_size_in_voxels'],
+                               np.prod(fwhm))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.feat_dir, 'stats', 'smoothness_v')))
+
+    def test_missing_residuals(self):
+        """
+        Test: Check that the export goes on without noise FWHM (and with
+        FSL's resels) when the residuals used by smoothest were deleted.
+        """
+        cmd = "smoothest -d 28 -m mask -r stats/res4d > stats/smoothness"
+        self.assertIsNotNone(smoothest_inputs(cmd, self.feat_dir))
+        os.remove(os.path.join(self.feat_dir, 'stats', 'res4d.nii.gz'))
+        self.assertIsNone(smoothest_inputs(cmd, self.feat_dir))
+        self.assertIsNone(smoothest_inputs("smoothest -m mask",
+                                           self.feat_dir))
+
+        exporter = FSLtoNIDMExporter(
+            self.feat_dir, version="1.3.0", native_smoothness=True)
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                exporter.parse()
+        finally:
+            exporter.cleanup()
+
+        self.assertTrue(any(
+            "noise FWHM will not be reported" in str(warning.message)
+            for warning in caught))
+        search_space = exporter.analysis_contexts[self.feat_dir].search_space
+        self.assertIsNone(search_space['noise_fwhm_in_voxels'])
+        self.assertAlmostEqual(
+            search_space['resel_size_in_voxels'],
+            np.loadtxt(os.path.join(self.feat_dir, 'stats', 'smoothness'),
+                       usecols=[1])[2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Test of the atomic move of NIDM-Results packs
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+import os
+import shutil
+import tempfile
+
+from nidmfsl.fsl_exporter import staging
+from nidmfsl.fsl_exporter.staging import move_atomic, link_file
+
+
+class TestMoveAtomic(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'scratch')
+        self.dst_dir = os.path.join(self.tmp_dir, 'out')
+        os.mkdir(self.src_dir)
+        os.mkdir(self.dst_dir)
+        self.same_device = staging.same_device
+
+    def tearDown(self):
+        staging.same_device = self.same_device
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, path, text):
+        with open(path, 'w') as fid:
+            fid.write(text)
+
+    def _read(self, path):
+        with open(path, 'r') as fid:
+            return fid.read()
+
+    def _check_moves(self):
+        # File pack, replacing a previous one
+        src = os.path.join(self.src_dir, 'sub.nidm.zip')
+        dst = os.path.join(self.dst_dir, 'sub.nidm.zip')
+        self._write(dst, 'previous')
+        self._write(src, 'new')
+        move_atomic(src, dst)
+        self.assertEqual(self._read(dst), 'new')
+        self.assertFalse(os.path.exists(src))
+
+        # Directory pack, replacing a previous one
+        src = os.path.join(self.src_dir, 'sub.nidm')
+        dst = os.path.join(self.dst_dir, 'sub.nidm')
+        os.mkdir(dst)
+        self._write(os.path.join(dst, 'old.txt'), 'previous')
+        os.mkdir(src)
+        self._write(os.path.join(src, 'nidm.ttl'), 'new')
+        move_atomic(src, dst)
+        self.assertEqual(os.listdir(dst), ['nidm.ttl'])
+        self.assertFalse(os.path.exists(src))
+
+        # No temporary file is left next to the packs
+        self.assertEqual(sorted(os.listdir(self.dst_dir)),
+                         ['sub.nidm', 'sub.nidm.zip'])
+
+    def test_move_atomic(self):
+        """
+        Test: Check that packs are moved in place of previous outputs.
+        """
+        self._check_moves()
+
+    def test_move_atomic_other_device(self):
+        """
+        Test: Check that packs staged on another file system are copied
+        before being moved in place.
+        """
+        staging.same_device = lambda path, directory: False
+        self._check_moves()
+
+
+class TestLinkFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'cope1.nii.gz')
+        with open(self.src, 'w') as fid:
+            fid.write('cope')
+        self.link = os.link
+        self.reflink = staging._reflink
+
+    def tearDown(self):
+        os.link = self.link
+        staging._reflink = self.reflink
+        shutil.rmtree(self.tmp_dir)
+
+    def _unsupported(self, *args):
+        raise OSError("Not supported")
+
+    def _read(self, path):
+        with open(path, 'r') as fid:
+            return fid.read()
+
+    def test_hardlink(self):
+        """
+        Test: Check that files are hard linked on the same file system.
+        """
+        dst = os.path.join(self.tmp_dir, 'Contrast.nii.gz')
+        self.assertEqual(link_file(self.src, dst), 'hardlink')
+        self.assertTrue(os.path.samefile(self.src, dst))
+
+    def test_fallbacks(self):
+        """
+        Test: Check that files are symbolically linked when neither hard
+        links nor reflinks are supported.
+        """
+        os.link = self._unsupported
+        staging._reflink = self._unsupported
+        dst = os.path.join(self.tmp_dir, 'Contrast.nii.gz')
+        self.assertEqual(link_file(self.src, dst), 'symlink')
+        self.assertTrue(os.path.islink(dst))
+        self.assertEqual(self._read(dst), 'cope')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Test of the generator of synthetic FEAT directories
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+import scipy.ndimage
+
+from nidmfsl.fsl_exporter.fsf import FSFDesign
+from nidmfsl.fsl_exporter.batch import BatchItem, discover_feat_dirs
+
+# Add the test directory (with the generator) to python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from synthetic_feat import make_feat_dir, make_gfeat_dir
+
+
+class TestSyntheticFeat(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_feat_dir(self):
+        """
+        Test: Check that a synthetic first-level FEAT directory has the
+        requested design and a cluster table consistent with each excursion
+        set.
+        """
+        feat_dir = make_feat_dir(
+            os.path.join(self.tmp_dir, 'sub.feat'), shape=(20, 20, 20),
+            num_evs=3, num_contrasts=4, num_ftests=2, num_clusters=4)
+
+        design = FSFDesign.from_file(os.path.join(feat_dir, 'design.fsf'))
+        self.assertEqual(design.get('fmri(level)'), 1)
+        self.assertEqual(design.get('fmri(evs_orig)'), 3)
+        self.assertEqual(len(design.vector('fmri(con_real1.*)')), 3)
+        self.assertEqual(design.get('fmri(ncon_real)'), 4)
+        self.assertEqual(design.get('fmri(nftests_real)'), 2)
+        self.assertTrue(all(os.path.isfile(onsets) for onsets in
+                            design.vector('fmri(custom*)')))
+
+        exc_sets = glob.glob(os.path.join(feat_dir, 'thresh_z*.nii.gz'))
+        self.assertEqual(len(exc_sets), 6)
+        for exc_set in exc_sets:
+            labels, num_clusters = scipy.ndimage.label(
+                nib.load(exc_set).get_fdata() > 0, np.ones((3, 3, 3)))
+            cluster_table = exc_set.replace('thresh_', 'cluster_').replace(
+                '.nii.gz', '.txt')
+            self.assertEqual(len(np.loadtxt(
+                cluster_table, skiprows=1, ndmin=2)), num_clusters)
+
+    def test_gfeat_dir(self):
+        """
+        Test: Check that a synthetic higher-level FEAT directory has one
+        analysis directory per cope and is found by the batch discovery.
+        """
+        gfeat_dir = make_gfeat_dir(
+            os.path.join(self.tmp_dir, 'group.gfeat'), shape=(20, 20, 20),
+            num_copes=3, num_contrasts=2, num_clusters=2)
+
+        analysis_dirs = sorted(
+            glob.glob(os.path.join(gfeat_dir, 'cope*.feat')))
+        self.assertEqual(len(analysis_dirs), 3)
+        for analysis_dir in analysis_dirs:
+            self.assertEqual(len(glob.glob(
+                os.path.join(analysis_dir, 'lmax_zstat*_std.txt'))), 2)
+            self.assertTrue(os.path.isfile(
+                os.path.join(analysis_dir, 'stats', 'smoothness')))
+
+        self.assertEqual(discover_feat_dirs(self.tmp_dir, [['all', '5']]),
+                         [BatchItem(gfeat_dir, [['all', '5']])])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Test of the reader of the tables of clusters and peaks written by FSL
+
+
+@author: Camille Maumet <c.m.j.maumet@warwick.ac.uk>
+@copyright: University of Warwick 2013-2014
+"""
+import unittest
+import os
+import shutil
+import tempfile
+import warnings
+
+from nidmfsl.fsl_exporter.tables import read_table
+
+CLUSTER_HEADER = "Cluster Index\tVoxels\tP\t-log10(P)\tZ-MAX\t" \
+    "Z-MAX X (vox)\tZ-MAX Y (vox)\tZ-MAX Z (vox)\tZ-COG X (vox)\t" \
+    "Z-COG Y (vox)\tZ-COG Z (vox)\t\n"
+LMAX_HEADER = "Cluster Index\tZ\tx\ty\tz\t\n"
+
+
+class TestTables(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, text):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as fid:
+            fid.write(text)
+        return path
+
+    def test_cluster_table(self):
+        """
+        Test: Check that the columns of a cluster table are found by name and
+        that its values are read once per path when a cache is given.
+        """
+        path = self._write(
+            'cluster_zstat1.txt', CLUSTER_HEADER +
+            "2\t120\t1.5e-08\t7.82\t5.1\t10\t12\t8\t10.2\t11.9\t8.4\n"
+            "1\t45\t0.0012\t2.92\t4.2\t30\t5\t7\t29.5\t5.5\t6.8\n")
+
+        table = read_table(path)
+        self.assertEqual(table.data.shape, (2, 11))
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.indices('P'), [2])
+        self.assertEqual(table.indices('Z-COG '), [8, 9, 10])
+        self.assertEqual(table.indices('Z-MAX X'), [5])
+        self.assertEqual(table.indices('COPE-MAX X'), [])
+        self.assertEqual(list(table.records['Voxels']), [120, 45])
+        self.assertEqual(table.data[0, 2], 1.5e-08)
+
+        cache = dict()
+        self.assertIs(read_table(path, cache), read_table(path, cache))
+
+    def test_empty_table(self):
+        """
+        Test: Check that an empty peak table (no significant cluster) is read
+        without warnings as a table with no row.
+        """
+        path = self._write('lmax_zstat1.txt', LMAX_HEADER)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            table = read_table(path)
+        self.assertEqual(caught, [])
+        self.assertEqual(table.data.shape, (0, 5))
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.indices('x'), [2])
+
+if __name__ == '__main__':
+    unittest.main()